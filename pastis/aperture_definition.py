@@ -1,6 +1,6 @@
 """
 Generates a segmented pupil and computes the number of unique pairs in your pupil.
-Currently configured for JWST.
+Currently configured for JWST, ATLAST and LUVOIR.
 No inputs.
 
 nb_seg is the number of segments WITHOUT the central obscuration.
@@ -10,13 +10,13 @@ discarded once we are getting the coordinates of the segment centers.
 NRPs are numbered from 0 to NR_pairs_nb-1 (NR_pairs_nb = total number of NRPs).
 
 Outputs:
-    Projection_Matrix:  [nb_seg, nb_seg, 3] array
-                        First plane: Projection_Matrix[i,j,0] = n means that the segment pair formed by the segments #i
-                        and #j is equivalent to the pair #n of the non-redundant-pair basis.
-                        Second and third planes: Projection_Matrix[i,j,1] = m and Projection_Matrix[i,j,2] = n means
-                        that the segment pair formed by the segments #i and #j is equivalent to the non-redundant pair
-                        formed by the segments #m and #n.
-                        Only the FIRST plane is useful for later (Projection_Matrix[:,:,0]).
+    segmentation.npz:   Versioned bundle holding all of the geometry products below, plus seg_position (segment center
+                        positions in meters), vec_list_nulled and NR_distance_list. Read it with
+                        load_segmentation_bundle(), which memory-maps all arrays.
+    Projection_Matrix:  [nb_seg, nb_seg] integer array (int16, or int32 for more than 32767 NRPs)
+                        Projection_Matrix[i,j] = n means that the segment pair formed by the segments #i and #j is
+                        equivalent to the pair #n of the non-redundant-pair basis. NRPs are numbered from n = 1, and
+                        n = 0 on the diagonal means that there is no pair.
     vec_list:           [nb_seg, nb_seg, 2] array
                         Relative positions of the centers between all pairs of segments.
                         vec_list[i,j,:] = [x,y] means that the vector between the centers of the segments #i and #j has
@@ -28,25 +28,135 @@ Outputs:
                         they're indexed, they start at 0 since that's how Python does indexing. Careful about this.
     Baseline_vec:       Restructured version of NR_pairs_list.
     JWST_aperture.pdf:  PDF display of the telescope pupil
+    *.txt, *.fits:      Text exports of the intermediate products and fits files of vec_list, NR_pairs_list and
+                        Projection_Matrix, only with make_aperture_nrp(export_text=True)
     pupil.fits:         fits file of the telescope pupil, stored for later use
 """
 
 import os
 import time
+import functools
 import numpy as np
 import astropy.units as u
 import logging
 
 import util_pastis as util
 from config import CONFIG_INI
+import disk_cache
 
 log = logging.getLogger()
 
+# Increase the version whenever the content or layout of the segmentation bundle changes
+SEGMENTATION_BUNDLE_NAME = 'segmentation.npz'
+SEGMENTATION_BUNDLE_VERSION = 1
 
-def make_aperture_nrp():
+
+def get_baseline_keys(vectors, precision=1e-6):
+    """
+    Create hashable keys of quantized baseline vectors that are identical for all redundant baselines.
+
+    Two baselines are redundant if they have the same length and the same direction, up to their sign. The vectors are
+    quantized to multiples of 'precision' and then flipped into the half-plane x > 0 (or x = 0 and y >= 0), which makes
+    the key of a vector and of its opposite the same.
+    :param vectors: array, baseline vectors [nb_baselines, 2] in meters
+    :param precision: float, quantization step in meters, baselines that differ by less are considered identical
+    :return: list of tuples, one key per baseline
+    """
+    quantized = np.rint(np.asarray(vectors) / precision).astype(np.int64)
+    flip = (quantized[:, 0] < 0) | ((quantized[:, 0] == 0) & (quantized[:, 1] < 0))
+    quantized[flip] *= -1
+
+    return list(map(tuple, quantized))
+
+
+def null_redundant_baselines(vec_flat):
+    """
+    Set all baselines that are redundant with an earlier baseline to zero.
+
+    Redundant baselines have identical quantized keys, so we only need to remember where each key showed up first.
+    Every later baseline with the same key gets nulled. This keeps the first occurrence of each baseline in the
+    flattened order, which is exactly what the pair-wise comparison against all earlier baselines did. The diagonal
+    (baseline between a segment with itself) is zero in vec_flat already and stays zero.
+    :param vec_flat: array, baseline vectors [nb_baselines, 2] in meters
+    :return: array, copy of vec_flat with the redundant baselines set to zero
+    """
+    vec_null = np.copy(vec_flat)
+    first_occurrence = {}
+    for i, key in enumerate(get_baseline_keys(vec_flat)):
+        if key in first_occurrence:
+            vec_null[i, :] = [0, 0]
+        else:
+            first_occurrence[key] = i
+
+    return vec_null
+
+
+def make_projection_matrix(vec_list, nrp_vectors):
+    """
+    Find the NRP of each segment pair, as a compact integer index.
+
+    Every NRP is identified by the quantized key of its baseline vector, which is shared by all redundant baselines,
+    so the NRP of each segment pair is looked up in one pass over all baselines.
+    :param vec_list: array, baseline vectors [nb_seg, nb_seg, 2] between all pairs of segments, in meters
+    :param nrp_vectors: array, baseline vectors [NR_pairs_nb, 2] of the NRPs, in meters
+    :return: array, Projection_Matrix [nb_seg, nb_seg] of NRP numbers, starting at 1 so that 0 can stand for
+             "no NRP" on the diagonal
+    """
+    nb_seg = vec_list.shape[0]
+    baseline_to_nrp = {key: k + 1 for k, key in enumerate(get_baseline_keys(nrp_vectors))}
+
+    vec_flat = np.reshape(vec_list, (np.square(nb_seg), 2))
+    nrp_numbers = [baseline_to_nrp.get(key, 0) for key in get_baseline_keys(vec_flat)]
+    index_type = np.int16 if len(nrp_vectors) <= np.iinfo(np.int16).max else np.int32
+    return np.reshape(np.array(nrp_numbers, dtype=index_type), (nb_seg, nb_seg))
+
+
+def write_segmentation_bundle(filepath, telescope, **products):
+    """
+    Save all geometry products of the segmentation into one uncompressed, versioned npz file.
+    :param filepath: str, path to save the bundle to, including file name
+    :param telescope: str, name of the telescope the segmentation was made for
+    :param products: numpy arrays to store in the bundle, e.g. seg_position, vec_list, NR_pairs_list, Projection_Matrix
+    :return: filepath
+    """
+    np.savez(filepath, version=SEGMENTATION_BUNDLE_VERSION, telescope=telescope, **products)
+    return filepath
+
+
+def load_segmentation_bundle(segdir):
+    """
+    Read the segmentation bundle from a segmentation directory, with all arrays memory-mapped read-only.
+
+    The bundle is only opened again if the file on disk changed, so repeated calls of the analytical model don't parse
+    anything more than once.
+    :param segdir: str, path to the 'segmentation' directory created by make_aperture_nrp()
+    :return: dict of numpy arrays: seg_position, vec_list, vec_list_nulled, NR_distance_list, NR_pairs_list,
+             Projection_Matrix, plus the bundle version and the telescope name
+    """
+    filepath = os.path.join(segdir, SEGMENTATION_BUNDLE_NAME)
+    if not os.path.isfile(filepath):
+        raise FileNotFoundError(f'No segmentation bundle in {segdir}, run aperture_definition.py first.')
+    return _load_segmentation_bundle(filepath, os.path.getmtime(filepath))
+
+
+@functools.lru_cache(maxsize=4)
+def _load_segmentation_bundle(filepath, mtime):
+    bundle = util.load_npz_mmap(filepath)
+    if int(bundle['version']) != SEGMENTATION_BUNDLE_VERSION:
+        raise ValueError(f"Segmentation bundle {filepath} has version {int(bundle['version'])}, but version "
+                         f"{SEGMENTATION_BUNDLE_VERSION} is needed. Rerun aperture_definition.py.")
+    return bundle
+
+
+def make_aperture_nrp(export_text=False):
+    """
+    Create the segmentation bundle of the telescope defined in the configfile.
+    :param export_text: bool, if True, also save the intermediate products as text files and the main products as fits
+                        files, for testing; default False
+    """
 
     # Keep track of time
-    start_time = time.time()   # runtime currently is around 2 seconds for JWST, 9 minutes for ATLAST
+    start_time = time.time()   # runtime currently is around 2 seconds for JWST, less than a second for ATLAST and LUVOIR
 
     # Parameters
     telescope = CONFIG_INI.get('telescope', 'name').upper()
@@ -82,9 +192,12 @@ def make_aperture_nrp():
         seg_position[:,0] = seg_coords.x
         seg_position[:,1] = seg_coords.y
 
-    # Save the segment center positions just in case we want to check them without running the code
-    np.savetxt(os.path.join(outDir, 'seg_position.txt'), seg_position, fmt='%2.2f')
-    # 18 segments, central segment (0) not included
+    elif telescope == 'LUVOIR':
+        # Segment positions are stored in the header of the indexed aperture of the STDT delivery
+        aper_ind_path = os.path.join(CONFIG_INI.get('LUVOIR', 'optics_path'), 'inputs',
+                                     'TelAp_LUVOIR_gap_pad01_bw_ovsamp04_N1000_indexed.fits')
+        seg_position[:] = np.transpose(disk_cache.read_segment_positions(aper_ind_path, nb_seg))
+
 
     #-# Make distance list with distances between all of the segment centers among each other - in meters
     vec_list = np.zeros((nb_seg, nb_seg, 2))
@@ -92,9 +205,6 @@ def make_aperture_nrp():
         for j in range(nb_seg):
             vec_list[i,j,:] = seg_position[i,:] - seg_position[j,:]
     vec_list *= u.m
-    # Save, but gotta save x and y coordinate separately because of the function I use for saving
-    np.savetxt(os.path.join(outDir, 'vec_list_x.txt'), vec_list[:,:,0], fmt='%2.2f')   # x distance; units: meters
-    np.savetxt(os.path.join(outDir, 'vec_list_y.txt'), vec_list[:,:,1], fmt='%2.2f')   # y distance; units: meters
 
     #-# Nulling redundant vectors = setting redundant vectors in vec_list equal to zero
     # This was really hard to figure out, so I simply went with exactly the same way like in IDL.
@@ -102,51 +212,12 @@ def make_aperture_nrp():
     # Reshape vec_list array to one dimension so that we can implement the loop below
     longshape = vec_list.shape[0] * vec_list.shape[1]
     vec_flat = np.reshape(vec_list, (longshape, 2))
-    # Save for testing
-    np.savetxt(os.path.join(outDir, 'vec_flat.txt'), vec_flat)
-
-    # Create array that will hold the nulled coordinates
-    vec_null = np.copy(vec_flat)
-
-    ap = 0
-    rp = 0
 
     log.info('Nulling redundant segment pairs')
-    for i in range(longshape):
-        for j in range(i):   # Since i starts at 0, the case with i=0 & j=0 never happens, we start at i=1 & j=0
-                             # With this loop setup, in all cases we have i != k, which is the baseline between a
-                             # segment with itself - which is not a valid baseline, so these vectors are already set
-                             # to 0 in vec_null (they're already 0 in vec_flat).
-
-            # Some print statements for testing
-            #print('i, j', i, j)
-            #print('vec_flat[i,:]: ', vec_flat[i,:])
-            #print('vec_flat[j,:]: ', vec_flat[j,:])
-            #print('norm diff: ', np.abs(np.linalg.norm(vec_flat[i,:]) - np.linalg.norm(vec_flat[j,:])))
-            #print('dir diff: ', np.linalg.norm(np.cross(vec_flat[i,:], vec_flat[j,:])))
-            ap += 1
-
-            # Check if length of two vectors is the same (within numerical limits)
-            if np.abs(np.linalg.norm(vec_flat[i,:]) - np.linalg.norm(vec_flat[j,:])) <= 1.e-10:
-
-                # Check if direction of two vectors is the same (within numerical limits)
-                if np.linalg.norm(np.cross(vec_flat[i,:], vec_flat[j,:])) <= 1.e-10:
-
-                    # Some print statements for testing
-                    #print('i, j', i, j)
-                    #print('vec_flat[i,:]: ', vec_flat[i, :])
-                    #print('vec_flat[j,:]: ', vec_flat[j, :])
-                    #print('norm diff: ', np.abs(np.linalg.norm(vec_flat[i, :]) - np.linalg.norm(vec_flat[j, :])))
-                    #print('dir diff: ', np.linalg.norm(np.cross(vec_flat[i, :], vec_flat[j, :])))
-                    rp += 1
-
-                    vec_null[i,:] = [0, 0]
+    vec_null = null_redundant_baselines(vec_flat)
 
     # Reshape nulled array back into proper shape of vec_list
     vec_list_nulled = np.reshape(vec_null, (vec_list.shape[0], vec_list.shape[1], 2))
-    # Save for testing
-    np.savetxt(os.path.join(outDir, 'vec_list_nulled_x.txt'), vec_list_nulled[:, :, 0], fmt='%2.2f')
-    np.savetxt(os.path.join(outDir, 'vec_list_nulled_y.txt'), vec_list_nulled[:, :, 1], fmt='%2.2f')
 
     #-# Extract the (number of) non redundant vectors: NR_distance_list
 
@@ -155,8 +226,6 @@ def make_aperture_nrp():
     nonzero = np.nonzero(distance_list)             # get indices of non-redundant segment pairs
     NR_distance_list = distance_list[nonzero]       # extract the list of distances between segments of NR pairs
     NR_pairs_nb = np.count_nonzero(distance_list)   # Counting how many non-redundant (NR) pairs we have
-    # Save for testing
-    np.savetxt(os.path.join(outDir, 'NR_distance_list.txt'), NR_distance_list, fmt='%2.2f')
     log.info(f'Number of non-redundant pairs: {NR_pairs_nb}')
 
     #-# Select non redundant vectors
@@ -175,8 +244,6 @@ def make_aperture_nrp():
         # Again, NRP are numbered from 1 to NR_pairs_nb, and the segments are too!
 
     NR_pairs_list = NR_pairs_list.astype(int)
-    # Save for testing
-    np.savetxt(os.path.join(outDir, 'NR_pairs_list.txt'), NR_pairs_list, fmt='%i')
 
     #-# Generate projection matrix
 
@@ -189,51 +256,40 @@ def make_aperture_nrp():
             if i ==j:
                 vec_list2[i,j,:] = [0,0]
 
-    # Save for testing
-    np.savetxt(os.path.join(outDir, 'vec_list2_x.txt'), vec_list2[:, :, 0], fmt='%2.2f')
-    np.savetxt(os.path.join(outDir, 'vec_list2_y.txt'), vec_list2[:, :, 1], fmt='%2.2f')
-
-    # Initialize the projection matrix
-    Projection_Matrix_int = np.zeros((nb_seg, nb_seg, 3))
-
-    # Reshape arrays so that we can loop over them easier
-    vec2_long = vec_list2.shape[0] * vec_list2.shape[1]
-    vec2_flat = np.reshape(vec_list2, (vec2_long, 2))
-
-    matrix_long = Projection_Matrix_int.shape[0] * Projection_Matrix_int.shape[1]
-    matrix_flat = np.reshape(Projection_Matrix_int, (matrix_long, 3))
-
     log.info('Creating projection matrix')
-    for i in range(np.square(nb_seg)):
-        # Compare segment pair in i against all available NRPs.
-        # Where it matches, record the NRP number in the matrix entry that corresponds to segments in i.
-
-        for k in range(NR_pairs_nb):
-
-            # Since the segment names (numbers) in NR_pairs_list assume we start numbering the segments at 1, we have to
-            # subtract 1 every time when we need to convert a segment number into an index.
-            # This means we write NR_pairs_list[k,0]-1 and NR_pairs_list[k,1]-1 .
-
-            # Figure out which NRP a segment distance vector corresponds to - first by length.
-            if np.abs(np.linalg.norm(vec2_flat[i, :]) - np.linalg.norm(vec_list[NR_pairs_list[k,0]-1, NR_pairs_list[k,1]-1, :])) <= 1.e-10:
-
-                # Figure out which NRP a segment distance vector corresponds to - now by direction.
-                if np.linalg.norm(np.cross(vec2_flat[i, :], vec_list[NR_pairs_list[k,0]-1, NR_pairs_list[k,1]-1, :])) <= 1.e-10:
-
-                    matrix_flat[i, 0] = k + 1                       # Again: NRP start their numbering at 1
-                    matrix_flat[i, 1] = NR_pairs_list[k,1] + 1      # and segments start their numbering at 1 too
-                    matrix_flat[i, 2] = NR_pairs_list[k,0] + 1      # (see pupil image!).
-
-    # Reshape matrix back to normal form
-    Projection_Matrix = np.reshape(matrix_flat, (Projection_Matrix_int.shape[0], Projection_Matrix_int.shape[1], 3))
+    Projection_Matrix = make_projection_matrix(vec_list2, vec_list[NR_pairs_list[:, 0] - 1, NR_pairs_list[:, 1] - 1])
 
     # Convert the segment positions in vec_list from meters to pixels
     vec_list_px = vec_list * m_to_px
 
-    #-# Save the arrays: vec_list, NR_pairs_list, Projection_Matrix
-    util.write_fits(vec_list_px.value, os.path.join(outDir, 'vec_list.fits'), header=None, metadata=None)
-    util.write_fits(NR_pairs_list, os.path.join(outDir, 'NR_pairs_list_int.fits'), header=None, metadata=None)
-    util.write_fits(Projection_Matrix, os.path.join(outDir, 'Projection_Matrix.fits'), header=None, metadata=None)
+    #-# Save all geometry products to the segmentation bundle
+    write_segmentation_bundle(os.path.join(outDir, SEGMENTATION_BUNDLE_NAME),
+                              telescope=telescope,
+                              seg_position=seg_position,
+                              vec_list=vec_list_px.value,
+                              vec_list_nulled=vec_list_nulled.value,
+                              NR_distance_list=NR_distance_list.value,
+                              NR_pairs_list=NR_pairs_list,
+                              Projection_Matrix=Projection_Matrix)
+
+    #-# Optionally save the intermediate products as text and fits files, for testing
+    if export_text:
+        log.info('Exporting text and fits files for testing')
+        np.savetxt(os.path.join(outDir, 'seg_position.txt'), seg_position, fmt='%2.2f')
+        # Save x and y coordinates separately because of the function used for saving; units: meters
+        np.savetxt(os.path.join(outDir, 'vec_list_x.txt'), vec_list[:,:,0], fmt='%2.2f')
+        np.savetxt(os.path.join(outDir, 'vec_list_y.txt'), vec_list[:,:,1], fmt='%2.2f')
+        np.savetxt(os.path.join(outDir, 'vec_flat.txt'), vec_flat)
+        np.savetxt(os.path.join(outDir, 'vec_list_nulled_x.txt'), vec_list_nulled[:, :, 0], fmt='%2.2f')
+        np.savetxt(os.path.join(outDir, 'vec_list_nulled_y.txt'), vec_list_nulled[:, :, 1], fmt='%2.2f')
+        np.savetxt(os.path.join(outDir, 'NR_distance_list.txt'), NR_distance_list, fmt='%2.2f')
+        np.savetxt(os.path.join(outDir, 'NR_pairs_list.txt'), NR_pairs_list, fmt='%i')
+        np.savetxt(os.path.join(outDir, 'vec_list2_x.txt'), vec_list2[:, :, 0], fmt='%2.2f')
+        np.savetxt(os.path.join(outDir, 'vec_list2_y.txt'), vec_list2[:, :, 1], fmt='%2.2f')
+
+        util.write_fits(vec_list_px.value, os.path.join(outDir, 'vec_list.fits'), header=None, metadata=None)
+        util.write_fits(NR_pairs_list, os.path.join(outDir, 'NR_pairs_list_int.fits'), header=None, metadata=None)
+        util.write_fits(Projection_Matrix, os.path.join(outDir, 'Projection_Matrix.fits'), header=None, metadata=None)
 
     log.info('All outputs saved to {}'.format(outDir))
 
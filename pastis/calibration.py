@@ -1,12 +1,16 @@
 """
 Making the calibration files for PASTIS.
+
+JWST is calibrated with WebbPSF, telescopes that are simulated with an HCIPy SegmentedTelescopeAPLC (like LUVOIR-A)
+are calibrated on that simulator.
 """
 import os
 import time
+import functools
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
 import astropy.units as u
-import webbpsf
 import logging
 
 from config import CONFIG_INI
@@ -16,7 +20,113 @@ import image_pastis as impastis
 log = logging.getLogger()
 
 
-if __name__ == '__main__':
+def _calibrate_segment(i, nm_aber, zern_number, normp, dh_area, outDir=None):
+    """
+    Calculate the E2E and the uncalibrated image-PASTIS contrast for the calibration aberration on one segment.
+
+    The WebbPSF images are calculated on the NIRCam coronagraph session of the current process, which is only set up
+    on the first segment.
+    :param i: int, index of the segment to aberrate, starting at 0
+    :param nm_aber: astropy quantity, calibration aberration in nm
+    :param zern_number: int, Noll index of the local Zernike to calibrate for
+    :param normp: float, maximum of the direct PSF, for normalization
+    :param dh_area: util.DarkHole, dark hole of the WebbPSF images
+    :param outDir: str, if given, save the PASTIS and WebbPSF images and the OTE OPD of this segment to outDir/images
+    :return: contrast_e2e, contrast_pastis: floats, mean contrasts in the dark hole
+    """
+    from e2e_simulators import webbpsf_imaging as webbim
+
+    iter_start = time.time()
+
+    telescope = CONFIG_INI.get('telescope', 'name')
+    fpm = CONFIG_INI.get(telescope, 'focal_plane_mask')          # focal plane mask
+    lyot_stop = CONFIG_INI.get(telescope, 'pupil_plane_stop')    # Lyot stop
+    filter = CONFIG_INI.get(telescope, 'filter_name')
+    nb_seg = CONFIG_INI.getint(telescope, 'nb_subapertures')
+    zern_max = CONFIG_INI.getint('zernikes', 'max_zern')
+    wss_zern_nb = util.noll_to_wss(zern_number)
+    zern_mode = util.ZernikeMode(zern_number)
+
+    # Create the name of the segment the loop is currently at
+    seg = webbim.wss_segs[i].split('-')[0]
+
+    log.info('')
+    log.info(f'Working on segment  {i+1}/{nb_seg}: {seg}')
+    # We have to make sure here that we aberrate the segments in their order of numbering as it was set
+    # in the script that generates the aperture (here: function_baselinify.py)!
+    # Currently there is a bug in WebbPSF though that numbers the segments wrong when used in the exit pupil
+    # orientation, so don't be confused when the segments are numbered wrong in the exit pupil!
+
+    # Create arrays to hold Zernike aberration coefficients
+    Aber_WSS = np.zeros([nb_seg, zern_max])           # The Zernikes here will be filled in the WSS order!!!
+                                                      # Because it goes into _apply_hexikes_to_seg().
+    Aber_Noll = np.copy(Aber_WSS)                     # This is the Noll version for input into PASTIS.
+
+    # Feed the aberration nm_aber into the array position
+    # that corresponds to the correct Zernike, but only on segment i
+    Aber_WSS[i, wss_zern_nb-1] = nm_aber.to(u.m).value  # Aberration on the segment we're currently working on;
+                                                        # convert to meters; -1 on the Zernike because Python starts
+                                                        # numbering at 0.
+    Aber_Noll[i, zern_number-1] = nm_aber.value         # Noll version - in nm
+
+    # Make sure the aberration coefficients have correct units
+    Aber_Noll *= u.nm
+    # Aber_WSS does NOT get multiplied by u.m, because the poppy function it goes to is actually a private function
+    # that is not decorated with the astropy decorator for checking units and does not use astropy.units. Which is
+    # why we made sure it gets filled with values in units of meters already a couple of lines above this.
+
+    #-# Crate OPD with aberrated segment(s) and generate the coronagraphic PSF
+    log.info('Applying aberration to OTE and calculating coronagraphic PSF.')
+    log.info('nm_aber: {}'.format(nm_aber))
+    nc_coro = webbim.get_nircam_session(filter, fpm, lyot_stop)
+    psf_end = nc_coro.calc_psf(Aber_WSS)   # resets the OTE, so there are no previous movements on the segments
+
+    #-# Normalize coro PSF
+    psf_end = psf_end / normp
+
+    #-# Get end-to-end image in DH, calculate the contrast (mean) and put it in array
+    contrast_e2e = util.dh_mean(psf_end, dh_area)
+
+    #-# Create image from PASTIS (analytical model), calculate contrast (mean, in DH) and put in array
+    dh_im_am, full_im_am = impastis.analytical_model(zern_number, Aber_Noll[:, zern_number-1], cali=False)
+    contrast_pastis = util.dh_mean(dh_im_am, impastis.analytical_dark_hole())
+
+    log.info(f'Contrast WebbPSF: {contrast_e2e}')
+    log.info(f'Contrast image-PASTIS, uncalibrated: {contrast_pastis}')
+
+    if outDir is not None:
+        # Save images for testing
+        im_am_name = 'image_pastis_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index) + '_seg' + str(i+1)
+        util.write_fits(full_im_am, os.path.join(outDir, 'images', im_am_name + '.fits'))
+        im_end_name = 'image_webbpsf_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index) + '_seg' + str(i+1)
+        util.write_fits(psf_end, os.path.join(outDir, 'images', im_end_name + '.fits'))
+        # Save OTE OPD
+        opd_name = 'opd_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index) + '_seg' + str(i+1)
+        plt.clf()
+        nc_coro.ote.display_opd()
+        plt.savefig(os.path.join(outDir, 'images', opd_name + '.pdf'))
+
+    iter_end = time.time()
+    log.info(f'Iteration {i+1} runtime: {iter_end-iter_start}sec = {(iter_end-iter_start)/60}min')
+
+    return contrast_e2e, contrast_pastis
+
+
+def calibration_jwst(processes=1, save_images=False):
+    """
+    Calculate the calibration coefficients of the analytical model for JWST, for the local Zernike in the configfile.
+
+    Each segment gets the calibration aberration on its own and the calibration coefficient is calculated from the
+    resulting E2E (WebbPSF) and uncalibrated image-PASTIS contrasts. The segments can be spread across several worker
+    processes, each of which sets up its own NIRCam coronagraph once; the results do not depend on the number of
+    processes. All inputs are read from the (local) configfile and the outputs are saved to the calibration directory.
+    :param processes: int, number of worker processes to calculate the segments with; 1 runs them serially
+    :param save_images: bool, whether to save the PASTIS and WebbPSF images as fits and the OTE OPD as PDF, for each
+                        segment; default False
+    :return: calibration: array, calibration coefficient per segment
+    """
+
+    from e2e_simulators import webbpsf_imaging as webbim
 
     # Keep track of time
     start_time = time.time()   # runtime currently is around 3 minutes
@@ -27,71 +137,41 @@ if __name__ == '__main__':
     fpm = CONFIG_INI.get(telescope, 'focal_plane_mask')                 # focal plane mask
     lyot_stop = CONFIG_INI.get(telescope, 'pupil_plane_stop')   # Lyot stop
     filter = CONFIG_INI.get(telescope, 'filter_name')
-    tel_size_px = CONFIG_INI.getint('numerical', 'tel_size_px')
-    im_size_e2e = CONFIG_INI.getint('numerical', 'im_size_px_webbpsf')
-    size_seg = CONFIG_INI.getint('numerical', 'size_seg')
     nb_seg = CONFIG_INI.getint(telescope, 'nb_subapertures')
-    wss_segs = webbpsf.constants.SEGNAMES_WSS_ORDER
-    zern_max = CONFIG_INI.getint('zernikes', 'max_zern')
     inner_wa = CONFIG_INI.getint(telescope, 'IWA')
     outer_wa = CONFIG_INI.getint(telescope, 'OWA')
     sampling = CONFIG_INI.getfloat('numerical', 'sampling')
 
-    if telescope == 'JWST':
-        # Setting to ensure that PyCharm finds the webbpsf-data folder. If you don't know where it is, find it with:
-        # webbpsf.utils.get_webbpsf_data_path()
-        # --> e.g.: >>source activate astroconda   >>ipython   >>import webbpsf   >>webbpsf.utils.get_webbpsf_data_path()
-        os.environ['WEBBPSF_PATH'] = CONFIG_INI.get('local', 'webbpsf_data_path')
-
     nm_aber = CONFIG_INI.getfloat('calibration', 'calibration_aberration') * u.nm       # [nm] amplitude of aberration
     zern_number = CONFIG_INI.getint('calibration', 'local_zernike')               # Which (Noll) Zernike we are calibrating for
-    wss_zern_nb = util.noll_to_wss(zern_number)                             # Convert from Noll to WSS framework
 
     # If subfolder "calibration" doesn't exist yet, create it.
     if not os.path.isdir(outDir):
         os.mkdir(outDir)
 
     # If subfolder "images" in "calibration" doesn't exist yet, create it.
-    if not os.path.isdir(os.path.join(outDir, 'images')):
+    if save_images and not os.path.isdir(os.path.join(outDir, 'images')):
         os.mkdir(os.path.join(outDir, 'images'))
 
     # Create Zernike mode object for easier handling
     zern_mode = util.ZernikeMode(zern_number)
 
-    # Create NIRCam objects, one for perfect PSF and one with coronagraph
+    # NIRCam with and without coronagraph, with all OTE and SI WFE nulled; the coronagraph is also used for the
+    # segments if we run serially
     log.info('Setting up the E2E simulation.')
-    nc = webbpsf.NIRCam()
-    # Set filter
-    nc.filter = filter
-
-    # Same for coronagraphic case
-    nc_coro = webbpsf.NIRCam()
-    nc_coro.filter = filter
-
-    # Add coronagraphic elements to nc_coro
-    nc_coro.image_mask = fpm
-    nc_coro.pupil_mask = lyot_stop
-
-    # Null the OTE OPDs for the PSFs, maybe we will add internal WFE later.
-    nc, ote = webbpsf.enable_adjustable_ote(nc)                     # create OTE for default PSF
-    nc_coro, ote_coro = webbpsf.enable_adjustable_ote(nc_coro)      # create OTE for coronagraph
-    ote.zero()                        # set OTE for default PSF to zero
-    ote_coro.zero()                   # set OTE for coronagraph to zero
-    nc.include_si_wfe = False         # set SI internal WFE to zero
-    nc_coro.include_si_wfe = False    # set SI internal WFE to zero
+    nc_nocoro = webbim.get_nircam_session(filter)
+    nc_coro = webbim.get_nircam_session(filter, fpm, lyot_stop)
 
     # Generate the E2E PSFs with and without coronagraph
     log.info('Calculating perfect PSF without coronograph...')
     psf_start_time = time.time()
-    psf_default_hdu = nc.calc_psf(fov_pixels=int(im_size_e2e), oversample=1, nlambda=1)
+    nc_nocoro.reset()
+    psf_default = nc_nocoro.calc_psf()
     psf_end_time = time.time()
     log.info(f'Calculating this PSF with WebbPSF took {psf_end_time-psf_start_time}sec = {(psf_end_time-psf_start_time)/60}min')
     log.info('Calculating perfect PSF with coronagraph...\n')
-    psf_coro_hdu = nc_coro.calc_psf(fov_pixels=int(im_size_e2e), oversample=1, nlambda=1)
-
-    # Extract the PSFs to image arrays - the [1] extension gives me detector resolution
-    psf_default = psf_default_hdu[0].data
-    psf_coro = psf_coro_hdu[0].data
+    nc_coro.reset()
+    psf_coro = nc_coro.calc_psf()
 
     # Get maximum of PSF for the normalization and normalize PSFs we have so far
     normp = np.max(psf_default)
@@ -103,103 +183,32 @@ if __name__ == '__main__':
     util.write_fits(psf_coro, os.path.join(outDir, 'psf_coro.fits'), header=None, metadata=None)
 
     # Create the dark hole
-    dh_area = util.create_dark_hole(psf_coro, inner_wa, outer_wa, sampling)
-    util.write_fits(dh_area, os.path.join(outDir, 'dh_area.fits'), header=None, metadata=None)
+    dh_area = util.get_dark_hole(psf_coro.shape, inner_wa, outer_wa, sampling)
+    util.write_fits(dh_area.mask, os.path.join(outDir, 'dh_area.fits'), header=None, metadata=None)
 
     # Calculate the baseline contrast *with* the coronagraph and *without* aberrations and save the value to file
-    contrast_im = psf_coro * dh_area
-    contrast_base = np.mean(contrast_im[np.where(contrast_im != 0)])
+    contrast_base = util.dh_mean(psf_coro, dh_area)
     contrastname = 'base-contrast_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index)   #TODO: Why does the filename include a Zernike if this is supposed to be the perfect PSF without aberrations?
     contrast_fake_array = np.array(contrast_base).reshape(1,)   # Convert into array of shape (1,), otherwise np.savetxt() doesn't work
     np.savetxt(os.path.join(outDir, contrastname+'.txt'), contrast_fake_array)
 
-    # Create the arrays to hold the contrast values from the iterations
-    contrast_e2e = np.zeros([nb_seg])
-    contrast_pastis = np.zeros([nb_seg])
-
-    # Loop over each individual segment, putting always the same aberration on
-    for i in range(nb_seg):
-
-        iter_start = time.time()
-
-        # Create the name of the segment the loop is currently at
-        seg = wss_segs[i].split('-')[0]
-
-        log.info('')
-        log.info(f'Working on segment  {i+1}/{nb_seg}: {seg}')
-        # We have to make sure here that we aberrate the segments in their order of numbering as it was set
-        # in the script that generates the aperture (here: function_baselinify.py)!
-        # Currently there is a bug in WebbPSF though that numbers the segments wrong when used in the exit pupil
-        # orientation, so don't be confused when the segments are numbered wrong in the exit pupil!
-
-        # Create arrays to hold Zernike aberration coefficients
-        Aber_WSS = np.zeros([nb_seg, zern_max])           # The Zernikes here will be filled in the WSS order!!!
-                                                          # Because it goes into _apply_hexikes_to_seg().
-        Aber_Noll = np.copy(Aber_WSS)                     # This is the Noll version for input into PASTIS.
-
-        # Feed the aberration nm_aber into the array position
-        # that corresponds to the correct Zernike, but only on segment i
-        Aber_WSS[i, wss_zern_nb-1] = nm_aber.to(u.m).value  # Aberration on the segment we're currently working on;
-                                                            # convert to meters; -1 on the Zernike because Python starts
-                                                            # numbering at 0.
-        Aber_Noll[i, zern_number-1] = nm_aber.value         # Noll version - in nm
-
-        # Make sure the aberration coefficients have correct units
-        Aber_Noll *= u.nm
-        # Aber_WSS does NOT get multiplied by u.m, because the poppy function it goes to is actually a private function
-        # that is not decorated with the astropy decorator for checking units and does not use astropy.units. Which is
-        # why we made sure it gets filled with values in units of meters already a couple of lines above this.
-
-        #-# Crate OPD with aberrated segment(s)
-        log.info('Applying aberration to OTE.')
-        log.info('nm_aber: {}'.format(nm_aber))
-        ote_coro.reset()   # Making sure there are no previous movements on the segments.
-        ote_coro.zero()    # For now, ignore internal WFE.
-        ote_coro._apply_hexikes_to_seg(seg, Aber_WSS[i,:])
-
-        # If you want to display it:
-        #ote_coro.display_opd()
-        #plt.show()
-
-        #-# Generate the coronagraphic PSF
-        log.info('Calculating coronagraphic PSF.')
-        psf_endsim = nc_coro.calc_psf(fov_pixels=int(im_size_e2e), oversample=1, nlambda=1)
-        psf_end = psf_endsim[0].data
-
-        #-# Normalize coro PSF
-        psf_end = psf_end / normp
-
-        #-# Get end-to-end image in DH, calculate the contrast (mean) and put it in array
-        im_end = psf_end * dh_area
-        contrast_e2e[i] = np.mean(im_end[np.where(im_end != 0)])
-
-        #-# Create image from PASTIS (analytical model), calculate contrast (mean, in DH) and put in array
-        dh_im_am, full_im_am = impastis.analytical_model(zern_number, Aber_Noll[:, zern_number-1], cali=False)
-        contrast_pastis[i] = np.mean(dh_im_am[np.where(dh_im_am != 0)])
-
-        log.info(f'Contrast WebbPSF: {contrast_e2e[i]}')
-        log.info(f'Contrast image-PASTIS, uncalibrated: {contrast_pastis[i]}')
-
-        # Save images for testing
-        im_am_name = 'image_pastis_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index) + '_seg' + str(i+1)
-        util.write_fits(full_im_am, os.path.join(outDir, 'images', im_am_name + '.fits'))
-        #dh_im_am - for image with DH
-        im_end_name = 'image_webbpsf_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index) + '_seg' + str(i+1)
-        util.write_fits(psf_end, os.path.join(outDir, 'images', im_end_name + '.fits'))
-        #im_end - for image with DH
-        # Save OTE OPD
-        opd_name = 'opd_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index) + '_seg' + str(i+1)
-        plt.clf()
-        ote_coro.display_opd()
-        plt.savefig(os.path.join(outDir, 'images', opd_name + '.pdf'))
-
-        iter_end = time.time()
-        log.info(f'Iteration {i+1} runtime: {iter_end-iter_start}sec = {(iter_end-iter_start)/60}min')
+    # Put always the same aberration on each individual segment, in order, either serially or on a pool of processes
+    # that each set up their own NIRCam coronagraph session once. The results come back in segment order in both cases.
+    calibrate_segment = functools.partial(_calibrate_segment, nm_aber=nm_aber, zern_number=zern_number, normp=normp,
+                                          dh_area=dh_area, outDir=outDir if save_images else None)
+    if processes > 1:
+        log.info(f'Calculating {nb_seg} segments on {processes} processes')
+        with multiprocessing.Pool(processes, initializer=webbim.get_nircam_session, initargs=(filter, fpm, lyot_stop)) as pool:
+            results = pool.map(calibrate_segment, range(nb_seg))
+    else:
+        results = [calibrate_segment(i) for i in range(nb_seg)]
+
+    # Create the arrays holding the contrast values from the iterations
+    contrast_e2e = np.array([res[0] for res in results])
+    contrast_pastis = np.array([res[1] for res in results])
 
     log.info('\n--- All PSFs calculated. ---\n')
     # Calculate calibration vector
-    calibration = np.zeros_like(contrast_e2e)
-
     calibration = np.sqrt((contrast_e2e - contrast_base) / contrast_pastis)
 
     #calibration = contrast_e2e / contrast_pastis   # without taking C_0 into account. should never to this, but it's
@@ -219,34 +228,6 @@ if __name__ == '__main__':
     util.write_fits(contrast_e2e, os.path.join(outDir, name_webbpsf+'.fits'), header=None, metadata=None)
     util.write_fits(contrast_pastis, os.path.join(outDir, name_impastis + '.fits'), header=None, metadata=None)
 
-    # Generate some plots
-    """
-    plt.clf()
-    plt.plot(contrast_e2e, label='WebbPSF')
-    plt.plot(contrast_pastis, label='imagePASTIS')
-    plt.title('Aberration per segment: {}'.format(nm_aber))
-    plt.xlabel('Segment number')
-    plt.ylabel('Contrast')
-    plt.legend()
-    plt.savefig(os.path.join(outDir, filename+'.pdf'))
-
-    plt.clf()
-    plt.plot(contrast_e2e, label='WebbPSF')
-    plt.title('Aberration per segment: {}'.format(nm_aber))
-    plt.xlabel('Segment number')
-    plt.ylabel('Contrast')
-    plt.legend()
-    plt.savefig(os.path.join(outDir, 'only_webbpsf'+'.pdf'))
-
-    plt.clf()
-    plt.plot(contrast_pastis, label='imagePASTIS')
-    plt.title('Aberration per segment: {}'.format(nm_aber))
-    plt.xlabel('Segment number')
-    plt.ylabel('Contrast')
-    plt.legend()
-    plt.savefig(os.path.join(outDir, 'only_pastis'+'.pdf'))
-    """
-
     # Tell us how long it took to finish.
     end_time = time.time()
     log.info(f'Runtime for calibration.py: {end_time - start_time}sec = {(end_time - start_time) / 60}min')
@@ -258,3 +239,116 @@ if __name__ == '__main__':
 
     ### If there were an apodizer, leave it in when calculating psf_default ("no coronagraph").
     # Leave Lyot stop in for psf_default?? -> try it, check max of value, because that's our normalization factor.
+
+    return calibration
+
+
+def calibration_hcipy(simulator, dh_mask, outDir=None, design=None):
+    """
+    Calculate the calibration coefficients of the analytical model on an HCIPy segmented telescope simulator.
+
+    The same simulator instance is used for all segments, which get the calibration aberration one by one by setting
+    the coefficients of the whole segmented mirror at once. The segmented mirror has piston, tip and tilt, so these are
+    the local Zernikes that can be calibrated (Noll 1 to 3), with the calibration aberration in nm rms OPD.
+    The image-PASTIS contrasts come from impastis.analytical_model(), on the final focal plane of the simulator.
+    :param simulator: SegmentedTelescopeAPLC, e.g. a LuvoirAPLC instance
+    :param dh_mask: hcipy.Field or util.DarkHole, dark hole on the final focal plane of the simulator
+    :param outDir: str, where to save the results, default is the 'calibration' folder in the 'active' data directory
+    :param design: str, LUVOIR-A APLC design of the simulator, see impastis.analytical_model()
+    :return: calibration: array, calibration coefficient per segment
+    """
+
+    # Keep track of time
+    start_time = time.time()
+
+    # Parameters
+    if outDir is None:
+        outDir = os.path.join(CONFIG_INI.get('local', 'local_data_path'), 'active', 'calibration')
+    telescope = CONFIG_INI.get('telescope', 'name')
+    nb_seg = CONFIG_INI.getint(telescope, 'nb_subapertures')
+    wfe_aber = CONFIG_INI.getfloat('calibration', 'calibration_aberration') * u.nm   # amplitude of aberration (OPD)
+    zern_number = CONFIG_INI.getint('calibration', 'local_zernike')
+    zern_mode = util.ZernikeMode(zern_number)
+
+    # Local Zernikes (Noll) of the segmented mirror, as local modes of the simulator
+    segment_modes = {1: 'piston', 2: 'tip', 3: 'tilt'}
+    if zern_number not in segment_modes:
+        raise ValueError(f'The segmented mirror only has piston, tip and tilt (Noll 1 to 3), it can not be calibrated '
+                         f'for Noll {zern_number}.')
+
+    os.makedirs(outDir, exist_ok=True)
+
+    # Reference image for normalization and baseline contrast *with* coronagraph and *without* aberrations
+    log.info('Calculating unaberrated coronagraphic and reference PSF')
+    simulator.flatten()
+    psf_unaber, ref = simulator.calc_psf(ref=True)
+    norm = ref.max()
+    contrast_base = util.dh_mean(psf_unaber, dh_mask) / norm
+    contrastname = 'base-contrast_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index)
+    np.savetxt(os.path.join(outDir, contrastname + '.txt'), np.array(contrast_base).reshape(1,))
+    log.info(f'Baseline contrast: {contrast_base}')
+
+    # Poke one segment after the other and calculate the E2E and (uncalibrated) image-PASTIS contrast
+    contrast_e2e = np.zeros([nb_seg])
+    contrast_pastis = np.zeros([nb_seg])
+    for i in range(nb_seg):
+        log.info(f'Working on segment {i+1}/{nb_seg}')
+
+        # Segmented mirror coefficients of the calibration aberration (rms OPD) on segment i
+        aber = np.zeros([nb_seg])
+        aber[i] = wfe_aber.to(u.m).value
+        simulator.set_coef(simulator.modal_aber_to_coef(aber, modes=(segment_modes[zern_number],)))
+        psf = simulator.calc_psf()
+        contrast_e2e[i] = util.dh_mean(psf, dh_mask) / norm
+
+        Aber_Noll = np.zeros([nb_seg]) * u.nm
+        Aber_Noll[i] = wfe_aber
+        dh_im_am, _full_im_am = impastis.analytical_model(zern_number, Aber_Noll, cali=False, design=design)
+        contrast_pastis[i] = util.dh_mean(dh_im_am, impastis.analytical_dark_hole(design))
+
+        log.info(f'Contrast E2E: {contrast_e2e[i]}')
+        log.info(f'Contrast image-PASTIS, uncalibrated: {contrast_pastis[i]}')
+
+    simulator.flatten()
+
+    # Calculate and save calibration vector
+    calibration = np.sqrt((contrast_e2e - contrast_base) / contrast_pastis)
+    filename = 'calibration_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index)
+    util.write_fits(calibration, os.path.join(outDir, filename + '.fits'), header=None, metadata=None)
+
+    # Save contrast vectors for the E2E simulator and image-PASTIS so that we can look at the values if needed
+    name_e2e = 'contrast_E2E_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index)
+    name_impastis = 'contrast_IMAGE-PASTIS_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index)
+    util.write_fits(contrast_e2e, os.path.join(outDir, name_e2e + '.fits'), header=None, metadata=None)
+    util.write_fits(contrast_pastis, os.path.join(outDir, name_impastis + '.fits'), header=None, metadata=None)
+
+    # Tell us how long it took to finish.
+    end_time = time.time()
+    log.info(f'Runtime for calibration_hcipy(): {end_time - start_time}sec = {(end_time - start_time) / 60}min')
+    log.info(f'Data saved to {outDir}')
+
+    return calibration
+
+
+def calibration_luvoir(design):
+    """
+    Calculate the calibration coefficients of the analytical model for LUVOIR-A, on a LuvoirAPLC instance.
+    :param design: str, "small", "medium" or "large" LUVOIR-A APLC design
+    :return: calibration: array, calibration coefficient per segment
+    """
+    from e2e_simulators.luvoir_imaging import get_luvoir_aplc
+
+    optics_input = CONFIG_INI.get('LUVOIR', 'optics_path')
+    sampling = CONFIG_INI.getfloat('numerical', 'sampling')
+    luvoir = get_luvoir_aplc(optics_input, design, sampling)
+
+    return calibration_hcipy(luvoir, luvoir.dark_hole, design=design)
+
+
+if __name__ == '__main__':
+
+    telescope = CONFIG_INI.get('telescope', 'name')
+    if telescope == 'LUVOIR':
+        calibration_luvoir(design=CONFIG_INI.get('LUVOIR', 'coronagraph_size'))
+    else:
+        calibration_jwst(processes=os.cpu_count())
@@ -16,12 +16,12 @@ import astropy.units as u
 import logging
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
-import hcipy as hc
 
 from config import CONFIG_INI
 import util_pastis as util
 import image_pastis as impastis
-from e2e_simulators.luvoir_imaging import LuvoirAPLC
+import pastis_analysis
+from e2e_simulators.luvoir_imaging import get_luvoir_aplc
 
 log = logging.getLogger()
 
@@ -87,23 +87,26 @@ def contrast_jwst_ana_num(matdir, matrix_mode="analytical", rms=1. * u.nm, im_pa
     Aber_WSS = np.zeros([nb_seg, zern_max])
     Aber_WSS[:,0] = aber.to(u.m).value   # index "0" works because we're using piston currently; convert to meters
 
+    # NIRCam with and without coronagraph, only set up on the first call
+    nc_nocoro = webbim.get_nircam_session(filter)
+    nc_coro = webbim.get_nircam_session(filter, fpm, lyot_stop)
+
     ### BASELINE PSF - NO ABERRATIONS, NO CORONAGRAPH
     log.info('Generating baseline PSF from E2E - no coronagraph, no aberrations')
-    psf_perfect = webbim.nircam_nocoro(filter, np.zeros_like(Aber_WSS))
+    psf_perfect = nc_nocoro.calc_psf(np.zeros_like(Aber_WSS))
     normp = np.max(psf_perfect)
     psf_perfect = psf_perfect / normp
 
     ### WEBBPSF
     log.info('Generating E2E coro contrast')
     start_webb = time.time()
-    # Set up NIRCam and coronagraph, get PSF
-    psf_webbpsf = webbim.nircam_coro(filter, fpm, lyot_stop, Aber_WSS)
+    # Apply aberrations to the NIRCam coronagraph, get PSF
+    psf_webbpsf = nc_coro.calc_psf(Aber_WSS)
     psf_webbpsf = psf_webbpsf / normp
     # Create dark hole
-    dh_area = util.create_dark_hole(psf_webbpsf, inner_wa, outer_wa, sampling)
+    dh_area = util.get_dark_hole(psf_webbpsf.shape, inner_wa, outer_wa, sampling)
     # Get the mean contrast from the WebbPSF coronagraph
-    webb_dh_psf = psf_webbpsf * dh_area
-    contrast_webbpsf = np.mean(webb_dh_psf[np.where(webb_dh_psf != 0)])
+    contrast_webbpsf = util.dh_mean(psf_webbpsf, dh_area)
     end_webb = time.time()
 
     #TODO: save plots of phase on segmented pupil
@@ -120,7 +123,7 @@ def contrast_jwst_ana_num(matdir, matrix_mode="analytical", rms=1. * u.nm, im_pa
         # Create calibrated image from analytical model
         psf_am, full_psf = impastis.analytical_model(zern_number, aber, cali=True)
         # Get the mean contrast from image PASTIS
-        contrast_am = np.mean(psf_am[np.where(psf_am != 0)]) + coro_floor
+        contrast_am = util.dh_mean(psf_am, impastis.analytical_dark_hole()) + coro_floor
         end_impastis = time.time()
 
     ### MATRIX PASTIS
@@ -249,16 +252,14 @@ def contrast_hicat_num(matrix_dir, matrix_mode='hicat', rms=1*u.nm):
     psf_hicat = psf_hicat[0].data / normp
 
     # Create DH
-    dh_mask = util.create_dark_hole(psf_hicat, iwa=iwa, owa=owa, samp=13 / 4)
+    dh_mask = util.get_dark_hole(psf_hicat.shape, iwa=iwa, owa=owa, samp=13 / 4)
     # Get the mean contrast
-    hicat_dh_psf = psf_hicat * dh_mask
-    contrast_hicat = np.mean(hicat_dh_psf[np.where(hicat_dh_psf != 0)])
+    contrast_hicat = util.dh_mean(psf_hicat, dh_mask)
     end_e2e = time.time()
 
     ###
     # Calculate coronagraph contrast floor
-    baseline_dh = psf_coro * dh_mask
-    coro_floor = np.mean(baseline_dh[np.where(baseline_dh != 0)])
+    coro_floor = util.dh_mean(psf_coro, dh_mask)
 
     ## MATRIX PASTIS
     log.info('Generating contrast from matrix-PASTIS')
@@ -283,11 +284,15 @@ def contrast_hicat_num(matrix_dir, matrix_mode='hicat', rms=1*u.nm):
     return contrast_hicat, contrast_matrix
 
 
-def contrast_luvoir_num(apodizer_choice, matrix_dir, rms=1*u.nm):
+def contrast_luvoir_num(apodizer_choice, matrix_dir, rms=1*u.nm, pupil_px=None,
+                        matrix_name='PASTISmatrix_num_piston_Noll1'):
     """
     Compute the contrast for a random segmented mirror misalignment on the LUVOIR simulator.
     :param matrix_dir: str, directory of saved matrix
     :param rms: astropy quantity (e.g. m or nm), WFE rms (OPD) to be put randomly over the entire segmented mirror
+    :param pupil_px: int, optional, reduced pupil resolution of the simulator, see LuvoirAPLC
+    :param matrix_name: string, file name of the matrix without extension, e.g. a multi-mode matrix from
+                        matrix_building_numerical.num_matrix_luvoir_multimode(); default is the piston matrix
     :return: 2x float, E2E and matrix contrast
     """
 
@@ -298,13 +303,13 @@ def contrast_luvoir_num(apodizer_choice, matrix_dir, rms=1*u.nm):
     nb_seg = CONFIG_INI.getint('LUVOIR', 'nb_subapertures')
     sampling = 4
 
-    # Import numerical PASTIS matrix for HiCAT sim
-    filename = 'PASTISmatrix_num_piston_Noll1'
-    matrix_pastis = fits.getdata(os.path.join(matrix_dir, filename + '.fits'))
+    # Import numerical PASTIS matrix, and the local segment modes it is made of
+    matrix_pastis, matrix_header = fits.getdata(os.path.join(matrix_dir, matrix_name + '.fits'), header=True)
+    modes = pastis_analysis.matrix_local_modes(matrix_header)
 
-    # Create random aberration coefficients
-    aber = np.random.random([nb_seg])   # piston values in input units
-    log.info(f'PISTON ABERRATIONS: {aber}')
+    # Create random aberration coefficients, ordered by local mode first, then by segment
+    aber = np.random.random([len(modes) * nb_seg])   # values in input units
+    log.info(f"{', '.join(modes).upper()} ABERRATIONS: {aber}")
 
     # Normalize to the WFE RMS value I want
     rms_init = util.rms(aber)
@@ -314,7 +319,9 @@ def contrast_luvoir_num(apodizer_choice, matrix_dir, rms=1*u.nm):
     log.info(f"Calculated WFE RMS: {calc_rms}")
 
     # Remove global piston
-    aber -= np.mean(aber)
+    if 'piston' in modes:
+        piston = aber[modes.index('piston') * nb_seg:(modes.index('piston') + 1) * nb_seg]
+        piston -= np.mean(piston)
 
     # Coronagraph parameters
     # The LUVOIR STDT delivery in May 2018 included three different apodizers
@@ -322,40 +329,24 @@ def contrast_luvoir_num(apodizer_choice, matrix_dir, rms=1*u.nm):
     design = apodizer_choice
     optics_input = CONFIG_INI.get('LUVOIR', 'optics_path')
 
-    # Instantiate LUVOIR telescope with APLC
-    luvoir = LuvoirAPLC(optics_input, design, sampling)
+    # Instantiate LUVOIR telescope with APLC, its optics and segment basis are only created once and shared between calls
+    luvoir = get_luvoir_aplc(optics_input, design, sampling, pupil_px)
+    # All contrasts over the band the matrix is built for
+    pastis_analysis.set_matrix_band(luvoir, matrix_header)
 
-    ### BASELINE PSF - NO ABERRATIONS, NO CORONAGRAPH
-    # and coro PSF without aberrations
     start_e2e = time.time()
-    log.info('Generating baseline PSF from E2E - no coronagraph, no aberrations')
-    log.info('Also generating coro PSF without aberrations')
-    psf_perfect, ref = luvoir.calc_psf(ref=True)
-    normp = np.max(ref)
-    psf_coro = psf_perfect / normp
-
     log.info('Calculating E2E contrast...')
-    # Put aberrations on segmented mirror
-    for nseg in range(nb_seg):
-        luvoir.set_segment(nseg+1, aber[nseg].to(u.m).value/2, 0, 0)
-
-    psf_luvoir = luvoir.calc_psf()
-    psf_luvoir /= normp
-
-    # Create DH
-    dh_outer = hc.circular_aperture(2 * luvoir.apod_dict[design]['owa'] * luvoir.lam_over_d)(luvoir.focal_det)
-    dh_inner = hc.circular_aperture(2 * luvoir.apod_dict[design]['iwa'] * luvoir.lam_over_d)(luvoir.focal_det)
-    dh_mask = (dh_outer - dh_inner).astype('bool')
-
-    # Get the mean contrast
-    dh_intensity = psf_luvoir * dh_mask
-    contrast_luvoir = np.mean(dh_intensity[np.where(dh_intensity != 0)])
+    if modes == ('piston',):
+        # The piston-only state is propagated exactly with the per-segment dark hole E-fields
+        contrast_luvoir = luvoir.calc_piston_contrast(aber.to(u.m).value, luvoir.dh_mask)
+    else:
+        pastis_analysis.apply_mode_to_luvoir(aber.value, luvoir, modes)
+        contrast_luvoir = luvoir.calc_psf_batch(np.array(luvoir.sm.coef)[np.newaxis])[0]
     end_e2e = time.time()
 
     ###
     # Calculate coronagraph contrast floor
-    baseline_dh = psf_coro * dh_mask
-    coro_floor = np.mean(baseline_dh[np.where(baseline_dh != 0)])
+    coro_floor = pastis_analysis.coronagraph_floor(luvoir)
     log.info(f'Baseline contrast: {coro_floor}')
 
     ## MATRIX PASTIS
@@ -381,6 +372,171 @@ def contrast_luvoir_num(apodizer_choice, matrix_dir, rms=1*u.nm):
     return contrast_luvoir, contrast_matrix
 
 
+def precision_validation_luvoir(design, rms_range=(0.1, 1., 10., 100.) * u.nm, realizations=10):
+    """
+    Validate the single-precision propagation of LuvoirAPLC against double precision.
+
+    Random piston maps of different WFE rms (including the unaberrated case) are propagated with
+    LuvoirAPLC.calc_psf_batch() once in double and once in single precision, and the relative differences of the mean
+    dark hole contrasts are reported.
+    :param design: str, "small", "medium" or "large" LUVOIR-A APLC design
+    :param rms_range: astropy quantity array, WFE rms (OPD) values to test
+    :param realizations: int, number of random piston maps per rms value
+    :return: contrast_double, contrast_single, rel_error: arrays [len(rms_range)+1, realizations], first row is the
+             unaberrated case
+    """
+
+    nb_seg = CONFIG_INI.getint('LUVOIR', 'nb_subapertures')
+    optics_input = CONFIG_INI.get('LUVOIR', 'optics_path')
+    sampling = CONFIG_INI.getfloat('numerical', 'sampling')
+    luvoir = get_luvoir_aplc(optics_input, design, sampling)
+
+    # Random piston maps with global piston removed, segment coefficients in meters of surface
+    coefs = np.zeros([len(rms_range) + 1, realizations, nb_seg, 3])
+    for i, rms in enumerate(rms_range):
+        for j in range(realizations):
+            aber = np.random.random([nb_seg])
+            aber -= np.mean(aber)
+            aber *= rms.to(u.m).value / util.rms(aber)
+            coefs[i+1, j, :, 0] = aber / 2
+    coefs = coefs.reshape(-1, nb_seg, 3)
+
+    luvoir.single_precision = False
+    contrast_double = luvoir.calc_psf_batch(coefs)
+    luvoir.single_precision = True
+    contrast_single = luvoir.calc_psf_batch(coefs)
+
+    contrast_double = contrast_double.reshape(len(rms_range) + 1, realizations)
+    contrast_single = contrast_single.reshape(len(rms_range) + 1, realizations)
+    rel_error = np.abs(contrast_single - contrast_double) / contrast_double
+
+    log.info(f'Unaberrated: contrast {np.mean(contrast_double[0])}, max relative error {np.max(rel_error[0])}')
+    for i, rms in enumerate(rms_range):
+        log.info(f'{rms} rms: mean contrast {np.mean(contrast_double[i+1])}, '
+                 f'max relative error {np.max(rel_error[i+1])}')
+
+    return contrast_double, contrast_single, rel_error
+
+
+def pupil_resolution_calibration_luvoir(design, pupil_px, resultdir, rms_range=(0.1, 1., 10., 100.) * u.nm,
+                                        realizations=10):
+    """
+    Calibrate the dark hole contrast of LuvoirAPLC at a reduced pupil resolution against the full resolution.
+
+    Random piston maps of different WFE rms (including the unaberrated case) are propagated with
+    LuvoirAPLC.calc_psf_batch() at the full and at the reduced pupil resolution. The contrasts and their relative
+    differences are saved to resultdir, so they are stored with the run that uses the reduced resolution. If the
+    calibration file already exists there, it is read instead of being calculated again.
+    :param design: str, "small", "medium" or "large" LUVOIR-A APLC design
+    :param pupil_px: int, reduced pupil resolution, see LuvoirAPLC
+    :param resultdir: str, directory of the run
+    :param rms_range: astropy quantity array, WFE rms (OPD) values to test
+    :param realizations: int, number of random piston maps per rms value
+    :return: rel_error: array [len(rms_range)+1, realizations] of relative contrast differences, first row is the
+             unaberrated case
+    """
+
+    filename = os.path.join(resultdir, f'pupil_resolution_calibration_{design}_{pupil_px}px.txt')
+    if os.path.isfile(filename):
+        calibration = np.loadtxt(filename)
+        rel_error = calibration[:, 3].reshape(-1, realizations)
+        log.info(f'Read pupil resolution calibration from {filename}, max relative error {np.max(rel_error)}')
+        return rel_error
+
+    nb_seg = CONFIG_INI.getint('LUVOIR', 'nb_subapertures')
+    optics_input = CONFIG_INI.get('LUVOIR', 'optics_path')
+    sampling = CONFIG_INI.getfloat('numerical', 'sampling')
+    luvoir_reduced = get_luvoir_aplc(optics_input, design, sampling, pupil_px=pupil_px)
+    luvoir_full = get_luvoir_aplc(optics_input, design, sampling, pupil_px=luvoir_reduced.apod_dict[design]['pxsize'])
+
+    # Random piston maps with global piston removed, segment coefficients in meters of surface
+    rms_values = np.concatenate(([0.], rms_range.to(u.nm).value))
+    coefs = np.zeros([len(rms_values), realizations, nb_seg, 3])
+    for i, rms in enumerate(rms_values[1:]):
+        for j in range(realizations):
+            aber = np.random.random([nb_seg])
+            aber -= np.mean(aber)
+            aber *= rms * 1e-9 / util.rms(aber)
+            coefs[i+1, j, :, 0] = aber / 2
+    coefs = coefs.reshape(-1, nb_seg, 3)
+
+    contrast_full = luvoir_full.calc_psf_batch(coefs)
+    contrast_reduced = luvoir_reduced.calc_psf_batch(coefs)
+    rel_error = np.abs(contrast_reduced - contrast_full) / contrast_full
+
+    os.makedirs(resultdir, exist_ok=True)
+    np.savetxt(filename, np.transpose([np.repeat(rms_values, realizations), contrast_full, contrast_reduced, rel_error]),
+               header=f'LUVOIR {design}, pupil resolution {pupil_px} px against {luvoir_full.pupil_px} px\n'
+                      f'WFE rms (nm), contrast full resolution, contrast reduced resolution, relative difference')
+
+    rel_error = rel_error.reshape(len(rms_values), realizations)
+    for rms, errors in zip(rms_values, rel_error):
+        log.info(f'{rms} nm rms: max relative error at {pupil_px} px {np.max(errors)}')
+
+    return rel_error
+
+
+def benchmark_pupil_crop_luvoir(design, nb_states=32, rms=1*u.nm):
+    """
+    Benchmark the LUVOIR propagation on the bounding box of the illuminated pupil pixels against the full pupil array.
+
+    The same random piston maps are propagated with LuvoirAPLC.calc_psf() and LuvoirAPLC.calc_psf_batch(), once on
+    the full pupil array and once on the illuminated pupil region only, and the runtimes and largest relative
+    differences of the PSFs and dark hole contrasts are reported.
+    :param design: str, "small", "medium" or "large" LUVOIR-A APLC design
+    :param nb_states: int, number of random piston maps
+    :param rms: astropy quantity, WFE rms (OPD) of the piston maps
+    :return: dict with the runtimes in seconds per PSF, per full and cropped pupil, and the relative differences
+    """
+
+    nb_seg = CONFIG_INI.getint('LUVOIR', 'nb_subapertures')
+    optics_input = CONFIG_INI.get('LUVOIR', 'optics_path')
+    sampling = CONFIG_INI.getfloat('numerical', 'sampling')
+    luvoir = get_luvoir_aplc(optics_input, design, sampling)
+
+    # Random piston maps with global piston removed, segment coefficients in meters of surface
+    coefs = np.zeros([nb_states, nb_seg, 3])
+    for i in range(nb_states):
+        aber = np.random.random([nb_seg])
+        aber -= np.mean(aber)
+        coefs[i, :, 0] = aber * rms.to(u.m).value / util.rms(aber) / 2
+
+    rows, cols = luvoir._illuminated_box
+    log.info(f'Pupil array {luvoir.aper.grid.shape}, illuminated region {rows.stop - rows.start} x {cols.stop - cols.start}')
+
+    results = {}
+    for crop in (False, True):
+        luvoir.crop_pupil = crop
+
+        # Set up the MFT matrices outside of the timing
+        luvoir.set_coef(coefs[0])
+        psf = luvoir.calc_psf()
+        luvoir.calc_psf_batch(coefs[:1])
+
+        start = time.time()
+        for coef in coefs:
+            luvoir.set_coef(coef)
+            luvoir.calc_psf()
+        time_single = (time.time() - start) / nb_states
+
+        start = time.time()
+        contrasts = luvoir.calc_psf_batch(coefs)
+        time_batch = (time.time() - start) / nb_states
+
+        results[crop] = {'psf': psf, 'contrasts': contrasts, 'time_single': time_single, 'time_batch': time_batch}
+
+    psf_error = np.max(np.abs(results[True]['psf'] - results[False]['psf'])) / np.max(results[False]['psf'])
+    contrast_error = np.max(np.abs(results[True]['contrasts'] - results[False]['contrasts']) / results[False]['contrasts'])
+
+    log.info(f"calc_psf(): {results[False]['time_single']} sec full pupil, {results[True]['time_single']} sec cropped")
+    log.info(f"calc_psf_batch(): {results[False]['time_batch']} sec full pupil, {results[True]['time_batch']} sec cropped")
+    log.info(f'Max relative PSF difference: {psf_error}, max relative contrast difference: {contrast_error}')
+
+    return {'time_single_full': results[False]['time_single'], 'time_single_cropped': results[True]['time_single'],
+            'time_batch_full': results[False]['time_batch'], 'time_batch_cropped': results[True]['time_batch'],
+            'psf_error': psf_error, 'contrast_error': contrast_error}
+
+
 if __name__ == '__main__':
 
     # Test JWST
@@ -0,0 +1,232 @@
+"""
+Content-addressed on-disk cache for simulation results, e.g. E2E PSFs, for propagation matrices and for converted
+optics files.
+
+Entries are numpy arrays stored as .npy files whose names are a hash of the simulator configuration and of the
+input array (e.g. the segment coefficients), so identical states computed by different scripts or processes share
+the same entry. The total size of a cache directory is bounded, the least recently used entries are evicted first.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import numpy as np
+from astropy.io import fits
+
+from config import CONFIG_INI
+
+log = logging.getLogger()
+
+
+def hash_key(config, array=None):
+    """
+    Create a content hash from a simulator configuration and an optional input array.
+    :param config: dict, JSON-serializable simulator configuration
+    :param array: array or None, input state of the simulator, e.g. segment coefficients
+    :return: str, hex digest
+    """
+    sha = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode())
+    if array is not None:
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        sha.update(str(array.shape).encode())
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+
+
+class DiskCache:
+    """
+    Size-bounded least-recently-used cache of numpy arrays in a directory.
+
+    Writes are atomic (write to a temporary file, then rename), so several processes can share a cache directory.
+    The access time of an entry is tracked with its file modification time.
+    :param cache_dir: str, directory holding the cache entries
+    :param max_size: int, maximum total size of all entries in bytes
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key, mmap_mode=None):
+        """
+        Read an entry from the cache.
+        :param key: str, key created with hash_key()
+        :param mmap_mode: None or str, memory-map the entry instead of reading it, see numpy.load()
+        :return: array, or None if the key is not in the cache
+        """
+        path = self._path(key)
+        try:
+            data = np.load(path, mmap_mode=mmap_mode)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+        try:
+            os.utime(path)   # mark as recently used
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """
+        Write an entry to the cache and evict the least recently used entries if it grew too large.
+        :param key: str, key created with hash_key()
+        :param data: array to save
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.asarray(data))
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """ Delete the least recently used entries until the cache is smaller than its maximum size. """
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        if total <= self.max_size:
+            return
+
+        for mtime, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:   # another process evicted it already
+                pass
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def clear(self):
+        """ Delete all entries. """
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    os.remove(entry.path)
+
+
+@functools.lru_cache(maxsize=None)
+def get_psf_cache():
+    """
+    Get the PSF cache defined in the configfile.
+    :return: DiskCache, or None if the PSF cache is switched off
+    """
+    if not CONFIG_INI.getboolean('cache', 'psf_cache', fallback=False):
+        return None
+
+    cache_dir = CONFIG_INI.get('cache', 'psf_cache_dir')
+    max_size = int(CONFIG_INI.getfloat('cache', 'psf_cache_size_mb') * 1024**2)
+    log.info(f'Using PSF cache in {cache_dir}')
+    return DiskCache(cache_dir, max_size)
+
+
+@functools.lru_cache(maxsize=None)
+def get_mft_cache():
+    """
+    Get the cache of matrix Fourier transform matrices defined in the configfile.
+    :return: DiskCache, or None if the MFT cache is switched off
+    """
+    if not CONFIG_INI.getboolean('cache', 'mft_cache', fallback=False):
+        return None
+
+    cache_dir = CONFIG_INI.get('cache', 'mft_cache_dir')
+    max_size = int(CONFIG_INI.getfloat('cache', 'mft_cache_size_mb') * 1024**2)
+    return DiskCache(cache_dir, max_size)
+
+
+@functools.lru_cache(maxsize=None)
+def get_optics_cache():
+    """
+    Get the cache of converted optics files (e.g. the LUVOIR delivery) defined in the configfile.
+    :return: DiskCache, or None if the optics cache is switched off
+    """
+    if not CONFIG_INI.getboolean('cache', 'optics_cache', fallback=False):
+        return None
+
+    cache_dir = CONFIG_INI.get('cache', 'optics_cache_dir')
+    max_size = int(CONFIG_INI.getfloat('cache', 'optics_cache_size_mb') * 1024**2)
+    return DiskCache(cache_dir, max_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _file_checksum(path, size, mtime):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_checksum(path):
+    """
+    Checksum of the content of a file, computed only once per process while its size and modification time stay the same.
+    :param path: str, path to the file
+    :return: str, hex digest
+    """
+    stat = os.stat(path)
+    return _file_checksum(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def _optics_cache_lookup(optics_cache, key, create):
+    """ Read an entry of the optics cache memory-mapped, converting and writing it with create() on the first call. """
+    data = optics_cache.get(key, mmap_mode='r')
+    if data is None:
+        data = create()
+        optics_cache.put(key, data)
+        cached = optics_cache.get(key, mmap_mode='r')
+        if cached is not None:   # it could have been evicted right away if the cache is too small
+            data = cached
+    return data
+
+
+def read_fits_asset(path):
+    """
+    Read the data of an optics FITS file through the optics cache.
+
+    The first read converts the data into a .npy file keyed on the checksum of the content of the FITS file (see
+    file_checksum()), all later reads memory-map it read-only, so the pixels are only loaded when they are used.
+    Identical files at different paths share the entry.
+    :param path: str, path to the FITS file
+    :return: array, read-only memory map if the optics cache is switched on
+    """
+    optics_cache = get_optics_cache()
+    if optics_cache is None:
+        return fits.getdata(path)
+
+    def convert():
+        data = fits.getdata(path)
+        return data.astype(data.dtype.newbyteorder('='))   # FITS data is big-endian
+
+    key = hash_key({'kind': 'fits_data', 'checksum': file_checksum(path)})
+    return _optics_cache_lookup(optics_cache, key, convert)
+
+
+def read_segment_positions(path, nseg):
+    """
+    Read the segment positions from the SEG<i>_X and SEG<i>_Y keywords in the header of an indexed aperture FITS file,
+    through the optics cache.
+    :param path: str, path to the FITS file
+    :param nseg: int, number of segments
+    :return: array [2, nseg], x and y positions of the segment centers
+    """
+    def convert():
+        hdr = fits.getheader(path)
+        return np.array([[hdr[f'SEG{i + 1}_X'] for i in range(nseg)],
+                         [hdr[f'SEG{i + 1}_Y'] for i in range(nseg)]], dtype=float)
+
+    optics_cache = get_optics_cache()
+    if optics_cache is None:
+        return convert()
+
+    key = hash_key({'kind': 'segment_positions', 'checksum': file_checksum(path), 'nseg': nseg})
+    return _optics_cache_lookup(optics_cache, key, convert)
@@ -2,14 +2,34 @@
 This is a module containing functions and classes for imaging propagation with HCIPy, for now LUVOIR A.
 """
 import os
+import functools
+import logging
+import math
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
-from astropy.io import fits
 import hcipy as hc
 from hcipy.optics.segmented_mirror import SegmentedMirror
 
 from config import CONFIG_INI
+import disk_cache
+import util_pastis as util
+
+log = logging.getLogger()
+
+# Local segment modes of the segmented mirror, in the order of its coefficients
+LOCAL_MODES = ('piston', 'tip', 'tilt')
+
+# APLC designs of the LUVOIR-A delivery from May 2019: pupil size in px, FPM radius (lambda/D) and size (px), IWA and OWA
+# (lambda/D) and apodizer file
+APOD_DESIGNS = {'small': {'pxsize': 1000, 'fpm_rad': 3.5, 'fpm_px': 150, 'iwa': 3.4, 'owa': 12.,
+                          'fname': '0_LUVOIR_N1000_FPM350M0150_IWA0340_OWA01200_C10_BW10_Nlam5_LS_IDD0120_OD0982_no_ls_struts.fits'},
+                'medium': {'pxsize': 1000, 'fpm_rad': 6.82, 'fpm_px': 250, 'iwa': 6.72, 'owa': 23.72,
+                           'fname': '0_LUVOIR_N1000_FPM682M0250_IWA0672_OWA02372_C10_BW10_Nlam5_LS_IDD0120_OD0982_no_ls_struts.fits'},
+                'large': {'pxsize': 1000, 'fpm_rad': 13.38, 'fpm_px': 400, 'iwa': 13.28, 'owa': 46.88,
+                          'fname': '0_LUVOIR_N1000_FPM1338M0400_IWA1328_OWA04688_C10_BW10_Nlam5_LS_IDD0120_OD0982_no_ls_struts.fits'}}
 
 
 class SegmentedTelescopeAPLC:
@@ -33,7 +53,8 @@ class SegmentedTelescopeAPLC:
     focal_grid :
         Focal plane grid to put final image on
     params : dict
-        wavelength, diameter, image size in lambda/D, FPM radius
+        wavelength, diameter, image size in lambda/D, FPM radius, optionally the list of wavelengths of a broadband
+        calculation
     """
 
     def __init__(self, aper, indexed_aperture, seg_pos, apod, lyotst, fpm, focal_grid, params):
@@ -47,11 +68,45 @@ class SegmentedTelescopeAPLC:
         self.imlamD = params['imlamD']
         self.fpm_rad = params['fpm_rad']
         self.lamDrad = self.wvln / self.diam
-        self.coro = hc.LyotCoronagraph(indexed_aperture.grid, fpm, lyotst)
-        self.prop = hc.FraunhoferPropagator(indexed_aperture.grid, focal_grid)
-        self.coro_no_ls = hc.LyotCoronagraph(indexed_aperture.grid, fpm)
+        self._propagators = {}     # coro, coro_no_ls and prop, built on first use
         self.wf_aper = hc.Wavefront(aper, wavelength=self.wvln)
         self.focal_det = focal_grid
+        self.cache_config = None   # dict identifying the optical configuration, switches on the PSF cache if set
+        self._dh_mfts = {}         # dark hole MFT matrices, per dark hole mask and precision
+        self._fpm_mfts = {}        # FPM MFT matrices, per precision
+        # Opt-in single precision: the E-field of the flat mirror is propagated in double precision, only the change
+        # of the E-field from the segment aberrations is propagated with complex64 fields and float32 masks
+        self.single_precision = CONFIG_INI.getboolean('numerical', 'single_precision', fallback=False)
+        self._flat_efields = {}    # double precision E-fields of the flat mirror, per focal plane mask and wavelength
+        self._ref_peaks = {}       # peak of the reference PSF per wavelength, for normalization to contrast
+        self.wavelengths = params.get('wavelengths', [self.wvln])   # propagated in calc_psf_batch()
+        self.indexed_aperture = indexed_aperture
+        self.seg_pos = seg_pos
+        self._segment_bases = {}   # dark hole E-fields of the individual segments, for calc_piston_contrast()
+        self._taylor_bases = {}    # dark hole E-fields of segment monomials, for calc_tiptilt_contrast()
+        self.taylor_errors = None  # truncation error bounds and validation of the last calc_tiptilt_contrast()
+        # Circumradius of a hexagonal segment, from the area of segment 1 in the indexed aperture
+        seg_area = np.count_nonzero(np.asarray(indexed_aperture) == 1) * np.prod(indexed_aperture.grid.delta)
+        self.seg_circumradius = np.sqrt(2 * seg_area / (3 * np.sqrt(3)))
+
+        # Compiled optical train: planes that do not depend on the segment state are built only once
+        self.fpm_plot = 1 - hc.circular_aperture(2 * self.fpm_rad * self.lamDrad)(self.focal_det)   # fake FPM for plotting
+        self.apod_prop = hc.Apodizer(self.apodizer)
+        self.aper_apod = self.aper * self.apodizer   # fused pupil multiplier
+        self.wf_ref_pup = hc.Wavefront(self.aper_apod * self.lyotstop, wavelength=self.wvln)
+        self._full_image_mask = np.ones(self.focal_det.size, dtype=bool)
+        self._work_buffers = {}    # preallocated arrays of _calc_psf_compiled(), per precision
+        # Threads that share each matrix product of _calc_psf_compiled(), 0 uses all cores
+        self.mft_threads = CONFIG_INI.getint('numerical', 'mft_threads', fallback=1)
+        self._mft_executor = None
+        self._mft_executor_threads = None
+        self._mft_executor_finalizer = None
+        # Bounding box of the illuminated pupil pixels, all pupil plane MFTs skip the rows and columns outside of it;
+        # a box rather than a pixel list keeps the MFTs separable, see _support_slices()
+        self.crop_pupil = CONFIG_INI.getboolean('numerical', 'crop_pupil', fallback=True)
+        illuminated = (np.asarray(self.aper_apod) != 0) | (np.asarray(self.lyotstop) != 0)
+        self._illuminated_box = _support_slices(illuminated.reshape(self.aper.grid.shape))
+        self._psf_ref = None       # reference PSF without FPM
 
     def calc_psf(self, ref=False, display_intermediate=False,  return_intermediate=None):
         """Calculate the PSF of the segmented telescope, normalized to contrast units.
@@ -82,26 +137,31 @@ class SegmentedTelescopeAPLC:
             Intermediate plane E-fields; except intensity in focal plane after FPM.
         """
 
-        # Create fake FPM for plotting
-        fpm_plot = 1 - hc.circular_aperture(2 * self.fpm_rad * self.lamDrad)(self.focal_det)
+        # Plain PSFs go through the compiled optical train, and are read from the PSF cache if the same segment
+        # state was calculated before
+        if not display_intermediate and return_intermediate is None:
+            psf_cache = disk_cache.get_psf_cache() if self.cache_config is not None else None
+            if psf_cache is not None:
+                return self._calc_psf_cached(psf_cache, ref)
 
-        # Create apodozer as hc.Apodizer() object to be able to propagate through it
-        apod_prop = hc.Apodizer(self.apodizer)
+            psf_coro = self._calc_psf_compiled()
+            if ref:
+                return psf_coro, self._get_psf_ref()
+            return psf_coro
 
         # Calculate all wavefronts of the full propagation
         wf_sm = self.sm(self.wf_aper)
-        wf_apod = apod_prop(wf_sm)
+        wf_apod = self.apod_prop(wf_sm)
         wf_lyot = self.coro(wf_apod)
         wf_im_coro = self.prop(wf_lyot)
 
         # Wavefronts in extra planes
         wf_before_fpm = self.prop(wf_apod)
-        int_after_fpm = np.log10(wf_before_fpm.intensity / wf_before_fpm.intensity.max()) * fpm_plot  # this is the intensity straight
+        int_after_fpm = np.log10(wf_before_fpm.intensity / wf_before_fpm.intensity.max()) * self.fpm_plot  # this is the intensity straight
         wf_before_lyot = self.coro_no_ls(wf_apod)
 
         # Wavefronts of the reference propagation
-        wf_ref_pup = hc.Wavefront(self.aper * self.apodizer * self.lyotstop, wavelength=self.wvln)
-        wf_im_ref = self.prop(wf_ref_pup)
+        wf_im_ref = self.prop(self.wf_ref_pup)
 
         # Display intermediate planes
         if display_intermediate:
@@ -175,6 +235,918 @@ class SegmentedTelescopeAPLC:
 
         return wf_im_coro.intensity
 
+    def _calc_psf_cached(self, psf_cache, ref=False):
+        """Calculate the coronagraphic (and reference) PSF through the PSF cache, propagating only on a cache miss.
+
+        Parameters:
+        ----------
+        psf_cache : DiskCache
+            Cache to read the PSFs from and write them to.
+        ref : bool
+            Keyword for additionally returning the refrence PSF without the FPM.
+        """
+        key_coro = disk_cache.hash_key(self._psf_cache_config('coro'), self.sm.coef)
+        psf_coro = psf_cache.get(key_coro)
+        if psf_coro is None:
+            psf_coro = self._calc_psf_compiled()
+            psf_cache.put(key_coro, psf_coro)
+        psf_coro = hc.Field(psf_coro, self.focal_det)
+
+        if not ref:
+            return psf_coro
+
+        return psf_coro, self._get_psf_ref()
+
+    def _psf_cache_config(self, plane, **extra):
+        """Configuration that identifies a result of this simulator in the PSF cache.
+
+        On top of the optical configuration in self.cache_config, this holds the numerical settings that change the
+        result: the precision and the propagated pupil region.
+
+        Parameters:
+        ----------
+        plane : str
+            Name of the cached result, e.g. 'coro' for the coronagraphic PSF.
+        extra :
+            Further settings the result depends on, e.g. the wavelengths of a broadband result.
+        """
+        return dict(self.cache_config, plane=plane, single_precision=self.single_precision,
+                    crop_pupil=self.crop_pupil, **extra)
+
+    def _get_work_buffers(self):
+        """Create (or get the previously created) work arrays of _calc_psf_compiled() in the current precision.
+
+        Returns:
+        --------
+        dict with the complex arrays of all planes and intermediate products, and the real multipliers of the pupil,
+        FPM and Lyot planes.
+        """
+        dtype = self._complex_dtype
+        key = (dtype, self._support_key)
+        if key not in self._work_buffers:
+            real_dtype = np.float32 if self.single_precision else np.float64
+            ny, nx = self._pupil_crop(self.aper).shape
+            nfy, nfx = self.fpm.grid.shape
+            niy, nix = self.focal_det.shape
+
+            self._work_buffers[key] = {'pupil': np.empty((ny, nx), dtype=dtype),
+                                       'fpm_rows': np.empty((nfy, nx), dtype=dtype),
+                                       'fpm': np.empty((nfy, nfx), dtype=dtype),
+                                       'lyot_rows': np.empty((ny, nfx), dtype=dtype),
+                                       'lyot': np.empty((ny, nx), dtype=dtype),
+                                       'image_rows': np.empty((niy, nx), dtype=dtype),
+                                       'image': np.empty((niy, nix), dtype=dtype),
+                                       'aper_apod': self._pupil_crop(self.aper_apod).astype(real_dtype),
+                                       'fpm_spot': (1 - np.asarray(self.fpm, dtype=real_dtype)).reshape(nfy, nfx),
+                                       'lyotstop': self._pupil_crop(self.lyotstop).astype(real_dtype)}
+
+        return self._work_buffers[key]
+
+    def _calc_psf_compiled(self):
+        """Calculate the coronagraphic PSF through the compiled optical train.
+
+        Same propagation as calc_psf(), with the Lyot coronagraph done by Babinet's principle like hc.LyotCoronagraph,
+        but all planes are matrix Fourier transforms into preallocated arrays, updated in place. Only the returned
+        image is allocated. In single precision, the propagated field is the change from the flat mirror, which is
+        added to the double precision image E-field of the flat mirror at the end. The work arrays are shared, so this
+        is not thread-safe. With self.mft_threads > 1, each matrix product is split into row blocks that are computed
+        in parallel.
+
+        Returns:
+        --------
+        psf_coro : Field
+            Coronagraphic image, in the same units as calc_psf().
+        """
+        fpm_mft = self._get_fpm_mft()
+        image_mft = self._get_dh_mft(self._full_image_mask)
+        buf = self._get_work_buffers()
+        pupil = buf['pupil']
+
+        # Apodized pupil E-field, the surface is seen twice in reflection. In single precision only its change from
+        # the flat mirror, aper_apod * (exp(i * phi) - 1), is propagated.
+        np.multiply(self._pupil_crop(self.sm.surface), 2j * 2 * np.pi / self.wvln, out=pupil)
+        if self.single_precision:
+            np.expm1(pupil, out=pupil)
+        else:
+            np.exp(pupil, out=pupil)
+        pupil *= buf['aper_apod']
+
+        # Lyot coronagraph
+        self._dot(fpm_mft['mft_y'], pupil, buf['fpm_rows'])
+        self._dot(buf['fpm_rows'], fpm_mft['mft_x'], buf['fpm'])
+        buf['fpm'] *= buf['fpm_spot']
+        self._dot(fpm_mft['imft_y'], buf['fpm'], buf['lyot_rows'])
+        self._dot(buf['lyot_rows'], fpm_mft['imft_x'], buf['lyot'])
+        buf['lyot'] *= -fpm_mft['norm']
+        buf['lyot'] += pupil
+        buf['lyot'] *= buf['lyotstop']
+
+        # Final focal plane
+        self._dot(image_mft['mft_y'], buf['lyot'], buf['image_rows'])
+        self._dot(buf['image_rows'], image_mft['mft_x'], buf['image'])
+        if self.single_precision:
+            efield_flat = self._get_flat_efield(self._full_image_mask, self.wvln).reshape(buf['image'].shape)
+            efield = efield_flat + buf['image'] * image_mft['norm']
+            psf_coro = np.abs(efield)**2
+        else:
+            psf_coro = np.abs(buf['image'])**2 * image_mft['norm']**2
+
+        return hc.Field(psf_coro.ravel(), self.focal_det)
+
+    def _dot(self, a, b, out):
+        """Matrix product a.dot(b) into out, split into row blocks over a thread pool if self.mft_threads > 1.
+
+        Parameters:
+        ----------
+        a : array
+            Left matrix [n, k].
+        b : array
+            Right matrix [k, m].
+        out : array
+            C-contiguous output array [n, m] of the result dtype.
+        """
+        nthreads = self.mft_threads if self.mft_threads > 0 else os.cpu_count()
+        if nthreads <= 1 or a.shape[0] < 2 * nthreads:
+            np.dot(a, b, out=out)
+            return
+
+        if self._mft_executor_threads != nthreads:
+            self.close()
+            self._mft_executor = ThreadPoolExecutor(max_workers=nthreads)
+            self._mft_executor_threads = nthreads
+            # Shut the threads down when the simulator is garbage collected or at exit, if close() is not called
+            self._mft_executor_finalizer = weakref.finalize(self, self._mft_executor.shutdown, wait=False)
+
+        # Row blocks of the output are contiguous, each thread writes its own block in place
+        bounds = np.linspace(0, a.shape[0], nthreads + 1).astype(int)
+        futures = [self._mft_executor.submit(np.dot, a[start:stop], b, out[start:stop])
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """ Shut down the thread pool of the matrix products, a later calc_psf() starts a new one if needed. """
+        if self._mft_executor is not None:
+            self._mft_executor_finalizer.detach()
+            self._mft_executor.shutdown()
+            self._mft_executor = None
+            self._mft_executor_threads = None
+            self._mft_executor_finalizer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _calc_psf_ref(self, wavelength):
+        """ Reference PSF without FPM at one wavelength, on the full final focal plane, in double precision. """
+        image_mft = self._get_dh_mft(self._full_image_mask, wavelength, dtype=np.complex128)
+        ref_pupil = self._pupil_crop(self.wf_ref_pup.electric_field)
+        efield_ref = image_mft['mft_y'].dot(ref_pupil).dot(image_mft['mft_x']) * image_mft['norm']
+        return hc.Field((np.abs(efield_ref)**2).ravel(), self.focal_det)
+
+    def _get_psf_ref(self):
+        """ Reference PSF without FPM, calculated only once because it does not depend on the segment state. """
+        if self._psf_ref is None:
+            self._psf_ref = self._calc_psf_ref(self.wvln)
+
+        return self._psf_ref
+
+    @property
+    def coro(self):
+        """ Lyot coronagraph from the apodized pupil to the Lyot plane, after the Lyot stop. """
+        if 'coro' not in self._propagators:
+            self._propagators['coro'] = _MftLyotCoronagraph(self, self.lyotstop)
+        return self._propagators['coro']
+
+    @property
+    def coro_no_ls(self):
+        """ Lyot coronagraph from the apodized pupil to the Lyot plane, before the Lyot stop. """
+        if 'coro_no_ls' not in self._propagators:
+            self._propagators['coro_no_ls'] = _MftLyotCoronagraph(self)
+        return self._propagators['coro_no_ls']
+
+    @property
+    def prop(self):
+        """ Fraunhofer propagator from the pupil to the final focal plane. """
+        if 'prop' not in self._propagators:
+            self._propagators['prop'] = _MftFraunhoferPropagator(self)
+        return self._propagators['prop']
+
+    @property
+    def _complex_dtype(self):
+        return np.complex64 if self.single_precision else np.complex128
+
+    @property
+    def _full_support(self):
+        """ Row and column slices of the full pupil array. """
+        ny, nx = self.aper.grid.shape
+        return slice(0, ny), slice(0, nx)
+
+    @property
+    def _pupil_support(self):
+        """ Row and column slices of the pupil region that is propagated, the illuminated pixels if self.crop_pupil. """
+        if self.crop_pupil:
+            return self._illuminated_box
+        return self._full_support
+
+    @property
+    def _support_key(self):
+        return _slices_key(*self._pupil_support)
+
+    def _pupil_crop(self, pupil_array):
+        """Crop pupil plane arrays to the propagated region.
+
+        Parameters:
+        ----------
+        pupil_array : array or Field
+            Flattened pupil plane array(s) [..., npix].
+        Returns:
+        --------
+        View of the array [..., my, mx] on the rows and columns of self._pupil_support.
+        """
+        rows, cols = self._pupil_support
+        pupil_array = np.asarray(pupil_array)
+        return pupil_array.reshape(pupil_array.shape[:-1] + tuple(self.aper.grid.shape))[..., rows, cols]
+
+    def _get_dh_mft(self, dh_mask, wavelength=None, full_pupil=False, dtype=None):
+        """Create (or get the previously created) MFT matrices from the Lyot plane onto the dark hole pixels.
+
+        The MFT only covers the rows and columns of the final focal plane that contain dark hole pixels, the dark hole
+        pixels themselves are picked with flat indices into that sub-array.
+
+        Parameters:
+        ----------
+        dh_mask : Field
+            Dark hole mask on the final focal plane grid.
+        wavelength : float, optional
+            Wavelength in m, default is self.wvln.
+        full_pupil : bool
+            Whether the MFT starts from the full pupil array instead of the propagated region of self._pupil_support.
+        dtype : dtype, optional
+            complex128 or complex64, default is the precision of the simulator.
+        Returns:
+        --------
+        dict with the MFT matrices along y and x, the dark hole pixel indices in the sub-array, and the normalization.
+        """
+        if wavelength is None:
+            wavelength = self.wvln
+        if dtype is None:
+            dtype = self._complex_dtype
+        dh_mask = np.asarray(dh_mask).astype(bool)
+        rows, cols = self._full_support if full_pupil else self._pupil_support
+        key = self._dh_mft_key(dh_mask, wavelength, full_pupil, dtype)
+        if key not in self._dh_mfts:
+            pupil_grid = self.aper.grid
+            x_pup, y_pup = pupil_grid.separated_coords[0][cols], pupil_grid.separated_coords[1][rows]
+            x_foc, y_foc = self.focal_det.separated_coords
+
+            rows, cols = np.nonzero(dh_mask.reshape(self.focal_det.shape))
+            rows_sub, row_idx = np.unique(rows, return_inverse=True)
+            cols_sub, col_idx = np.unique(cols, return_inverse=True)
+
+            # Fraunhofer propagation with the focal plane in angular units; E = w / lambda * sum(E_pup * exp(-ikx))
+            self._dh_mfts[key] = {'mft_y': _mft_matrix(y_foc[rows_sub], y_pup, wavelength, dtype=dtype),
+                                  'mft_x': _mft_matrix(x_pup, x_foc[cols_sub], wavelength, dtype=dtype),
+                                  'dh_idx': row_idx * len(cols_sub) + col_idx,
+                                  'norm': np.prod(pupil_grid.delta) / wavelength}
+
+        return self._dh_mfts[key]
+
+    def _dh_mft_key(self, dh_mask, wavelength, full_pupil=False, dtype=None):
+        """ Key of the MFT matrices of _get_dh_mft() in self._dh_mfts. """
+        if dtype is None:
+            dtype = self._complex_dtype
+        support = self._full_support if full_pupil else self._pupil_support
+        return np.asarray(dh_mask).astype(bool).tobytes(), np.dtype(dtype), wavelength, _slices_key(*support)
+
+    def calc_psf_dh(self, dh_mask=None):
+        """Calculate the coronagraphic PSF on the dark hole pixels only, normalized to contrast units.
+
+        The last propagation is a matrix Fourier transform onto the dark hole pixels instead of the full final focal
+        plane, which makes this cheaper than calc_psf() when only the dark hole is needed. Same propagation as
+        calc_psf_batch(), at the central wavelength.
+
+        Parameters:
+        ----------
+        dh_mask : Field, optional
+            Dark hole mask on the final focal plane grid, default is self.dh_mask.
+        Returns:
+        --------
+        dh_intensity : array
+            Intensity in the dark hole pixels, normalized to contrast units by the max of the reference image, in the
+            order of the dark hole pixels in the flattened focal plane.
+        contrast : float
+            Mean contrast in the dark hole.
+        """
+        if dh_mask is None:
+            dh_mask = self.dh_mask
+
+        surface = self._pupil_crop(self.sm.surface)[np.newaxis]
+        efield_dh = self._calc_dh_efield_batch(surface, self.wvln, dh_mask)[0]
+        dh_intensity = np.abs(efield_dh)**2 / self._get_ref_peak()
+
+        return dh_intensity, np.mean(dh_intensity, dtype=np.float64)
+
+    def _get_fpm_mft(self, wavelength=None, full_pupil=False, dtype=None):
+        """Create (or get the previously created) MFT matrices between the pupil and the focal plane mask.
+
+        Parameters:
+        ----------
+        wavelength : float, optional
+            Wavelength in m, default is self.wvln.
+        full_pupil : bool
+            Whether the MFTs cover the full pupil array instead of the propagated region of self._pupil_support.
+        dtype : dtype, optional
+            complex128 or complex64, default is the precision of the simulator.
+        Returns:
+        --------
+        dict with the forward and backward MFT matrices along y and x, and the normalization of a forward and
+        backward propagation through the FPM plane.
+        """
+        if wavelength is None:
+            wavelength = self.wvln
+        if dtype is None:
+            dtype = self._complex_dtype
+        rows, cols = self._full_support if full_pupil else self._pupil_support
+        key = self._fpm_mft_key(wavelength, full_pupil, dtype)
+        if key not in self._fpm_mfts:
+            pupil_grid = self.aper.grid
+            fpm_grid = self.fpm.grid
+            x_pup, y_pup = pupil_grid.separated_coords[0][cols], pupil_grid.separated_coords[1][rows]
+            x_fpm, y_fpm = fpm_grid.separated_coords
+
+            self._fpm_mfts[key] = {'mft_y': _mft_matrix(y_fpm, y_pup, wavelength, dtype=dtype),
+                                   'mft_x': _mft_matrix(x_pup, x_fpm, wavelength, dtype=dtype),
+                                   'imft_y': _mft_matrix(y_pup, y_fpm, wavelength, sign=1, dtype=dtype),
+                                   'imft_x': _mft_matrix(x_fpm, x_pup, wavelength, sign=1, dtype=dtype),
+                                   'norm': np.prod(pupil_grid.delta) * np.prod(fpm_grid.delta) / wavelength**2}
+
+        return self._fpm_mfts[key]
+
+    def _fpm_mft_key(self, wavelength, full_pupil=False, dtype=None):
+        """ Key of the MFT matrices of _get_fpm_mft() in self._fpm_mfts. """
+        if dtype is None:
+            dtype = self._complex_dtype
+        support = self._full_support if full_pupil else self._pupil_support
+        return np.dtype(dtype), wavelength, _slices_key(*support)
+
+    def _get_ref_peak(self, wavelength=None):
+        """Peak of the reference PSF (without FPM) at one wavelength, which all PSFs and contrasts are normalized by.
+
+        At the central wavelength this is the maximum of the reference PSF of calc_psf(ref=True), so that all
+        propagations share the same normalization.
+
+        Parameters:
+        ----------
+        wavelength : float, optional
+            Wavelength in m, default is self.wvln.
+        """
+        if wavelength is None:
+            wavelength = self.wvln
+        if wavelength not in self._ref_peaks:
+            psf_ref = self._get_psf_ref() if wavelength == self.wvln else self._calc_psf_ref(wavelength)
+            self._ref_peaks[wavelength] = float(np.max(psf_ref))
+
+        return self._ref_peaks[wavelength]
+
+    def _propagate_dh_batch(self, efields, wavelength, dh_mask, dtype=None):
+        """Propagate a stack of E-fields on the segmented mirror through the APLC at one wavelength, onto the dark hole.
+
+        Parameters:
+        ----------
+        efields : array
+            E-fields [nstates, my, mx] of the segmented mirror on the propagated pupil region (see _pupil_crop()),
+            without the aperture, which is applied here together with the apodizer. Overwritten with the apodized
+            fields.
+        wavelength : float
+            Wavelength in m.
+        dh_mask : Field
+            Dark hole mask on the final focal plane grid.
+        dtype : dtype, optional
+            complex128 or complex64 precision of the propagation, default is the precision of the simulator.
+        Returns:
+        --------
+        Dark hole E-fields [nstates, ndh_pixels], not normalized.
+        """
+        if dtype is None:
+            dtype = self._complex_dtype
+        dh_mft = self._get_dh_mft(dh_mask, wavelength, dtype=dtype)
+        fpm_mft = self._get_fpm_mft(wavelength, dtype=dtype)
+        real_dtype = np.float32 if np.dtype(dtype) == np.complex64 else np.float64
+        fpm_spot = (1 - np.asarray(self.fpm, dtype=real_dtype)).reshape(self.fpm.grid.shape)   # Babinet: FPM blocks
+
+        aper_apod = self._pupil_crop(self.aper_apod).astype(real_dtype)
+        lyotstop = self._pupil_crop(self.lyotstop).astype(real_dtype)
+
+        efields *= aper_apod
+
+        # Lyot coronagraph
+        efields_fpm = _batch_mft(efields, fpm_mft['mft_y'], fpm_mft['mft_x']) * fpm_spot
+        efields_lyot = efields - fpm_mft['norm'] * _batch_mft(efields_fpm, fpm_mft['imft_y'], fpm_mft['imft_x'])
+        efields_lyot *= lyotstop
+
+        # Dark hole pixels of the final focal plane
+        efields_dh = _batch_mft(efields_lyot, dh_mft['mft_y'], dh_mft['mft_x'])
+        return efields_dh.reshape(len(efields), -1)[:, dh_mft['dh_idx']] * dh_mft['norm']
+
+    def _get_flat_efield(self, dh_mask, wavelength):
+        """Create (or get the previously created) E-field of the flat segmented mirror on the dark hole pixels.
+
+        Always propagated in double precision, it is the reference the single precision propagations add their
+        E-field change to.
+
+        Parameters:
+        ----------
+        dh_mask : Field
+            Dark hole mask on the final focal plane grid.
+        wavelength : float
+            Wavelength in m.
+        Returns:
+        --------
+        Dark hole E-field [ndh_pixels], not normalized, like the output of _propagate_dh_batch().
+        """
+        dh_mask = np.asarray(dh_mask).astype(bool)
+        key = self._flat_efield_key(dh_mask, wavelength)
+        if key not in self._flat_efields:
+            efield = np.ones((1,) + self._pupil_crop(self.aper).shape, dtype=np.complex128)
+            self._flat_efields[key] = self._propagate_dh_batch(efield, wavelength, dh_mask, dtype=np.complex128)[0]
+
+        return self._flat_efields[key]
+
+    def _flat_efield_key(self, dh_mask, wavelength):
+        """ Key of the E-field of _get_flat_efield() in self._flat_efields. """
+        return np.asarray(dh_mask).astype(bool).tobytes(), wavelength, self._support_key
+
+    def _calc_dh_efield_batch(self, surfaces, wavelength, dh_mask):
+        """Propagate a stack of segmented mirror surfaces through the APLC at one wavelength, onto the dark hole.
+
+        In single precision, only the change of the pupil E-field from the flat mirror, exp(i * phi) - 1, is
+        propagated in single precision, and added to the double precision dark hole E-field of the flat mirror. This
+        keeps the relative error of the E-field change at the float32 level, instead of the one of the full E-field,
+        which would dominate the dark hole contrast after the coronagraph cancels most of it.
+
+        Parameters:
+        ----------
+        surfaces : array
+            Segmented mirror surfaces [nstates, my, mx] in m, on the propagated pupil region (see _pupil_crop()).
+        wavelength : float
+            Wavelength in m.
+        dh_mask : Field
+            Dark hole mask on the final focal plane grid.
+        Returns:
+        --------
+        Dark hole E-fields [nstates, ndh_pixels] in double precision, not normalized.
+        """
+        # The surface is seen twice in reflection
+        phases = (2j * 2 * np.pi / wavelength) * surfaces
+        if not self.single_precision:
+            return self._propagate_dh_batch(np.exp(phases), wavelength, dh_mask)
+
+        efield_changes = np.expm1(phases).astype(np.complex64)
+        return self._get_flat_efield(dh_mask, wavelength) + self._propagate_dh_batch(efield_changes, wavelength,
+                                                                                      dh_mask)
+
+    def _iter_dh_efield_batches(self, coef_array, dh_mask, batch_size, workers):
+        """Propagate segment states in batches onto the dark hole, at all wavelengths in self.wavelengths.
+
+        The segment state of the mirror is restored at the end.
+
+        Parameters:
+        ----------
+        coef_array : array
+            Segment coefficients [nstates, nseg, 3] in the format of set_coef().
+        dh_mask : Field
+            Dark hole mask on the final focal plane grid.
+        batch_size : int
+            Number of segment states propagated together, limits the memory use.
+        workers : int
+            Number of threads that propagate different wavelengths in parallel.
+        Yields:
+        --------
+        start : int
+            Index of the first segment state of the batch.
+        efields_dh : list of arrays
+            Dark hole E-fields [nstates_batch, ndh_pixels] per wavelength, normalized such that the sum of their
+            intensities over the wavelengths is in contrast units.
+        """
+        # Set up the optics of all wavelengths before the threads share them
+        ref_peak = 0
+        for wavelength in self.wavelengths:
+            self._get_dh_mft(dh_mask, wavelength)
+            self._get_fpm_mft(wavelength)
+            ref_peak += self._get_ref_peak(wavelength)
+        norm = 1 / np.sqrt(ref_peak)
+
+        pupil_shape = self._pupil_crop(self.aper).shape
+        coef_prev = np.array(self.sm.coef)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for start in range(0, len(coef_array), batch_size):
+                    coefs = coef_array[start:start + batch_size]
+
+                    # Segmented mirror surfaces of all segment states in this batch
+                    surfaces = np.empty((len(coefs),) + pupil_shape)
+                    for i, coef in enumerate(coefs):
+                        self.set_coef(coef)
+                        surfaces[i] = self._pupil_crop(self.sm.surface)
+
+                    efields_dh = executor.map(lambda wvln: self._calc_dh_efield_batch(surfaces, wvln, dh_mask) * norm,
+                                              self.wavelengths)
+                    yield start, list(efields_dh)
+        finally:
+            self.set_coef(coef_prev)
+
+    def calc_psf_batch(self, coef_array, dh_mask=None, batch_size=16, workers=1):
+        """Calculate the (bandwidth-integrated) dark hole contrast for many segment states at once.
+
+        The pupil E-fields of all segment states in a batch are stacked, so that all matrix Fourier transforms of the
+        coronagraph and onto the dark hole pixels are large matrix-matrix products. The propagation is the same as in
+        calc_psf_dh(), with the Lyot coronagraph done by Babinet's principle like hc.LyotCoronagraph. All wavelengths
+        in self.wavelengths are propagated, with their own cached MFT matrices, and the dark hole intensities and
+        reference peaks are summed over the band. The segment state of the mirror is restored at the end.
+
+        Parameters:
+        ----------
+        coef_array : array
+            Segment coefficients [nstates, nseg, 3] in the format of set_coef().
+        dh_mask : Field, optional
+            Dark hole mask on the final focal plane grid, default is self.dh_mask.
+        batch_size : int
+            Number of segment states propagated together, limits the memory use.
+        workers : int
+            Number of threads that propagate different wavelengths in parallel.
+        Returns:
+        --------
+        contrasts : array
+            Mean dark hole contrast of each segment state.
+        """
+        if dh_mask is None:
+            dh_mask = self.dh_mask
+
+        contrasts = np.zeros(len(coef_array))
+        for start, efields_dh in self._iter_dh_efield_batches(coef_array, dh_mask, batch_size, workers):
+            dh_intensity = sum(np.abs(efield).astype(np.float64)**2 for efield in efields_dh)
+            contrasts[start:start + len(dh_intensity)] = np.mean(dh_intensity, axis=1)
+
+        return contrasts
+
+    def calc_efield_batch(self, coef_array, dh_mask=None, batch_size=16, workers=1):
+        """Calculate the dark hole E-fields for many segment states at once, at all wavelengths in self.wavelengths.
+
+        Same propagation as calc_psf_batch(), the E-fields are normalized such that the mean over the dark hole of
+        their intensities, summed over the wavelengths, is the mean contrast.
+
+        Parameters:
+        ----------
+        coef_array : array
+            Segment coefficients [nstates, nseg, 3] in the format of set_coef().
+        dh_mask : Field, optional
+            Dark hole mask on the final focal plane grid, default is self.dh_mask.
+        batch_size : int
+            Number of segment states propagated together, limits the memory use.
+        workers : int
+            Number of threads that propagate different wavelengths in parallel.
+        Returns:
+        --------
+        efields_dh : array
+            Dark hole E-fields [nwavelengths, nstates, ndh_pixels].
+        """
+        if dh_mask is None:
+            dh_mask = self.dh_mask
+
+        efields = None
+        for start, efields_dh in self._iter_dh_efield_batches(coef_array, dh_mask, batch_size, workers):
+            if efields is None:
+                efields = np.zeros((len(self.wavelengths), len(coef_array), efields_dh[0].shape[1]),
+                                   dtype=efields_dh[0].dtype)
+            efields[:, start:start + efields_dh[0].shape[0]] = efields_dh
+
+        return efields
+
+    def calc_region_contrasts(self, coef_array, regions, batch_size=16, workers=1):
+        """Calculate the (bandwidth-integrated) mean contrast in several focal plane regions for many segment states.
+
+        All segment states are propagated once, onto the union of the regions, and the contrast of each region is the
+        mean over its pixels in there, so extra regions cost almost nothing. Same propagation as calc_psf_batch().
+
+        Parameters:
+        ----------
+        coef_array : array
+            Segment coefficients [nstates, nseg, 3] in the format of set_coef().
+        regions : dict
+            Region name: util.DarkHole or boolean mask on the final focal plane grid, e.g. from
+            LuvoirAPLC.dark_hole_regions().
+        batch_size : int
+            Number of segment states propagated together, limits the memory use.
+        workers : int
+            Number of threads that propagate different wavelengths in parallel.
+        Returns:
+        --------
+        contrasts : dict
+            Region name: mean contrast of each segment state in that region.
+        """
+        union_mask, positions = dark_hole_union(regions)
+        union_mask = hc.Field(union_mask, self.focal_det)
+
+        contrasts = {name: np.zeros(len(coef_array)) for name in regions}
+        for start, efields_dh in self._iter_dh_efield_batches(coef_array, union_mask, batch_size, workers):
+            dh_intensity = sum(np.abs(efield).astype(np.float64)**2 for efield in efields_dh)
+            for name, region_pos in positions.items():
+                contrasts[name][start:start + len(dh_intensity)] = np.mean(dh_intensity[:, region_pos], axis=1)
+
+        return contrasts
+
+    def _get_segment_basis(self, dh_mask):
+        """Create (or get the previously created) dark hole E-fields of the individual segments, at all wavelengths.
+
+        Row 0 is the field of all aperture pixels outside of the segments (index 0 in the indexed aperture), row s is
+        the field of segment s with all other pixels blocked. With the PSF cache switched on, the basis is also
+        cached on disk.
+
+        Parameters:
+        ----------
+        dh_mask : Field
+            Dark hole mask on the final focal plane grid.
+        Returns:
+        --------
+        segment_basis : array
+            Dark hole E-fields [nwavelengths, nseg + 1, ndh_pixels], normalized like in calc_efield_batch().
+        """
+        dh_mask = np.asarray(dh_mask).astype(bool)
+        key = self._segment_basis_key(dh_mask)
+        if key in self._segment_bases:
+            return self._segment_bases[key]
+
+        psf_cache = disk_cache.get_psf_cache() if self.cache_config is not None else None
+        if psf_cache is not None:
+            basis_config = self._psf_cache_config('segment_basis', wavelengths=list(self.wavelengths))
+            cache_key = disk_cache.hash_key(basis_config, dh_mask)
+            segment_basis = psf_cache.get(cache_key)
+            if segment_basis is not None:
+                self._segment_bases[key] = segment_basis
+                return segment_basis
+
+        seg_index = self._pupil_crop(np.rint(np.asarray(self.indexed_aperture)).astype(int))
+        nseg = self.sm.coef.shape[0]
+
+        ref_peak = sum(self._get_ref_peak(wavelength) for wavelength in self.wavelengths)
+        segment_basis = []
+        for wavelength in self.wavelengths:
+            efields_dh = []
+            for start in range(0, nseg + 1, 16):
+                segids = np.arange(start, min(start + 16, nseg + 1))
+                indicators = (seg_index[np.newaxis] == segids[:, np.newaxis, np.newaxis]).astype(self._complex_dtype)
+                efields_dh.append(self._propagate_dh_batch(indicators, wavelength, dh_mask))
+            segment_basis.append(np.concatenate(efields_dh) / np.sqrt(ref_peak))
+        segment_basis = np.array(segment_basis)
+
+        if psf_cache is not None:
+            psf_cache.put(cache_key, segment_basis)
+        self._segment_bases[key] = segment_basis
+        return segment_basis
+
+    def _segment_basis_key(self, dh_mask):
+        """ Key of the basis of _get_segment_basis() in self._segment_bases. """
+        dh_mask = np.asarray(dh_mask).astype(bool)
+        return dh_mask.tobytes(), self._complex_dtype, tuple(self.wavelengths), self._support_key
+
+    def calc_piston_contrast(self, piston_opd, dh_mask=None):
+        """Calculate the exact dark hole contrast of piston-only segment states from the per-segment basis.
+
+        The coronagraph is linear in the pupil E-field, so the dark hole E-field of a piston state is the sum of the
+        per-segment dark hole E-fields times exp(i * phi_s), which is one matrix product per wavelength for all
+        states. This holds for any piston amplitude. Tip and tilt on the segmented mirror are ignored.
+
+        Parameters:
+        ----------
+        piston_opd : array
+            Segment pistons in meters of OPD, [nseg] for one state or [nstates, nseg].
+        dh_mask : Field, optional
+            Dark hole mask on the final focal plane grid, default is self.dh_mask.
+        Returns:
+        --------
+        contrast : float or array
+            Mean dark hole contrast of each state.
+        """
+        if dh_mask is None:
+            dh_mask = self.dh_mask
+        segment_basis = self._get_segment_basis(dh_mask)
+
+        piston_opd = np.asarray(piston_opd)
+        opd = np.atleast_2d(piston_opd)
+        ref_peak = sum(self._get_ref_peak(wavelength) for wavelength in self.wavelengths)
+
+        # Dark hole E-field of the flat mirror (double precision) plus the change from the segment phasors, row 0 of
+        # the basis is outside of the segments and does not change
+        dh_intensity = 0
+        for wavelength, basis in zip(self.wavelengths, segment_basis):
+            phasor_changes = np.expm1(1j * 2 * np.pi / wavelength * opd).astype(basis.dtype)
+            efields_dh = self._get_flat_efield(dh_mask, wavelength) / np.sqrt(ref_peak) + phasor_changes.dot(basis[1:])
+            dh_intensity = dh_intensity + np.abs(efields_dh)**2
+
+        contrast = np.mean(dh_intensity, axis=1)
+        return contrast[0] if piston_opd.ndim == 1 else contrast
+
+    @staticmethod
+    def _taylor_monomials(order):
+        """ Exponents (m, q) of the monomials x^m * y^q of the Taylor expansion of a segment tip/tilt to an order. """
+        return [(m, n - m) for n in range(order + 1) for m in range(n, -1, -1)]
+
+    def _get_segment_taylor_basis(self, dh_mask, order):
+        """Create (or get the previously created) dark hole E-fields of the segment monomials, at all wavelengths.
+
+        Entry [s, j] is the dark hole field of segment s with all other pixels blocked, multiplied by the monomial
+        (x/R)^m * (y/R)^q in local segment coordinates, with R the segment circumradius and (m, q) the j-th entry of
+        _taylor_monomials(order). The first monomial is the piston basis of _get_segment_basis(). With the PSF cache
+        switched on, the basis is also cached on disk.
+
+        Parameters:
+        ----------
+        dh_mask : Field
+            Dark hole mask on the final focal plane grid.
+        order : int
+            Order of the Taylor expansion.
+        Returns:
+        --------
+        taylor_basis : array
+            Dark hole E-fields [nwavelengths, nseg + 1, nmonomials, ndh_pixels], normalized like in
+            calc_efield_batch().
+        """
+        dh_mask = np.asarray(dh_mask).astype(bool)
+        key = (dh_mask.tobytes(), self._complex_dtype, tuple(self.wavelengths), self._support_key, order)
+        if key in self._taylor_bases:
+            return self._taylor_bases[key]
+
+        psf_cache = disk_cache.get_psf_cache() if self.cache_config is not None else None
+        if psf_cache is not None:
+            basis_config = self._psf_cache_config('segment_taylor_basis', wavelengths=list(self.wavelengths),
+                                                  order=order)
+            cache_key = disk_cache.hash_key(basis_config, dh_mask)
+            taylor_basis = psf_cache.get(cache_key)
+            if taylor_basis is not None:
+                self._taylor_bases[key] = taylor_basis
+                return taylor_basis
+
+        segment_basis = self._get_segment_basis(dh_mask)
+        monomials = self._taylor_monomials(order)
+
+        # Local segment coordinates in units of the segment circumradius
+        seg_index = np.rint(np.asarray(self.indexed_aperture)).astype(int).ravel()
+        on_seg = seg_index > 0
+        local_x = np.zeros(seg_index.shape)
+        local_y = np.zeros(seg_index.shape)
+        local_x[on_seg] = self.aper.grid.x[on_seg] - self.seg_pos.x[seg_index[on_seg] - 1]
+        local_y[on_seg] = self.aper.grid.y[on_seg] - self.seg_pos.y[seg_index[on_seg] - 1]
+        local_x = self._pupil_crop(local_x / self.seg_circumradius)
+        local_y = self._pupil_crop(local_y / self.seg_circumradius)
+        seg_index = self._pupil_crop(seg_index)
+
+        nseg = self.sm.coef.shape[0]
+        ref_peak = sum(self._get_ref_peak(wavelength) for wavelength in self.wavelengths)
+        taylor_basis = np.zeros((len(self.wavelengths), nseg + 1, len(monomials), segment_basis.shape[-1]),
+                                dtype=segment_basis.dtype)
+        taylor_basis[:, :, 0] = segment_basis
+
+        # Monomials of order > 0, the pixels outside of the segments (row 0) do not tip or tilt
+        terms = [(segid, j) for segid in range(1, nseg + 1) for j in range(1, len(monomials))]
+        for w, wavelength in enumerate(self.wavelengths):
+            for start in range(0, len(terms), 16):
+                batch = terms[start:start + 16]
+                efields = np.empty((len(batch),) + seg_index.shape, dtype=self._complex_dtype)
+                for i, (segid, j) in enumerate(batch):
+                    m, q = monomials[j]
+                    efields[i] = (seg_index == segid) * local_x**m * local_y**q
+                efields_dh = self._propagate_dh_batch(efields, wavelength, dh_mask) / np.sqrt(ref_peak)
+                for (segid, j), efield_dh in zip(batch, efields_dh):
+                    taylor_basis[w, segid, j] = efield_dh
+
+        if psf_cache is not None:
+            psf_cache.put(cache_key, taylor_basis)
+        self._taylor_bases[key] = taylor_basis
+        return taylor_basis
+
+    def calc_tiptilt_contrast(self, coef_array, dh_mask=None, order=3, tolerance=1e-3, validate=0):
+        """Calculate the dark hole contrast of piston, tip and tilt segment states from a Taylor-expanded segment basis.
+
+        The phase of a tipped and tilted segment is expanded into monomials of the local segment coordinates,
+        exp(i*k*(a*x + b*y)) ~ sum over m + q <= order of (i*k*a*x)^m * (i*k*b*y)^q / (m! * q!), so the dark hole
+        E-field of a state is a linear combination of the precomputed dark hole fields of the (segment, monomial)
+        pairs, one matrix product per wavelength for all states. The truncation error of the pupil E-field of a
+        segment is at most theta^(order+1) / (order+1)!, with theta the largest phase across the segment from its tip
+        and tilt at the shortest wavelength. States where this bound exceeds tolerance are propagated directly with
+        calc_psf_batch() instead. The bound of every state, and the error measured on the validated states, are kept
+        in self.taylor_errors after each call.
+
+        Parameters:
+        ----------
+        coef_array : array
+            Segment coefficients [nseg, 3] for one state or [nstates, nseg, 3], in the format of set_coef().
+        dh_mask : Field, optional
+            Dark hole mask on the final focal plane grid, default is self.dh_mask.
+        order : int
+            Order of the Taylor expansion.
+        tolerance : float
+            Largest accepted truncation error bound of the pupil E-field.
+        validate : int
+            Number of randomly chosen expanded states that are also propagated directly, to measure the error of the
+            expansion on the contrast.
+        Returns:
+        --------
+        contrast : float or array
+            Mean dark hole contrast of each state, a float for a single state.
+
+        self.taylor_errors is set to a dict with:
+        error_bound : array
+            Truncation error bound of the pupil E-field of each state, also of the states propagated directly.
+        expanded : array
+            Whether each state was calculated from the Taylor expansion.
+        rel_error : float or None
+            Largest relative contrast difference between the expansion and the direct propagation of the validated
+            states, None if no state was validated.
+        """
+        if dh_mask is None:
+            dh_mask = self.dh_mask
+
+        coef_array = np.asarray(coef_array)
+        coefs = coef_array.reshape((-1,) + coef_array.shape[-2:])
+        monomials = self._taylor_monomials(order)
+
+        # Largest phase across each segment from tip and tilt, |(x, y)| <= R on a hexagon with circumradius R
+        k_max = 2 * 2 * np.pi / min(self.wavelengths)   # the surface is seen twice in reflection
+        theta = k_max * self.seg_circumradius * np.hypot(coefs[:, :, 1], coefs[:, :, 2])
+        error_bound = np.max(theta, axis=1)**(order + 1) / math.factorial(order + 1)
+        expanded = error_bound <= tolerance
+
+        contrast = np.zeros(len(coefs))
+        if np.any(expanded):
+            taylor_basis = self._get_segment_taylor_basis(dh_mask, order)
+            coefs_exp = coefs[expanded]
+
+            # Weights of the (segment, monomial) fields of each state, as change from the flat mirror whose dark hole
+            # E-field is added in double precision; the part outside the segments (row 0 of the basis) does not change
+            ref_peak = sum(self._get_ref_peak(wavelength) for wavelength in self.wavelengths)
+            weights = np.zeros((len(coefs_exp), coefs_exp.shape[1], len(monomials)), dtype=taylor_basis.dtype)
+            dh_intensity = 0
+            for wavelength, basis in zip(self.wavelengths, taylor_basis):
+                k = 2 * 2 * np.pi / wavelength
+                phase_x = 1j * k * self.seg_circumradius * coefs_exp[:, :, 1]
+                phase_y = 1j * k * self.seg_circumradius * coefs_exp[:, :, 2]
+                piston = np.exp(1j * k * coefs_exp[:, :, 0])
+                for j, (m, q) in enumerate(monomials):
+                    weights[:, :, j] = piston * phase_x**m * phase_y**q / (math.factorial(m) * math.factorial(q))
+                weights[:, :, 0] = np.expm1(1j * k * coefs_exp[:, :, 0])
+                efields_dh = weights.reshape(len(coefs_exp), -1).dot(basis[1:].reshape(-1, basis.shape[-1]))
+                efields_dh = self._get_flat_efield(dh_mask, wavelength) / np.sqrt(ref_peak) + efields_dh
+                dh_intensity = dh_intensity + np.abs(efields_dh)**2
+            contrast[expanded] = np.mean(dh_intensity, axis=1)
+
+        if not np.all(expanded):
+            log.info(f'{np.count_nonzero(~expanded)} states beyond the accurate range of the Taylor expansion, '
+                     f'propagating them directly')
+            contrast[~expanded] = self.calc_psf_batch(coefs[~expanded], dh_mask)
+
+        # Measure the error of the expansion on some states against the direct propagation
+        rel_error = None
+        expanded_states = np.flatnonzero(expanded)
+        if validate > 0 and len(expanded_states) > 0:
+            check = np.random.choice(expanded_states, size=min(validate, len(expanded_states)), replace=False)
+            contrast_direct = self.calc_psf_batch(coefs[check], dh_mask)
+            rel_error = float(np.max(np.abs(contrast[check] - contrast_direct) / contrast_direct))
+            log.info(f'Largest relative contrast error of the Taylor expansion of order {order}: {rel_error}')
+        self.taylor_errors = {'error_bound': error_bound, 'expanded': expanded, 'rel_error': rel_error}
+
+        return contrast[0] if coef_array.ndim == 2 else contrast
+
+    def modal_aber_to_coef(self, aber, modes=('piston',)):
+        """Convert local segment aberrations in meters rms OPD into segmented mirror coefficients.
+
+        Piston is half the OPD on the surface, tip and tilt are the surface slopes that give the requested rms OPD
+        over a hexagonal segment.
+
+        Parameters:
+        ----------
+        aber : array
+            Aberrations [nmodes * nseg] in m rms OPD, ordered by mode first, then by segment.
+        modes : tuple of str
+            Local modes of aber, out of 'piston', 'tip' and 'tilt'.
+        Returns:
+        --------
+        coef : array
+            Segment coefficients [nseg, 3] in the format of set_coef().
+        """
+        aber = np.asarray(aber).reshape(len(modes), -1)
+        # rms of x over a hexagon with circumradius R is R * sqrt(5/24)
+        slope_per_opd = 1 / (2 * self.seg_circumradius * np.sqrt(5 / 24))
+        scale = {'piston': 0.5, 'tip': slope_per_opd, 'tilt': slope_per_opd}
+
+        coef = np.zeros((aber.shape[1], 3))
+        for mode, mode_aber in zip(modes, aber):
+            coef[:, LOCAL_MODES.index(mode)] = mode_aber * scale[mode]
+
+        return coef
+
     def flatten(self):
         self.sm.flatten()
 
@@ -185,6 +1157,98 @@ class SegmentedTelescopeAPLC:
         for vals in aber_array:
             self.sm.set_segment(vals[0], vals[1], vals[2], vals[3])
 
+    def set_coef(self, coef_array):
+        """ Set piston, tip and tilt of all segments at once, replacing all previous segment coefficients.
+
+        Parameters:
+        ----------
+        coef_array : array
+            Segment coefficients [nseg, 3], row i holds piston (in meters of surface), tip and tilt (in radians of
+            surface) of segment i+1.
+        """
+        self.sm.coef[:] = coef_array
+
+    def share_optics(self, store):
+        """ Put the pupil plane optics, segment positions, dark hole mask and reference PSF into a SharedArrayStore.
+
+        Worker processes create their own instance from it, see LuvoirAPLC, instead of reading the optics files.
+
+        Parameters:
+        ----------
+        store : SharedArrayStore
+            Store owned by this process.
+        """
+        pupil_shape = tuple(self.aper.grid.shape)
+        store.put('aperture', np.asarray(self.aper).reshape(pupil_shape))
+        store.put('indexed_aperture', np.asarray(self.indexed_aperture).reshape(pupil_shape))
+        store.put('apodizer', np.asarray(self.apodizer).reshape(pupil_shape))
+        store.put('lyot_stop', np.asarray(self.lyotstop).reshape(pupil_shape))
+        store.put('seg_pos', np.array([self.seg_pos.x, self.seg_pos.y]))
+        store.put('dh_mask', np.asarray(self.dh_mask))
+        store.put('psf_ref', np.asarray(self._get_psf_ref()))
+
+    def share_propagation(self, store, segment_basis=True):
+        """ Calculate the propagation onto the dark hole once, and put it into a SharedArrayStore next to
+        share_optics().
+
+        These are the MFT matrices onto the FPM and the dark hole of self.dh_mask at self.wvln and all
+        self.wavelengths, the dark hole E-fields of the flat mirror, the reference peaks and optionally the segment
+        basis of calc_piston_contrast(), in the current precision and pupil crop. Worker processes use them with
+        attach_propagation() instead of each calculating its own copy.
+
+        Parameters:
+        ----------
+        store : SharedArrayStore
+            Store owned by this process.
+        segment_basis : bool
+            Whether to also calculate and share the segment basis, which only piston-only calculations use.
+        """
+        wavelengths = list(self.wavelengths) + ([self.wvln] if self.wvln not in self.wavelengths else [])
+        store.put('propagation_settings', np.array([self.single_precision, self.crop_pupil]))
+        store.put('wavelengths', np.array(self.wavelengths))
+        store.put('mft_wavelengths', np.array(wavelengths))
+        store.put('ref_peaks', np.array([self._get_ref_peak(wavelength) for wavelength in wavelengths]))
+        for w, wavelength in enumerate(wavelengths):
+            for name, mft in (('fpm_mft', self._get_fpm_mft(wavelength)),
+                              ('dh_mft', self._get_dh_mft(self.dh_mask, wavelength))):
+                for field, array in mft.items():
+                    store.put(f'{name}_{w}_{field}', np.asarray(array))
+            store.put(f'flat_efield_{w}', self._get_flat_efield(self.dh_mask, wavelength))
+        if segment_basis:
+            store.put('segment_basis', self._get_segment_basis(self.dh_mask))
+
+    def attach_propagation(self, store):
+        """ Use the propagation that share_propagation() put into a SharedArrayStore, as zero-copy views.
+
+        Takes over the precision, pupil crop and wavelengths of the sharing simulator, which the shared arrays are
+        calculated for. The optics and dark hole mask have to be the same, as for an instance created on the store
+        of share_optics().
+
+        Parameters:
+        ----------
+        store : SharedArrayStore
+            Store attached in this process.
+        """
+        single_precision, crop_pupil = store.get('propagation_settings')
+        self.single_precision, self.crop_pupil = bool(single_precision), bool(crop_pupil)
+        self.wavelengths = [float(wavelength) for wavelength in store.get('wavelengths')]
+
+        def from_store(name, fields):
+            arrays = {field: store.get(f'{name}_{field}') for field in fields}
+            return {field: float(array) if array.ndim == 0 else array for field, array in arrays.items()}
+
+        ref_peaks = store.get('ref_peaks')
+        for w, wavelength in enumerate(store.get('mft_wavelengths')):
+            wavelength = float(wavelength)
+            self._ref_peaks[wavelength] = float(ref_peaks[w])
+            self._fpm_mfts[self._fpm_mft_key(wavelength)] = from_store(f'fpm_mft_{w}', ('mft_y', 'mft_x', 'imft_y',
+                                                                                        'imft_x', 'norm'))
+            self._dh_mfts[self._dh_mft_key(self.dh_mask, wavelength)] = from_store(f'dh_mft_{w}', ('mft_y', 'mft_x',
+                                                                                                  'dh_idx', 'norm'))
+            self._flat_efields[self._flat_efield_key(self.dh_mask, wavelength)] = store.get(f'flat_efield_{w}')
+        if 'segment_basis' in store:
+            self._segment_bases[self._segment_basis_key(self.dh_mask)] = store.get('segment_basis')
+
     def forward(self, wavefront):
         raise NotImplementedError()
 
@@ -201,19 +1265,22 @@ class LuvoirAPLC(SegmentedTelescopeAPLC):
         Path to input files: apodizer, aperture, indexed aperture, Lyot stop.
     apod_design : string
         Choice of apodizer design from May 2019 delivery. "small", "medium" or "large".
+    samp : float
+        Sampling of the final focal plane, in pixels per lambda/D.
+    pupil_px : int, optional
+        Number of pupil pixels across, default from the configfile or the 1000 px of the delivered files. Must divide
+        the delivered size, the pupil plane optics are binned down to it.
+    shared_store : SharedArrayStore, optional
+        Store filled by share_optics() of an instance with the same parameters, typically in a parent process. The
+        optics are then zero-copy views on the shared arrays instead of being read from the FITS files.
     """
-    def __init__(self, input_dir, apod_design, samp):
+    def __init__(self, input_dir, apod_design, samp, pupil_px=None, shared_store=None):
         self.nseg = 120   # FIXME: this should not be hard-coded
         self.wvln = CONFIG_INI.getfloat('LUVOIR', 'lambda') * 1e-9    # m
         self.diam = 15.  # m   # FIXME: this should not be hard-coded
         self.sampling = samp
         self.lam_over_d = self.wvln / self.diam
-        self.apod_dict = {'small': {'pxsize': 1000, 'fpm_rad': 3.5, 'fpm_px': 150, 'iwa': 3.4, 'owa': 12.,
-                                    'fname': '0_LUVOIR_N1000_FPM350M0150_IWA0340_OWA01200_C10_BW10_Nlam5_LS_IDD0120_OD0982_no_ls_struts.fits'},
-                          'medium': {'pxsize': 1000, 'fpm_rad': 6.82, 'fpm_px': 250, 'iwa': 6.72, 'owa': 23.72,
-                                     'fname': '0_LUVOIR_N1000_FPM682M0250_IWA0672_OWA02372_C10_BW10_Nlam5_LS_IDD0120_OD0982_no_ls_struts.fits'},
-                          'large': {'pxsize': 1000, 'fpm_rad': 13.38, 'fpm_px': 400, 'iwa': 13.28, 'owa': 46.88,
-                                    'fname': '0_LUVOIR_N1000_FPM1338M0400_IWA1328_OWA04688_C10_BW10_Nlam5_LS_IDD0120_OD0982_no_ls_struts.fits'}}
+        self.apod_dict = APOD_DESIGNS
         self.imlamD = 1.2*self.apod_dict[apod_design]['owa']
 
         # Pupil plane optics
@@ -223,29 +1290,46 @@ class LuvoirAPLC(SegmentedTelescopeAPLC):
                                  self.apod_dict[apod_design]['fname'])
         ls_fname = 'inputs/LS_LUVOIR_ID0120_OD0982_no_struts_gy_ovsamp4_N1000.fits'
 
-        pup_read = hc.read_fits(os.path.join(input_dir, aper_path))
-        aper_ind_read = hc.read_fits(os.path.join(input_dir, aper_ind_path))
-        apod_read = hc.read_fits(os.path.join(input_dir, apod_path))
-        ls_read = hc.read_fits(os.path.join(input_dir, ls_fname))
+        # Pupil resolution, reduced by binning the delivered optics
+        pxsize = self.apod_dict[apod_design]['pxsize']
+        if pupil_px is None:
+            pupil_px = CONFIG_INI.getint('LUVOIR', 'pupil_px', fallback=pxsize)
+        if pxsize % pupil_px != 0:
+            raise ValueError(f'pupil_px = {pupil_px} has to divide the {pxsize} px of the delivered pupil files.')
+        self.pupil_px = pupil_px
+
+        if shared_store is not None:
+            # Zero-copy views on the optics shared by the parent process
+            pup_read = shared_store.get('aperture')
+            aper_ind_read = shared_store.get('indexed_aperture')
+            apod_read = shared_store.get('apodizer')
+            ls_read = shared_store.get('lyot_stop')
+            poslist = shared_store.get('seg_pos')
+            if pup_read.shape != (pupil_px, pupil_px):
+                raise ValueError(f'The shared optics have {pup_read.shape[0]} px, not {pupil_px} px.')
+        else:
+            # Memory-mapped from the optics cache after the first read of each file
+            pup_read = disk_cache.read_fits_asset(os.path.join(input_dir, aper_path))
+            aper_ind_read = disk_cache.read_fits_asset(os.path.join(input_dir, aper_ind_path))
+            apod_read = disk_cache.read_fits_asset(os.path.join(input_dir, apod_path))
+            ls_read = disk_cache.read_fits_asset(os.path.join(input_dir, ls_fname))
+
+            binning = pxsize // pupil_px
+            if binning > 1:
+                pup_read = _bin_pupil(pup_read, binning)
+                aper_ind_read = _bin_indexed_pupil(aper_ind_read, binning)
+                apod_read = _bin_pupil(apod_read, binning)
+                ls_read = _bin_pupil(ls_read, binning)
 
-        pupil_grid = hc.make_pupil_grid(dims=self.apod_dict[apod_design]['pxsize'], diameter=self.diam)
+            # Load segment positions from fits header
+            poslist = disk_cache.read_segment_positions(os.path.join(input_dir, aper_ind_path), self.nseg)
+
+        pupil_grid = hc.make_pupil_grid(dims=pupil_px, diameter=self.diam)
 
         self.aperture = hc.Field(pup_read.ravel(), pupil_grid)
         self.aper_ind = hc.Field(aper_ind_read.ravel(), pupil_grid)
         self.apod = hc.Field(apod_read.ravel(), pupil_grid)
         self.ls = hc.Field(ls_read.ravel(), pupil_grid)
-
-        # Load segment positions from fits header
-        hdr = fits.getheader(os.path.join(input_dir, aper_ind_path))
-
-        poslist = []
-        for i in range(self.nseg):
-            segname = 'SEG' + str(i + 1)
-            xin = hdr[segname + '_X']
-            yin = hdr[segname + '_Y']
-            poslist.append((xin, yin))
-
-        poslist = np.transpose(np.array(poslist))
         self.seg_pos = hc.CartesianGrid(poslist)
 
         # Focal plane mask
@@ -255,25 +1339,355 @@ class LuvoirAPLC(SegmentedTelescopeAPLC):
         self.fpm = 1 - hc.circular_aperture(2*self.apod_dict[apod_design]['fpm_rad']*self.lam_over_d)(focal_grid_fpm)
 
         # Final focal plane grid (detector)
-        self.focal_det = hc.make_focal_grid(pupil_grid=pupil_grid, q=self.sampling, num_airy=self.imlamD, wavelength=self.wvln)
+        self.focal_det = make_luvoir_focal_grid(pupil_grid, apod_design, self.sampling, self.wvln)
+
+        # Wavelengths of broadband calculations, evenly spread over the fractional bandwidth
+        nb_wavelengths = CONFIG_INI.getint('LUVOIR', 'nb_wavelengths', fallback=1)
+        bandwidth = CONFIG_INI.getfloat('LUVOIR', 'bandwidth', fallback=0.)
+        wavelengths = self.wvln * (1 + bandwidth * np.linspace(-0.5, 0.5, nb_wavelengths)) if nb_wavelengths > 1 \
+            else np.array([self.wvln])
 
         luvoir_params = {'wavelength': self.wvln, 'diameter': self.diam, 'imlamD': self.imlamD,
-                         'fpm_rad': self.apod_dict[apod_design]['fpm_rad']}
+                         'fpm_rad': self.apod_dict[apod_design]['fpm_rad'], 'wavelengths': list(wavelengths)}
 
         # Initialize the general segmented telescope with APLC class, includes the SM
         super().__init__(aper=self.aperture, indexed_aperture=self.aper_ind, seg_pos=self.seg_pos, apod=self.apod,
                          lyotst=self.ls, fpm=self.fpm, focal_grid=self.focal_det, params=luvoir_params)
 
-        # Make dark hole mask
-        dh_outer = hc.circular_aperture(2 * self.apod_dict[apod_design]['owa'] * self.lam_over_d)(
-            self.focal_det)
-        dh_inner = hc.circular_aperture(2 * self.apod_dict[apod_design]['iwa'] * self.lam_over_d)(
-            self.focal_det)
-        self.dh_mask = (dh_outer - dh_inner).astype('bool')
-
-        # Propagators
-        self.coro = hc.LyotCoronagraph(pupil_grid, self.fpm, self.ls)
-        self.prop = hc.FraunhoferPropagator(pupil_grid, self.focal_det)
-        self.coro_no_ls = hc.LyotCoronagraph(pupil_grid, self.fpm)
-        #TODO: these three propagators should actually happen in the super init
-        # -> how are self.aper_ind and pupil_grid connected?
+        # Dark hole mask, and its pixel indices for the contrast
+        if shared_store is not None:
+            dh_mask = hc.Field(shared_store.get('dh_mask'), self.focal_det)
+            self.dark_hole = util.DarkHole(dh_mask, np.flatnonzero(dh_mask))
+            self._psf_ref = hc.Field(shared_store.get('psf_ref'), self.focal_det)
+        else:
+            self.dark_hole = get_dark_hole(self.focal_det, self.apod_dict[apod_design]['iwa'],
+                                           self.apod_dict[apod_design]['owa'], self.lam_over_d)
+        self.dh_mask = self.dark_hole.mask
+
+        # Identifies this optical configuration in the PSF cache
+        self.cache_config = {'telescope': 'LUVOIR', 'input_dir': os.path.abspath(input_dir),
+                             'apod_design': apod_design, 'sampling': self.sampling, 'wavelength': self.wvln,
+                             'pupil_px': self.pupil_px}
+
+
+    def dark_hole_regions(self, annuli=(), halves=False, masks=None):
+        """ Get focal plane regions to calculate contrasts in, in addition to the dark hole itself.
+
+        Parameters:
+        ----------
+        annuli : list of (float, float)
+            Inner and outer radius of radial annuli, in lambda/D. They are not limited to the dark hole.
+        halves : bool
+            Whether to add the halves of the dark hole on either side of the x and y axes. Pixels on an axis
+            belong to neither half.
+        masks : dict, optional
+            Region name: boolean mask on the final focal plane grid, user-defined regions.
+        Returns:
+        --------
+        regions : dict
+            Region name: util.DarkHole. The dark hole is 'dh', the annuli are 'annulus_<inner>-<outer>' and the halves
+            'dh_right', 'dh_left', 'dh_top' and 'dh_bottom'.
+        """
+        regions = {'dh': self.dark_hole}
+        for inner, outer in annuli:
+            regions[f'annulus_{inner:g}-{outer:g}'] = get_dark_hole(self.focal_det, inner, outer, self.lam_over_d)
+
+        if halves:
+            x, y = self.focal_det.x, self.focal_det.y
+            for name, side in (('dh_right', x > 0), ('dh_left', x < 0), ('dh_top', y > 0), ('dh_bottom', y < 0)):
+                half_mask = hc.Field(np.asarray(self.dh_mask, dtype=bool) & np.asarray(side), self.focal_det)
+                regions[name] = util.DarkHole(half_mask, np.flatnonzero(half_mask))
+
+        if masks is not None:
+            for name, mask in masks.items():
+                mask = hc.Field(np.asarray(mask).ravel().astype(bool), self.focal_det)
+                regions[name] = util.DarkHole(mask, np.flatnonzero(mask))
+
+        return regions
+
+
+# Dark holes on focal plane grids, see get_dark_hole()
+_dark_holes = {}
+
+
+def get_dark_hole(focal_grid, iwa, owa, lam_over_d):
+    """ Get the dark hole on a focal plane grid, which is only built once per grid and set of working angles.
+
+    The returned mask and indices are shared between all callers and read-only.
+
+    Parameters:
+    ----------
+    focal_grid : hcipy.CartesianGrid
+        Regularly spaced focal plane grid.
+    iwa : float
+        Inner working angle, in lambda/D.
+    owa : float
+        Outer working angle, in lambda/D.
+    lam_over_d : float
+        Size of lambda/D in the units of the focal plane grid.
+    Returns:
+    --------
+    util.DarkHole with the boolean dark hole mask Field and the flat indices of its pixels.
+    """
+    key = (tuple(focal_grid.dims), tuple(focal_grid.delta), tuple(focal_grid.zero), iwa, owa, lam_over_d)
+    if key not in _dark_holes:
+        dh_outer = hc.circular_aperture(2 * owa * lam_over_d)(focal_grid)
+        dh_inner = hc.circular_aperture(2 * iwa * lam_over_d)(focal_grid)
+        dh_mask = (dh_outer - dh_inner).astype('bool')
+        indices = np.flatnonzero(dh_mask)
+        dh_mask.flags.writeable = False
+        indices.flags.writeable = False
+        _dark_holes[key] = util.DarkHole(dh_mask, indices)
+    return _dark_holes[key]
+
+
+def dark_hole_union(regions):
+    """ Union of the masks of several focal plane regions, and the positions of the pixels of each region in it.
+
+    Parameters:
+    ----------
+    regions : dict
+        Region name: util.DarkHole or boolean mask, all on the same grid.
+    Returns:
+    --------
+    union_mask : array of bool
+    positions : dict
+        Region name: indices into the pixels of the union mask, in the order of np.flatnonzero().
+    """
+    union_mask = None
+    indices = {}
+    for name, region in regions.items():
+        if not isinstance(region, util.DarkHole):
+            region = util.DarkHole(region, np.flatnonzero(region))
+        if union_mask is None:
+            union_mask = np.zeros(np.size(region.mask), dtype=bool)
+        union_mask[region.indices] = True
+        indices[name] = region.indices
+
+    union_idx = np.flatnonzero(union_mask)
+    positions = {name: np.searchsorted(union_idx, region_idx) for name, region_idx in indices.items()}
+    return union_mask, positions
+
+
+def _bin_pupil(pupil, binning):
+    """ Bin a square pupil plane array down by an integer factor, averaging the pixels of each bin. """
+    n = pupil.shape[0] // binning
+    return np.asarray(pupil, dtype=np.float64).reshape(n, binning, n, binning).mean(axis=(1, 3))
+
+
+def _bin_indexed_pupil(indexed_pupil, binning):
+    """ Bin a square indexed aperture down by an integer factor, each bin gets the most frequent segment index in it.
+
+    Gap pixels (index 0) are not counted, so every bin that transmits light of a segment in the binned aperture of
+    _bin_pupil() belongs to a segment, also when the gap covers half of the bin or more. Only bins without any segment
+    pixels get index 0.
+    """
+    n = indexed_pupil.shape[0] // binning
+    bins = np.rint(indexed_pupil).astype(int).reshape(n, binning, n, binning).transpose(0, 2, 1, 3)
+    bins = bins.reshape(n, n, binning**2)
+    counts = np.sum(bins[..., :, np.newaxis] == bins[..., np.newaxis, :], axis=-1)
+    counts[bins == 0] = 0
+    return np.take_along_axis(bins, np.argmax(counts, axis=-1)[..., np.newaxis], axis=-1)[..., 0].astype(float)
+
+
+def _mft_matrix(coords_left, coords_right, wavelength, sign=-1, dtype=complex):
+    """One-dimensional MFT matrix exp(sign * i * 2pi/lambda * outer(coords_left, coords_right)).
+
+    With the MFT cache switched on, the matrix is read from (or written to) the cache directory, keyed on the
+    coordinates and the wavelength, and memory-mapped read-only so that all processes share the same copy.
+
+    Parameters:
+    ----------
+    coords_left : array
+        Coordinates along the first axis of the matrix, in m (pupil) or radians (focal plane).
+    coords_right : array
+        Coordinates along the second axis of the matrix.
+    wavelength : float
+        Wavelength in m.
+    sign : int
+        -1 for a propagation from pupil to focal plane, 1 for the inverse direction.
+    dtype : dtype
+        complex128 (default) or complex64 for single-precision propagations.
+    """
+    mft_cache = disk_cache.get_mft_cache()
+    if mft_cache is not None:
+        mft_config = {'kind': 'mft', 'wavelength': wavelength, 'sign': sign,
+                      'shape': [len(coords_left), len(coords_right)], 'dtype': np.dtype(dtype).name}
+        key = disk_cache.hash_key(mft_config, np.concatenate((coords_left, coords_right)))
+        matrix = mft_cache.get(key, mmap_mode='r')
+        if matrix is not None:
+            return matrix
+
+    k = 2 * np.pi / wavelength
+    matrix = np.exp(sign * 1j * k * np.outer(coords_left, coords_right)).astype(dtype, copy=False)
+
+    if mft_cache is not None:
+        mft_cache.put(key, matrix)
+        matrix = mft_cache.get(key, mmap_mode='r')
+
+    return matrix
+
+
+def _slices_key(*slices):
+    """ Hashable key of a tuple of slices, for the memos of arrays on a pupil region. """
+    return tuple((sl.start, sl.stop) for sl in slices)
+
+
+def _support_slices(mask):
+    """Row and column slices of the bounding box of the nonzero pixels of a 2D mask.
+
+    The pupil plane MFTs are separable, a matrix product along y and one along x, so the propagated pupil region has
+    to be a rectangle of rows and columns. The pixels of the box outside of the mask are zero and do not contribute to
+    the transforms, so the crop is exact. An index vector of only the illuminated pixels would also skip the corners of
+    the box, but needs a dense MFT matrix from all of these pixels onto the focal plane, with about as many elements as
+    pupil pixels times focal plane pixels instead of (rows + columns) times their size, and a matrix-vector product
+    per field instead of two small matrix products. For a round pupil the box only holds about 1 - pi/4 of zeros.
+    """
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    cols = np.flatnonzero(np.any(mask, axis=0))
+    return slice(int(rows[0]), int(rows[-1]) + 1), slice(int(cols[0]), int(cols[-1]) + 1)
+
+
+def _batch_mft(fields, mft_y, mft_x):
+    """Matrix Fourier transform of a stack of 2D fields, done as two large matrix-matrix products.
+
+    Parameters:
+    ----------
+    fields : array
+        Stack of fields [nfields, ny, nx].
+    mft_y : array
+        MFT matrix along y, [my, ny].
+    mft_x : array
+        MFT matrix along x, [nx, mx].
+    Returns:
+    --------
+    Stack of transformed fields [nfields, my, mx].
+    """
+    nfields, ny, nx = fields.shape
+    tmp = mft_y.dot(fields.transpose(1, 0, 2).reshape(ny, nfields * nx))   # [my, nfields * nx]
+    tmp = tmp.reshape(-1, nx).dot(mft_x)                                   # [my * nfields, mx]
+    return tmp.reshape(mft_y.shape[0], nfields, -1).transpose(1, 0, 2)
+
+
+class _MftLyotCoronagraph:
+    """ Lyot coronagraph of a SegmentedTelescopeAPLC on its cached MFT matrices, like hc.LyotCoronagraph.
+
+    The full pupil is propagated in double precision at the wavelength of the wavefront, with Babinet's principle:
+    the field blocked by the FPM is propagated to the focal plane and back, and subtracted from the pupil field.
+
+    Parameters:
+    ----------
+    simulator : SegmentedTelescopeAPLC
+        Simulator whose FPM and MFT matrices are used.
+    lyot_stop : Field, optional
+        Lyot stop applied in the Lyot plane, default is none.
+    """
+    def __init__(self, simulator, lyot_stop=None):
+        self.simulator = simulator
+        self.lyot_stop = None if lyot_stop is None else np.asarray(lyot_stop).reshape(simulator.aper.grid.shape)
+        self.fpm_spot = (1 - np.asarray(simulator.fpm)).reshape(simulator.fpm.grid.shape)
+
+    def __call__(self, wavefront):
+        pupil_grid = self.simulator.aper.grid
+        fpm_mft = self.simulator._get_fpm_mft(wavefront.wavelength, full_pupil=True, dtype=np.complex128)
+        efield = np.asarray(wavefront.electric_field).reshape(pupil_grid.shape)
+
+        efield_fpm = fpm_mft['mft_y'].dot(efield).dot(fpm_mft['mft_x']) * self.fpm_spot
+        efield_lyot = efield - fpm_mft['norm'] * fpm_mft['imft_y'].dot(efield_fpm).dot(fpm_mft['imft_x'])
+        if self.lyot_stop is not None:
+            efield_lyot *= self.lyot_stop
+
+        return hc.Wavefront(hc.Field(efield_lyot.ravel(), pupil_grid), wavefront.wavelength)
+
+    forward = __call__
+
+
+class _MftFraunhoferPropagator:
+    """ Fraunhofer propagation of a SegmentedTelescopeAPLC onto its final focal plane, like hc.FraunhoferPropagator.
+
+    The full pupil is propagated in double precision at the wavelength of the wavefront, on the cached MFT matrices
+    onto the full final focal plane, including the constant phase factor 1/i of the HCIPy propagator.
+
+    Parameters:
+    ----------
+    simulator : SegmentedTelescopeAPLC
+        Simulator whose final focal plane and MFT matrices are used.
+    """
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def __call__(self, wavefront):
+        simulator = self.simulator
+        image_mft = simulator._get_dh_mft(simulator._full_image_mask, wavefront.wavelength, full_pupil=True,
+                                          dtype=np.complex128)
+        efield = np.asarray(wavefront.electric_field).reshape(simulator.aper.grid.shape)
+        efield_im = image_mft['mft_y'].dot(efield).dot(image_mft['mft_x']) * (image_mft['norm'] / 1j)
+
+        return hc.Wavefront(hc.Field(efield_im.ravel(), simulator.focal_det), wavefront.wavelength)
+
+    forward = __call__
+
+
+def make_luvoir_focal_grid(pupil_grid, apod_design, samp, wavelength):
+    """ Final focal plane grid of LuvoirAPLC, in radians, out to 1.2 times the OWA of the APLC design.
+
+    Parameters:
+    ----------
+    pupil_grid : hcipy.CartesianGrid
+        Pupil plane grid of the full telescope.
+    apod_design : string
+        Choice of apodizer design from May 2019 delivery. "small", "medium" or "large".
+    samp : float
+        Sampling of the final focal plane, in pixels per lambda/D.
+    wavelength : float
+        Wavelength in m.
+    """
+    return hc.make_focal_grid(pupil_grid=pupil_grid, q=samp, num_airy=1.2 * APOD_DESIGNS[apod_design]['owa'],
+                              wavelength=wavelength)
+
+
+class _OpticsStore(dict):
+    """ In-process store of read-only optics arrays, with the put() and get() of a SharedArrayStore. """
+    def put(self, name, array):
+        array = np.array(array)
+        array.flags.writeable = False
+        self[name] = array
+        return array
+
+
+# Memoized results of SegmentedTelescopeAPLC that are keyed on everything they depend on, shared by get_luvoir_aplc()
+_SHARED_MEMOS = ('_dh_mfts', '_fpm_mfts', '_segment_bases', '_taylor_bases', '_flat_efields')
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_luvoir_optics(input_dir, apod_design, samp, pupil_px):
+    luvoir = LuvoirAPLC(input_dir, apod_design, samp, pupil_px)
+    optics = _OpticsStore()
+    luvoir.share_optics(optics)
+    return optics, {name: getattr(luvoir, name) for name in _SHARED_MEMOS}
+
+
+def get_luvoir_aplc(input_dir, apod_design, samp, pupil_px=None):
+    """ Get a new LuvoirAPLC instance, with the optics only read once per set of parameters.
+
+    Every call returns its own instance with a flat segmented mirror, so callers can change its segment state,
+    precision and pupil crop without affecting each other. The optics are read-only arrays shared by all instances
+    of the same parameters, as are the MFT matrices and segment bases they calculate, whose keys include the
+    precision, pupil crop and wavelengths.
+
+    Parameters:
+    ----------
+    input dir : string
+        Path to input files: apodizer, aperture, indexed aperture, Lyot stop.
+    apod_design : string
+        Choice of apodizer design from May 2019 delivery. "small", "medium" or "large".
+    samp : float
+        Sampling of the final focal plane, in pixels per lambda/D.
+    pupil_px : int, optional
+        Number of pupil pixels across, see LuvoirAPLC.
+    """
+    optics, memos = _cached_luvoir_optics(input_dir, apod_design, samp, pupil_px)
+    luvoir = LuvoirAPLC(input_dir, apod_design, samp, pupil_px, shared_store=optics)
+    for name, memo in memos.items():
+        setattr(luvoir, name, memo)
+    return luvoir
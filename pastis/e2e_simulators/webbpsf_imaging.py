@@ -1,6 +1,7 @@
 """
 This is a module containing convenience functions to create the JWST aperture and coronagraphic images with WebbPSF.
 """
+import functools
 import os
 import numpy as np
 import matplotlib.pyplot as plt
@@ -11,6 +12,7 @@ import poppy
 import webbpsf
 
 from config import CONFIG_INI
+import disk_cache
 import util_pastis as util
 
 log = logging.getLogger()
@@ -19,6 +21,7 @@ log = logging.getLogger()
 # webbpsf.utils.get_webbpsf_data_path()
 # --> e.g.: >>source activate astroconda   >>ipython   >>import webbpsf   >>webbpsf.utils.get_webbpsf_data_path()
 os.environ['WEBBPSF_PATH'] = CONFIG_INI.get('local', 'webbpsf_data_path')
+util.configure_poppy_fft()
 
 
 which_tel = CONFIG_INI.get('telescope', 'name')
@@ -84,6 +87,90 @@ def get_jwst_coords(outDir):
     return seg_position
 
 
+class NircamSession:
+    """
+    Persistent NIRCam instrument with an adjustable OTE, for repeated PSF calculations.
+
+    The instrument, its masks and the adjustable OTE are set up only once, so that every subsequent PSF only costs
+    the segment update and the propagation itself. Use get_nircam_session() to get a cached instance.
+    :param filter: str, filter name
+    :param fpm: focal plane mask, None for no coronagraph
+    :param ppm: pupil plane mask - Lyot stop, None for no coronagraph
+    """
+    def __init__(self, filter, fpm=None, ppm=None):
+        self.nc = webbpsf.NIRCam()
+        self.nc.filter = filter
+        if fpm is not None:
+            self.nc.image_mask = fpm
+        if ppm is not None:
+            self.nc.pupil_mask = ppm
+
+        self.nc, self.ote = webbpsf.enable_adjustable_ote(self.nc)
+        self.nc.include_si_wfe = False  # set SI internal WFE to zero
+        self.reset()
+
+        # Identifies this instrument configuration in the PSF cache
+        self.cache_config = {'instrument': 'NIRCam', 'filter': filter, 'fpm': fpm, 'ppm': ppm,
+                             'fov_pixels': int(im_size_e2e), 'webbpsf_version': webbpsf.__version__}
+
+    def reset(self):
+        """ Remove all segment aberrations, and ignore the internal WFE of the OTE. """
+        self.ote.reset()
+        self.ote.zero()
+
+    def apply_segment_zernikes(self, Aber_WSS):
+        """
+        Reset the OTE and apply Zernike (hexike) coefficients to all segments at once.
+        :param Aber_WSS: list or array of shape [nb_seg, zern_max] holding Zernike coefficients ordered in WSS convention
+                         and in METERS
+        """
+        self.reset()
+        Aber_WSS = np.asarray(Aber_WSS)
+        for i in np.nonzero(np.any(Aber_WSS != 0, axis=1))[0]:   # segments without aberration stay untouched
+            seg = wss_segs[i].split('-')[0]
+            self.ote._apply_hexikes_to_seg(seg, Aber_WSS[i,:])
+
+    def calc_psf(self, Aber_WSS=None):
+        """
+        Calculate the PSF on the current OTE state, or after applying new segment aberrations.
+
+        PSFs for explicitly passed aberrations go through the PSF cache, so a repeated aberration state is read from
+        disk instead of being propagated again.
+        :param Aber_WSS: optional, array holding Zernike coefficients ordered in WSS convention and in METERS
+        :return: array, PSF
+        """
+        psf_cache = None
+        if Aber_WSS is not None:
+            self.apply_segment_zernikes(Aber_WSS)
+            psf_cache = disk_cache.get_psf_cache()
+
+        if psf_cache is not None:
+            key = disk_cache.hash_key(self.cache_config, Aber_WSS)
+            psf_webbpsf = psf_cache.get(key)
+            if psf_webbpsf is not None:
+                return psf_webbpsf
+
+        psf_nc = self.nc.calc_psf(oversample=1, fov_pixels=int(im_size_e2e), nlambda=1)
+        psf_webbpsf = psf_nc[1].data
+
+        if psf_cache is not None:
+            psf_cache.put(key, psf_webbpsf)
+
+        return psf_webbpsf
+
+
+@functools.lru_cache(maxsize=None)
+def get_nircam_session(filter, fpm=None, ppm=None):
+    """
+    Get the NIRCam session for a filter and coronagraph, creating it only on the first call.
+    :param filter: str, filter name
+    :param fpm: focal plane mask, None for no coronagraph
+    :param ppm: pupil plane mask - Lyot stop, None for no coronagraph
+    :return: NircamSession
+    """
+    return NircamSession(filter, fpm, ppm)
+
+
 def nircam_coro(filter, fpm, ppm, Aber_WSS):
     """
     Create NIRCam image with specified filter and coronagraph, and aberration input.
@@ -93,27 +180,7 @@ def nircam_coro(filter, fpm, ppm, Aber_WSS):
     :param Aber_WSS: list or array holding Zernike coefficients ordered in WSS convention and in METERS
     :return:
     """
-
-    # Set up NIRCam and coronagraph
-    nc = webbpsf.NIRCam()
-    nc.filter = filter
-    nc.image_mask = fpm
-    nc.pupil_mask = ppm
-
-    # Adjust OTE with aberrations
-    nc, ote = webbpsf.enable_adjustable_ote(nc)
-    nc.include_si_wfe = False  # set SI internal WFE to zero
-    ote.reset()
-    ote.zero()
-    for i in range(nb_seg):
-        seg = wss_segs[i].split('-')[0]
-        ote._apply_hexikes_to_seg(seg, Aber_WSS[i,:])
-
-    # Calculate PSF
-    psf_nc = nc.calc_psf(oversample=1, fov_pixels=int(im_size_e2e), nlambda=1)
-    psf_webbpsf = psf_nc[1].data
-
-    return psf_webbpsf
+    return get_nircam_session(filter, fpm, ppm).calc_psf(Aber_WSS)
 
 
 def nircam_nocoro(filter, Aber_WSS):
@@ -123,25 +190,7 @@ def nircam_nocoro(filter, Aber_WSS):
     :param Aber_WSS:
     :return:
     """
-    # Create NIRCam object
-    nc = webbpsf.NIRCam()
-    # Set filter
-    nc.filter = filter
-
-    # Adjust OTE with aberrations
-    nc, ote = webbpsf.enable_adjustable_ote(nc)
-    nc.include_si_wfe = False  # set SI internal WFE to zero
-    ote.reset()
-    ote.zero()
-    for i in range(nb_seg):
-        seg = wss_segs[i].split('-')[0]
-        ote._apply_hexikes_to_seg(seg, Aber_WSS[i,:])
-
-    # Calculate PSF
-    psf_nc = nc.calc_psf(oversample=1, fov_pixels=int(im_size_e2e), nlambda=1)
-    psf_webbpsf = psf_nc[1].data
-
-    return psf_webbpsf
+    return get_nircam_session(filter).calc_psf(Aber_WSS)
 
 
 def setup_coro(filter, fpm, ppm):
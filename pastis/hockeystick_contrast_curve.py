@@ -193,7 +193,7 @@ def hockeystick_hicat(matrixdir, resultdir='', range_points=3, no_realizations=3
     log.info(f'\nTotal runtime for pastis_vs_e2e_contrast_calc.py: {runtime} sec = {runtime/60} min')
 
 
-def hockeystick_luvoir(apodizer_choice, matrixdir, resultdir='', range_points=3, no_realizations=3):
+def hockeystick_luvoir(apodizer_choice, matrixdir, resultdir='', range_points=3, no_realizations=3, pupil_px=None):
     """
     Construct a PASTIS hockeystick contrast curve for validation of the PASTIS matrix for LUVOIR.
 
@@ -208,6 +208,8 @@ def hockeystick_luvoir(apodizer_choice, matrixdir, resultdir='', range_points=3,
     :param range_points: int, How many points of WFE rms error to use in the predefined aberration range.
     :param no_realizations: int, How many realizations per WFE rms error should be calculated; the mean of the realizations
                                 is used in the plot
+    :param pupil_px: int, optional, reduced pupil resolution of the E2E simulator, calibrated once against the full
+                     resolution in resultdir
     :return:
     """
 
@@ -221,6 +223,10 @@ def hockeystick_luvoir(apodizer_choice, matrixdir, resultdir='', range_points=3,
     # Create results directory if it doesn't exist yet
     os.makedirs(resultdir, exist_ok=True)
 
+    # Accuracy of the reduced pupil resolution, stored with the results
+    if pupil_px is not None:
+        consim.pupil_resolution_calibration_luvoir(apodizer_choice, pupil_px, resultdir)
+
     # Loop over different RMS values and calculate contrast with MATRIX PASTIS and E2E simulation
     e2e_contrasts = []        # contrasts from E2E sim
     matrix_contrasts = []     # contrasts from matrix PASTIS
@@ -242,7 +248,8 @@ def hockeystick_luvoir(apodizer_choice, matrixdir, resultdir='', range_points=3,
             log.info(f"Random realization: {j+1}/{no_realizations}")
             log.info(f"Total: {(i*no_realizations)+(j+1)}/{len(rms_range)*no_realizations}\n")
 
-            c_e2e, c_matrix = consim.contrast_luvoir_num(apodizer_choice, matrix_dir=matrixdir, rms=rms)
+            c_e2e, c_matrix = consim.contrast_luvoir_num(apodizer_choice, matrix_dir=matrixdir, rms=rms,
+                                                         pupil_px=pupil_px)
 
             e2e_rand.append(c_e2e)
             matrix_rand.append(c_matrix)
@@ -19,17 +19,74 @@ import hcipy
 
 from config import CONFIG_INI
 import util_pastis as util
+import aperture_definition as apdef
 
 log = logging.getLogger()
 
 
+def _luvoir_image_plane(design=None):
+    """
+    Get the final focal plane grid and dark hole of the LuvoirAPLC of an APLC design, for the LUVOIR analytical model.
+    :param design: str, "small", "medium" or "large" LUVOIR-A APLC design, default is coronagraph_size from the configfile
+    :return: focal_grid: hcipy.CartesianGrid in radians, dark_hole: util.DarkHole
+    """
+    from e2e_simulators import luvoir_imaging
+
+    if design is None:
+        design = CONFIG_INI.get('LUVOIR', 'coronagraph_size')
+    tel_size_m = CONFIG_INI.getfloat('LUVOIR', 'diameter')
+    wvln = CONFIG_INI.getfloat('LUVOIR', 'lambda') * 1e-9
+    sampling = CONFIG_INI.getfloat('numerical', 'sampling')
+    pupil_px = CONFIG_INI.getint('LUVOIR', 'pupil_px')
+
+    pupil_grid = hcipy.make_pupil_grid(dims=pupil_px, diameter=tel_size_m)
+    focal_grid = luvoir_imaging.make_luvoir_focal_grid(pupil_grid, design, sampling, wvln)
+    apod_design = luvoir_imaging.APOD_DESIGNS[design]
+    dark_hole = luvoir_imaging.get_dark_hole(focal_grid, apod_design['iwa'], apod_design['owa'], wvln / tel_size_m)
+
+    return focal_grid, dark_hole
+
+
+def analytical_dark_hole(design=None):
+    """
+    Get the dark hole of the images returned by analytical_model(), from the dark hole registry in util_pastis, or for
+    LUVOIR the one of the LuvoirAPLC.
+
+    Use its indices to calculate the contrast of these images with util.dh_mean().
+    :param design: str, LUVOIR-A APLC design, only used for LUVOIR, see analytical_model()
+    :return: util.DarkHole
+    """
+    dataDir = os.path.join(CONFIG_INI.get('local', 'local_data_path'), 'active')
+    telescope = CONFIG_INI.get('telescope', 'name')
+
+    if telescope == 'LUVOIR':
+        return _luvoir_image_plane(design)[1]
+
+    inner_wa = CONFIG_INI.getint(telescope, 'IWA')
+    outer_wa = CONFIG_INI.getint(telescope, 'OWA')
+    sampling = CONFIG_INI.getfloat('numerical', 'sampling')
+    sz = CONFIG_INI.getint('numerical', 'im_size_lamD_hcipy')
+
+    # The dark hole is built on the pupil array, and then cut to the size of the final image
+    pupil_header = fits.getheader(os.path.join(dataDir, 'segmentation', 'pupil.fits'))
+    pup_shape = (pupil_header['NAXIS2'], pupil_header['NAXIS1'])
+    if telescope == 'JWST':
+        half_box = sampling * (outer_wa + 3)
+    else:
+        half_box = sz * sampling
+
+    return util.get_dark_hole(pup_shape, inner_wa, outer_wa, sampling, half_box)
+
+
 @u.quantity_input(coef=u.nm)
-def analytical_model(zernike_pol, coef, cali=False):
+def analytical_model(zernike_pol, coef, cali=False, design=None):
     """
 
     :param zernike_pol:
     :param coef:
     :param cali: bool; True if we already have calibration coefficients to use. False if we still need to create them.
+    :param design: str, "small", "medium" or "large" LUVOIR-A APLC design whose final focal plane the LUVOIR image is
+                   calculated on, default is coronagraph_size from the configfile; not used for other telescopes
     :return:
     """
 
@@ -38,11 +95,8 @@ def analytical_model(zernike_pol, coef, cali=False):
     telescope = CONFIG_INI.get('telescope', 'name')
     nb_seg = CONFIG_INI.getint(telescope, 'nb_subapertures')
     tel_size_m = CONFIG_INI.getfloat(telescope, 'diameter') * u.m
-    real_size_seg = CONFIG_INI.getfloat(telescope, 'flat_to_flat')     # in m, size in meters of an individual segment flatl to flat
     size_seg = CONFIG_INI.getint('numerical', 'size_seg')              # pixel size of an individual segment tip to tip
-    wvln = CONFIG_INI.getint(telescope, 'lambda') * u.nm
-    inner_wa = CONFIG_INI.getint(telescope, 'IWA')
-    outer_wa = CONFIG_INI.getint(telescope, 'OWA')
+    wvln = CONFIG_INI.getfloat(telescope, 'lambda') * u.nm
     tel_size_px = CONFIG_INI.getint('numerical', 'tel_size_px')        # pupil diameter of telescope in pixels
     im_size_pastis = CONFIG_INI.getint('numerical', 'im_size_px_pastis')             # image array size in px
     sampling = CONFIG_INI.getfloat('numerical', 'sampling')            # sampling
@@ -58,9 +112,20 @@ def analytical_model(zernike_pol, coef, cali=False):
     if zernike_pol == 1:
         coef -= np.mean(coef)
 
+    #-# Import information form segmentation script
+    segmentation = apdef.load_segmentation_bundle(os.path.join(dataDir, 'segmentation'))
+    Projection_Matrix = segmentation['Projection_Matrix'].astype(int)
+    vec_list = segmentation['vec_list']                    # in pixels
+    NR_pairs_list = segmentation['NR_pairs_list']
+
+    # Figure out how many NRPs we're dealing with
+    NR_pairs_nb = NR_pairs_list.shape[0]
+
     #-# Generic segment shapes
 
     if telescope == 'JWST':
+        real_size_seg = CONFIG_INI.getfloat(telescope, 'flat_to_flat')   # in m, size in meters of an individual segment flat to flat
+
         # Load pupil from file
         pupil = fits.getdata(os.path.join(dataDir, 'segmentation', 'pupil.fits'))
 
@@ -81,6 +146,8 @@ def analytical_model(zernike_pol, coef, cali=False):
         mini_seg = mini_hdu[0].data      # extract the image data from the fits file
 
     elif telescope == 'ATLAST':
+        real_size_seg = CONFIG_INI.getfloat(telescope, 'flat_to_flat')
+
         # Create mini-segment
         pupil_grid = hcipy.make_pupil_grid(dims=tel_size_px, diameter=real_size_seg)
         focal_grid = hcipy.make_focal_grid(pupil_grid, sampling, sz, wavelength=wvln.to(u.m).value)       # fov = lambda/D radius of total image
@@ -93,23 +160,31 @@ def analytical_model(zernike_pol, coef, cali=False):
         # Redefine size_seg if using HCIPy
         size_seg = mini_seg.shape[0]
 
-        # Make stand-in pupil for DH array
-        pupil = fits.getdata(os.path.join(dataDir, 'segmentation', 'pupil.fits'))
-        pup_im = np.copy(pupil)
-
-    #-# Generate a dark hole mask
-    #TODO: simplify DH generation and usage
-    dh_area = util.create_dark_hole(pup_im, inner_wa, outer_wa, sampling)   # this might become a problem if pupil size is not same like pastis image size. fine for now though.
-    if telescope == 'ATLAST':
-        dh_sz = util.zoom_cen(dh_area, sz*sampling)
+    elif telescope == 'LUVOIR':
+        # The segment pitch is the shortest baseline, and the flat sides of the hexagonal segments face their neighbours
+        seg_position = segmentation['seg_position']        # in m
+        baselines = seg_position[:, np.newaxis] - seg_position[np.newaxis, :]
+        baseline_lengths = np.hypot(baselines[:, :, 0], baselines[:, :, 1])
+        np.fill_diagonal(baseline_lengths, np.inf)
+        closest = np.unravel_index(np.argmin(baseline_lengths), baseline_lengths.shape)
+        real_size_seg = baseline_lengths[closest] - CONFIG_INI.getfloat(telescope, 'gaps')   # flat to flat, in m
+        seg_angle = np.arctan2(baselines[closest][1], baselines[closest][0])
+        circum_size_seg = 2 * real_size_seg / np.sqrt(3)
+
+        # Create mini-segment, and its propagator to the final focal plane of the LuvoirAPLC
+        focal_grid, dark_hole = _luvoir_image_plane(design)
+        pupil_grid = hcipy.make_pupil_grid(dims=size_seg, diameter=circum_size_seg)
+        prop = hcipy.FraunhoferPropagator(pupil_grid, focal_grid)
 
-    #-# Import information form segmentation script
-    Projection_Matrix = fits.getdata(os.path.join(dataDir, 'segmentation', 'Projection_Matrix.fits'))
-    vec_list = fits.getdata(os.path.join(dataDir, 'segmentation', 'vec_list.fits'))                    # in pixels
-    NR_pairs_list = fits.getdata(os.path.join(dataDir, 'segmentation', 'NR_pairs_list_int.fits'))
+        mini_seg_real = hcipy.hexagonal_aperture(circum_diameter=circum_size_seg, angle=seg_angle)
+        mini_seg_hc = hcipy.evaluate_supersampled(mini_seg_real, pupil_grid, 4)
+        mini_seg = mini_seg_hc.shaped
 
-    # Figure out how many NRPs we're dealing with
-    NR_pairs_nb = NR_pairs_list.shape[0]
+    #-# Get the dark hole mask, cut to the size of the final image
+    if telescope == 'LUVOIR':
+        dh_area = dark_hole.mask.reshape(focal_grid.shape)
+    else:
+        dh_area = analytical_dark_hole().mask   # this might become a problem if pupil size is not same like pastis image size. fine for now though.
 
     #-# Chose whether calibration factors to do the calibraiton with
     if cali:
@@ -122,13 +197,12 @@ def analytical_model(zernike_pol, coef, cali=False):
 
     #-# Generic coefficients
     # the coefficients in front of the non redundant pairs, the A_q in eq. 13 in Leboulleux et al. 2018
-    generic_coef = np.zeros(NR_pairs_nb) * u.nm * u.nm    # setting it up with the correct units this will have
-
-    for q in range(NR_pairs_nb):
-        for i in range(nb_seg):
-            for j in range(i+1, nb_seg):
-                if Projection_Matrix[i, j, 0] == q+1:
-                    generic_coef[q] += coef[i] * coef[j]
+    # Projection_Matrix[i, j] holds the NRP number (starting at 1) of the segment pair i, j, so we can sum the products
+    # of the coefficients of all pairs above the diagonal directly into their NRP.
+    seg_i, seg_j = np.triu_indices(nb_seg, k=1)
+    pair_products = (coef[seg_i] * coef[seg_j]).to(u.nm * u.nm).value
+    generic_coef = np.bincount(Projection_Matrix[seg_i, seg_j] - 1, weights=pair_products,
+                               minlength=NR_pairs_nb) * u.nm * u.nm
 
     #-# Constant sum and cosine sum - calculating eq. 13 from Leboulleux et al. 2018
     if telescope == 'JWST':
@@ -143,14 +217,15 @@ def analytical_model(zernike_pol, coef, cali=False):
     # Calculating the cosine terms from eq. 13.
     # The -1 with each NR_pairs_list is because the segment names are saved starting from 1, but Python starts
     # its indexing at zero, so we have to make it start at zero here too.
-    for q in range(NR_pairs_nb):
-        # cos(b_q <dot> u): b_q with 1 <= q <= NR_pairs_nb is the basis of NRPS, meaning the distance vectors between
-        #                   two segments of one NRP. We can read these out from vec_list.
-        #                   u is the position (vector) in the detector plane. Here, those are the grids tab_i and tab_j.
-        # We need to calculate the dot product between all b_q and u, so in each iteration (for q), we simply add the
-        # x and y component.
-        cos_u_mat[:,:,q] = np.cos(px_sq_to_rad * (vec_list[NR_pairs_list[q,0]-1, NR_pairs_list[q,1]-1, 0] * tab_i) +
-                                  px_sq_to_rad * (vec_list[NR_pairs_list[q,0]-1, NR_pairs_list[q,1]-1, 1] * tab_j)) * u.dimensionless_unscaled
+    if telescope != 'LUVOIR':
+        for q in range(NR_pairs_nb):
+            # cos(b_q <dot> u): b_q with 1 <= q <= NR_pairs_nb is the basis of NRPS, meaning the distance vectors between
+            #                   two segments of one NRP. We can read these out from vec_list.
+            #                   u is the position (vector) in the detector plane. Here, those are the grids tab_i and tab_j.
+            # We need to calculate the dot product between all b_q and u, so in each iteration (for q), we simply add the
+            # x and y component.
+            cos_u_mat[:,:,q] = np.cos(px_sq_to_rad * (vec_list[NR_pairs_list[q,0]-1, NR_pairs_list[q,1]-1, 0] * tab_i) +
+                                      px_sq_to_rad * (vec_list[NR_pairs_list[q,0]-1, NR_pairs_list[q,1]-1, 1] * tab_j)) * u.dimensionless_unscaled
 
     sum1 = np.sum(coef**2)   # sum of all a_{k,l} in eq. 13 - this works only for single Zernikes (l fixed), because np.sum would sum over l too, which would be wrong.
     if telescope == 'JWST':
@@ -158,8 +233,18 @@ def analytical_model(zernike_pol, coef, cali=False):
     elif telescope == 'ATLAST':
         sum2 = np.zeros((int(2 * sz * sampling), int(2 * sz * sampling))) * u.nm * u.nm
 
-    for q in range(NR_pairs_nb):
-        sum2 = sum2 + generic_coef[q] * cos_u_mat[:,:,q]
+    if telescope == 'LUVOIR':
+        # Baseline vectors of the NRPs in meters; cos(b_q <dot> u) = Re(exp(i*k*b_qx*x) * exp(i*k*b_qy*y)) separates
+        # into phasors along the x and y axes of the focal grid (in radians), so sum2 is one matrix product
+        nrp_vectors = seg_position[NR_pairs_list[:, 0]-1] - seg_position[NR_pairs_list[:, 1]-1]
+        k = 2 * np.pi / wvln.to(u.m).value
+        x_foc, y_foc = focal_grid.separated_coords
+        phasor_x = np.exp(1j * k * np.outer(x_foc, nrp_vectors[:, 0]))   # [nx, NR_pairs_nb]
+        phasor_y = np.exp(1j * k * np.outer(y_foc, nrp_vectors[:, 1]))   # [ny, NR_pairs_nb]
+        sum2 = np.real((phasor_y * generic_coef.value).dot(phasor_x.T)) * u.nm * u.nm
+    else:
+        for q in range(NR_pairs_nb):
+            sum2 = sum2 + generic_coef[q] * cos_u_mat[:,:,q]
 
     #-# Local Zernike
     if telescope == 'JWST':
@@ -178,7 +263,7 @@ def analytical_model(zernike_pol, coef, cali=False):
         mf = mft.MatrixFourierTransform()
         ft_zern = mf.perform(Zer, im_size_pastis/sampling, im_size_pastis)
 
-    elif telescope == 'ATLAST':
+    elif telescope in ['ATLAST', 'LUVOIR']:
         isolated_zerns = hcipy.make_zernike_basis(num_modes=zern_max, D=real_size_seg, grid=pupil_grid, radial_cutoff=False)
         Zer = hcipy.Wavefront(mini_seg_hc * isolated_zerns[zernike_pol - 1], wavelength=wvln.to(u.m).value)
 
@@ -189,19 +274,19 @@ def analytical_model(zernike_pol, coef, cali=False):
     if telescope == 'JWST':
         # Generating the final image that will get passed on to the outer scope, I(u) in eq. 13
         intensity = np.abs(ft_zern)**2 * (sum1.value + 2. * sum2.value)
-    elif telescope == 'ATLAST':
+    elif telescope in ['ATLAST', 'LUVOIR']:
         intensity = ft_zern.intensity.shaped * (sum1.value + 2. * sum2.value)
 
     # PASTIS is only valid inside the dark hole, so we cut out only that part
     if telescope == 'JWST':
+        outer_wa = CONFIG_INI.getint(telescope, 'OWA')
         tot_dh_im_size = sampling * (outer_wa + 3)
         intensity_zoom = util.zoom_cen(intensity, tot_dh_im_size)       # zoom box is (owa + 3*lambda/D) wide, in terms of lambda/D
-        dh_area_zoom = util.zoom_cen(dh_area, tot_dh_im_size)
 
-        dh_psf = dh_area_zoom * intensity_zoom
+        dh_psf = dh_area * intensity_zoom
 
-    elif telescope == 'ATLAST':
-        dh_psf = dh_sz * intensity
+    elif telescope in ['ATLAST', 'LUVOIR']:
+        dh_psf = dh_area * intensity
 
     """
     # Create plots.
@@ -37,6 +37,9 @@ def ana_matrix_jwst():
     if not os.path.isdir(resDir):
         os.mkdir(resDir)
 
+    # Dark hole of the images from the analytical model, for the contrast
+    dark_hole = impastis.analytical_dark_hole()
+
     #-# Generating the PASTIS matrix
     matrix_direct = np.zeros([nb_seg, nb_seg])   # Generate empty matrix for contrast values from loop.
     all_ims = []
@@ -65,7 +68,7 @@ def ana_matrix_jwst():
             util.write_fits(temp_im_am, os.path.join(resDir, 'darkholes', filename_dh + '.fits'), header=None, metadata=None)
             all_dhs.append(temp_im_am)
 
-            contrast = np.mean(temp_im_am[np.where(temp_im_am != 0)])
+            contrast = util.dh_mean(temp_im_am, dark_hole)
             matrix_direct[i,j] = contrast
             log.info(f'contrast = {contrast}')
             all_contrasts.append(contrast)
@@ -20,12 +20,89 @@ import numpy as np
 import hcipy as hc
 
 from config import CONFIG_INI
+import disk_cache
 import util_pastis as util
-from e2e_simulators.luvoir_imaging import LuvoirAPLC
+from e2e_simulators.luvoir_imaging import LuvoirAPLC, dark_hole_union
 
 log = logging.getLogger()
 
 
+def _region_suffix(name):
+    """ File name suffix of the results of a focal plane region, empty for the dark hole itself. """
+    return '' if name == 'dh' else '_' + name
+
+
+def _save_dark_hole_regions(regions, resDir):
+    """
+    Save the masks of the focal plane regions a matrix is built for, as a cube with the region names in the header.
+    :param regions: dict, region name: util.DarkHole on the focal plane, see LuvoirAPLC.dark_hole_regions()
+    :param resDir: str, directory to save the masks to
+    """
+    header = fits.Header()
+    for k, name in enumerate(regions):
+        header[f'REGION{k}'] = name
+    masks = np.array([region.mask.shaped for region in regions.values()]).astype(int)
+    util.write_fits(masks, os.path.join(resDir, 'dark_hole_regions.fits'), header=header)
+
+
+def _read_dark_hole_regions(resDir, focal_grid):
+    """
+    Read the masks of the focal plane regions a matrix is built for, as saved by _save_dark_hole_regions().
+    :param resDir: str, directory the masks are saved in
+    :param focal_grid: hcipy.CartesianGrid, focal plane grid of the masks
+    :return: dict, region name: util.DarkHole on the focal plane; None if there are no saved regions
+    """
+    path = os.path.join(resDir, 'dark_hole_regions.fits')
+    if not os.path.exists(path):
+        return None
+
+    masks, header = fits.getdata(path, header=True)
+    regions = {}
+    for k, mask in enumerate(masks):
+        mask = hc.Field(mask.ravel().astype(bool), focal_grid)
+        regions[header[f'REGION{k}']] = util.DarkHole(mask, np.flatnonzero(mask))
+    return regions
+
+
+def _pastis_matrix_from_contrasts(matrix_direct, wfe_aber):
+    """
+    Fill the off-axis elements of a numerical PASTIS matrix from the pair-wise contrasts, and normalize it to nm.
+    :param matrix_direct: array [nseg, nseg], contrasts of the segment pairs minus the coronagraph floor
+    :param wfe_aber: float, calibration aberration in m
+    :return: matrix_pastis: array [nseg, nseg], in contrast per nm^2
+    """
+    diag = np.diag(matrix_direct)
+    matrix_pastis = (matrix_direct - diag[:, np.newaxis] - diag[np.newaxis, :]) / 2.
+    np.fill_diagonal(matrix_pastis, diag)
+
+    # Normalize matrix for the input aberration - this defines what units the PASTIS matrix will be in
+    matrix_pastis /= np.square(wfe_aber * 1e9)
+    return matrix_pastis
+
+
+def _matrix_config_header(luvoir, wfe_aber, zern_mode, **extra):
+    """
+    Header with a hash of the simulator configuration and calibration a numerical LUVOIR matrix is built with, so that
+    update_matrix_luvoir() only updates matrices it would calculate the same way.
+    :param luvoir: LuvoirAPLC
+    :param wfe_aber: float, calibration aberration in m
+    :param zern_mode: util.ZernikeMode, local aberration of the calibration; None for multi-mode matrices, whose local
+                      modes are passed in extra
+    :param extra: further settings the matrix depends on, e.g. the propagation and the wavelengths
+    :return: astropy.io.fits.Header with the CFGHASH keyword, and the NBWAVES and BANDWID keywords of the band
+    """
+    zernike = zern_mode.index if zern_mode is not None else None
+    config = dict(luvoir.cache_config, calibration_aberration=wfe_aber, zernike=zernike, **extra)
+    header = fits.Header()
+    header['CFGHASH'] = (disk_cache.hash_key(config), 'configuration hash')
+    if 'wavelengths' in extra:
+        # Band of the contrasts, see pastis_analysis.set_matrix_band()
+        wavelengths = extra['wavelengths']
+        header['NBWAVES'] = (len(wavelengths), 'number of wavelengths of the contrasts')
+        header['BANDWID'] = ((max(wavelengths) - min(wavelengths)) / luvoir.wvln, 'fractional bandwidth')
+    return header
+
+
 def num_matrix_jwst():
     """
     Generate a numerical PASTIS matrix for a JWST coronagraph.
@@ -68,9 +145,8 @@ def num_matrix_jwst():
     os.makedirs(os.path.join(resDir, 'psfs'), exist_ok=True)
     os.makedirs(os.path.join(resDir, 'darkholes'), exist_ok=True)
 
-    # Create the dark hole mask.
-    pup_im = np.zeros([im_size_e2e, im_size_e2e])    # this is just used for DH mask generation
-    dh_area = util.create_dark_hole(pup_im, inner_wa, outer_wa, sampling)
+    # Get the dark hole mask
+    dh_area = util.get_dark_hole((im_size_e2e, im_size_e2e), inner_wa, outer_wa, sampling)
 
     # Create a direct WebbPSF image for normalization factor
     fake_aber = np.zeros([nb_seg, zern_max])
@@ -142,8 +218,8 @@ def num_matrix_jwst():
             all_psfs.append(psf)
 
             log.info('Calculating mean contrast in dark hole')
-            dh_intensity = psf * dh_area
-            contrast = np.mean(dh_intensity[np.where(dh_intensity != 0)])
+            dh_intensity = psf * dh_area.mask
+            contrast = util.dh_mean(psf, dh_area)
             log.info(f'contrast: {contrast}')
 
             # Save DH image to disk and put current contrast in list
@@ -197,7 +273,7 @@ def num_matrix_jwst():
     # runtime = 20 min
 
 
-def num_matrix_luvoir(design, savepsfs=False, saveopds=True):
+def num_matrix_luvoir(design, savepsfs=False, saveopds=True, annuli=(), halves=False, masks=None):
     """
     Generate a numerical PASTIS matrix for a LUVOIR A coronagraph.
 
@@ -208,6 +284,10 @@ def num_matrix_luvoir(design, savepsfs=False, saveopds=True):
     :param savepsfs: bool, if True, all PSFs will be saved to disk individually, as fits files, additionally to the
                      total PSF cube. If False, the total cube will still get saved at the very end of the script.
     :param saveopds: bool, if True, all pupil surface maps of aberrated segment pairs will be saved to disk as PDF
+    :param annuli: list of (float, float), radial annuli in lambda/D to build additional matrices for
+    :param halves: bool, whether to build additional matrices for the halves of the dark hole
+    :param masks: dict, region name: boolean mask on the focal plane, user regions to build additional matrices for
+    The additional matrices come from the same PSFs and are saved with the region name appended to the file names.
     """
 
     # Keep track of time
@@ -258,21 +338,19 @@ def num_matrix_luvoir(design, savepsfs=False, saveopds=True):
     optics_input = CONFIG_INI.get('LUVOIR', 'optics_path')
     luvoir = LuvoirAPLC(optics_input, design, sampling)
 
-    ### Dark hole mask
-    dh_outer = hc.circular_aperture(2 * luvoir.apod_dict[design]['owa'] * luvoir.lam_over_d)(luvoir.focal_det)
-    dh_inner = hc.circular_aperture(2 * luvoir.apod_dict[design]['iwa'] * luvoir.lam_over_d)(luvoir.focal_det)
-    dh_mask = (dh_outer - dh_inner).astype('bool')
+    ### Focal plane regions, the dark hole and the additional ones
+    regions = luvoir.dark_hole_regions(annuli, halves, masks)
+    _save_dark_hole_regions(regions, resDir)
 
     ### Reference images for contrast normalization and coronagraph floor
     unaberrated_coro_psf, ref = luvoir.calc_psf(ref=True, display_intermediate=False, return_intermediate=False)
     norm = np.max(ref)
 
-    dh_intensity = (unaberrated_coro_psf / norm) * dh_mask
-    contrast_floor = np.mean(dh_intensity[np.where(dh_mask != 0)])
-    log.info(f'contrast floor: {contrast_floor}')
+    contrast_floor = np.array([util.dh_mean(unaberrated_coro_psf, region) / norm for region in regions.values()])
+    log.info(f'contrast floor: {contrast_floor[0]}')
 
-    ### Generating the PASTIS matrix and a list for all contrasts
-    matrix_direct = np.zeros([nb_seg, nb_seg])   # Generate empty matrix
+    ### Generating the PASTIS matrices and a list for all contrasts
+    matrix_direct = np.zeros([len(regions), nb_seg, nb_seg])   # Generate empty matrix per region
     all_psfs = []
     all_contrasts = []
 
@@ -309,13 +387,12 @@ def num_matrix_luvoir(design, savepsfs=False, saveopds=True):
                 plt.savefig(os.path.join(resDir, 'OTE_images', opd_name + '.pdf'))
 
             log.info('Calculating mean contrast in dark hole')
-            dh_intensity = psf * dh_mask
-            contrast = np.mean(dh_intensity[np.where(dh_mask != 0)])
-            log.info(f'contrast: {float(contrast)}')    # contrast is a Field, here casting to normal float
+            contrast = np.array([util.dh_mean(psf, region) for region in regions.values()])
+            log.info(f'contrast: {contrast[0]}')
             all_contrasts.append(contrast)
 
-            # Fill according entry in the matrix and subtract baseline contrast
-            matrix_direct[i,j] = contrast - contrast_floor
+            # Fill according entry in the matrices and subtract baseline contrast
+            matrix_direct[:, i, j] = contrast - contrast_floor
 
     # Transform saved lists to arrays
     all_psfs = np.array(all_psfs)
@@ -323,37 +400,369 @@ def num_matrix_luvoir(design, savepsfs=False, saveopds=True):
 
     # Save the PSF image *cube* as well (as opposed to each one individually)
     hc.write_fits(all_psfs, os.path.join(resDir, 'psfs', 'psf_cube' + '.fits'),)
-    np.savetxt(os.path.join(resDir, 'pair-wise_contrasts.txt'), all_contrasts, fmt='%e')
 
-    # Filling the off-axis elements
-    matrix_two_N = np.copy(matrix_direct)      # This is just an intermediary copy so that I don't mix things up.
-    matrix_pastis = np.copy(matrix_direct)     # This will be the final PASTIS matrix.
+    # Fill the off-axis elements and normalize the matrices for the input aberration - this defines what units the
+    # PASTIS matrix will be in. The PASTIS matrix propagation function (util.pastis_contrast()) then needs to take in
+    # the aberration vector in these same units. I have chosen to keep this to 1nm, so, we normalize the PASTIS matrix
+    # to units of nanometers.
+    filename_matrix = 'PASTISmatrix_num_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index)
+    header = _matrix_config_header(luvoir, wfe_aber, zern_mode, propagation='calc_psf', wavelengths=[luvoir.wvln])
+    for k, name in enumerate(regions):
+        suffix = _region_suffix(name)
+        np.savetxt(os.path.join(resDir, 'pair-wise_contrasts' + suffix + '.txt'), all_contrasts[:, k], fmt='%e')
+        matrix_pastis = _pastis_matrix_from_contrasts(matrix_direct[k], wfe_aber)
 
-    for i in range(nb_seg):
-        for j in range(nb_seg):
-            if i != j:
-                matrix_off_val = (matrix_two_N[i,j] - matrix_two_N[i,i] - matrix_two_N[j,j]) / 2.
-                matrix_pastis[i,j] = matrix_off_val
-                log.info(f'Off-axis for i{i+1}-j{j+1}: {matrix_off_val}')
+        # Save matrix to file
+        util.write_fits(matrix_pastis, os.path.join(resDir, filename_matrix + suffix + '.fits'), header=header)
+        log.info(f'Matrix saved to: {os.path.join(resDir, filename_matrix + suffix + ".fits")}')
+
+    # Tell us how long it took to finish.
+    end_time = time.time()
+    log.info(f'Runtime for matrix_building.py: {end_time - start_time}sec = {(end_time - start_time) / 60}min')
+    log.info(f'Data saved to {resDir}')
+    
+    return overall_dir
 
-    # Normalize matrix for the input aberration - this defines what units the PASTIS matrix will be in. The PASTIS
-    # matrix propagation function (util.pastis_contrast()) then needs to take in the aberration vector in these same
-    # units. I have chosen to keep this to 1nm, so, we normalize the PASTIS matrix to units of nanometers.
-    matrix_pastis /= np.square(wfe_aber * 1e9)    #  1e9 converts the calibration aberration back to nanometers
 
-    # Save matrix to file
+def num_matrix_luvoir_broadband(design, batch_size=16, annuli=(), halves=False, masks=None):
+    """
+    Generate a bandwidth-integrated numerical PASTIS matrix for a LUVOIR A coronagraph.
+
+    The wavelengths are set by 'lambda', 'bandwidth' and 'nb_wavelengths' in the LUVOIR section of the configfile.
+    All segment pairs are propagated with LuvoirAPLC.calc_region_contrasts(), which only calculates the contrasts
+    in the dark hole and the additional focal plane regions and propagates the wavelengths in parallel threads, so no
+    PSFs are saved. The matrices of the additional regions are saved with the region name appended to the file names.
+    :param design: string, what coronagraph design to use - 'small', 'medium' or 'large'
+    :param batch_size: int, number of segment pairs propagated together
+    :param annuli: list of (float, float), radial annuli in lambda/D to build additional matrices for
+    :param halves: bool, whether to build additional matrices for the halves of the dark hole
+    :param masks: dict, region name: boolean mask on the focal plane, user regions to build additional matrices for
+    :return: overall_dir: string, experiment directory
+    """
+
+    # Keep track of time
+    start_time = time.time()
+
+    ### Parameters
+
+    # System parameters
+    overall_dir = util.create_data_path(CONFIG_INI.get('local', 'local_data_path'), telescope='luvoir-'+design)
+    os.makedirs(overall_dir, exist_ok=True)
+    resDir = os.path.join(overall_dir, 'matrix_numerical')
+    os.makedirs(resDir, exist_ok=True)
+
+    # Set up logger
+    util.setup_pastis_logging(resDir, f'pastis_matrix_{design}')
+    log.info('Building broadband numerical matrix for LUVOIR\n')
+
+    # Read calibration aberration
+    zern_number = CONFIG_INI.getint('calibration', 'local_zernike')
+    zern_mode = util.ZernikeMode(zern_number)                       # Create Zernike mode object for easier handling
+
+    # General telescope parameters
+    nb_seg = CONFIG_INI.getint('LUVOIR', 'nb_subapertures')
+    wfe_aber = CONFIG_INI.getfloat('calibration', 'calibration_aberration') * 1e-9   # m
+    sampling = CONFIG_INI.getfloat('numerical', 'sampling')
+
+    #  Copy configfile to resulting matrix directory
+    util.copy_config(resDir)
+
+    ### Instantiate Luvoir telescope with chosen apodizer design
+    optics_input = CONFIG_INI.get('LUVOIR', 'optics_path')
+    luvoir = LuvoirAPLC(optics_input, design, sampling)
+    log.info(f'LUVOIR apodizer design: {design}')
+    log.info(f'Wavelengths: {luvoir.wavelengths} m')
+
+    ### Segment states: unaberrated, then all pairs i <= j with the calibration aberration (OPD) in piston
+    pairs_i, pairs_j = np.triu_indices(nb_seg)
+    coefs = np.zeros([len(pairs_i) + 1, nb_seg, 3])
+    coefs[np.arange(1, len(pairs_i) + 1), pairs_i, 0] = wfe_aber / 2
+    coefs[np.arange(1, len(pairs_i) + 1), pairs_j, 0] = wfe_aber / 2
+
+    ### Focal plane regions, the dark hole and the additional ones
+    regions = luvoir.dark_hole_regions(annuli, halves, masks)
+    _save_dark_hole_regions(regions, resDir)
+
+    log.info(f'Propagating {coefs.shape[0]} segment states at {len(luvoir.wavelengths)} wavelengths')
+    region_contrasts = luvoir.calc_region_contrasts(coefs, regions, batch_size=batch_size,
+                                                    workers=len(luvoir.wavelengths))
+    log.info(f'contrast floor: {region_contrasts["dh"][0]}')
+
+    ### Generating the PASTIS matrix of each region
     filename_matrix = 'PASTISmatrix_num_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index)
-    hc.write_fits(matrix_pastis, os.path.join(resDir, filename_matrix + '.fits'))
-    log.info(f'Matrix saved to: {os.path.join(resDir, filename_matrix + ".fits")}')
+    header = _matrix_config_header(luvoir, wfe_aber, zern_mode, propagation='calc_region_contrasts',
+                                   wavelengths=list(luvoir.wavelengths), single_precision=luvoir.single_precision,
+                                   crop_pupil=luvoir.crop_pupil)
+    for name, all_contrasts in region_contrasts.items():
+        suffix = _region_suffix(name)
+        contrast_floor = all_contrasts[0]
+        matrix_direct = np.zeros([nb_seg, nb_seg])
+        matrix_direct[pairs_i, pairs_j] = all_contrasts[1:] - contrast_floor
+        matrix_direct[pairs_j, pairs_i] = all_contrasts[1:] - contrast_floor
+
+        # Contrasts of all N^2 segment pairs (i, j), in the same layout as num_matrix_luvoir()
+        pair_contrasts = np.zeros([nb_seg, nb_seg])
+        pair_contrasts[pairs_i, pairs_j] = all_contrasts[1:]
+        pair_contrasts[pairs_j, pairs_i] = all_contrasts[1:]
+        np.savetxt(os.path.join(resDir, 'pair-wise_contrasts' + suffix + '.txt'), pair_contrasts.ravel(), fmt='%e')
+
+        # Filling the off-axis elements and normalizing to units of nanometers like num_matrix_luvoir()
+        matrix_pastis = _pastis_matrix_from_contrasts(matrix_direct, wfe_aber)
+
+        # Save matrix to file
+        util.write_fits(matrix_pastis, os.path.join(resDir, filename_matrix + suffix + '.fits'), header=header)
+        log.info(f'Matrix saved to: {os.path.join(resDir, filename_matrix + suffix + ".fits")}')
 
     # Tell us how long it took to finish.
     end_time = time.time()
     log.info(f'Runtime for matrix_building.py: {end_time - start_time}sec = {(end_time - start_time) / 60}min')
     log.info(f'Data saved to {resDir}')
-    
+
+    return overall_dir
+
+
+def num_matrix_luvoir_multimode(design, modes=('piston', 'tip', 'tilt'), batch_size=16, annuli=(), halves=False,
+                                masks=None):
+    """
+    Generate a numerical PASTIS matrix for several local segment modes (piston, tip, tilt) of a LUVOIR A coronagraph.
+
+    Every local mode of every segment is poked once with the calibration aberration (in rms OPD), so the number of
+    propagations is linear in the number of modes. The off-diagonal elements are the overlaps of the dark hole E-field
+    changes of two pokes, which is what the pair-wise poking of num_matrix_luvoir() measures for small aberrations.
+    The diagonal elements are the single-poke contrasts minus the coronagraph floor, like in num_matrix_luvoir().
+
+    The matrix is ordered by mode first, then by segment, so the aberration vector for util.pastis_contrast() is
+    [nmodes*nseg] in nm rms OPD. It is saved as a whole, as blocks per pair of local modes [nmodes, nmodes, nseg, nseg]
+    (see util.matrix_blocks()), and the diagonal blocks are saved as single-mode matrices with '_block_<mode>' appended
+    to the file name. All of them have the configuration hash and the band in their header, and their local modes.
+    Additional matrices for other focal plane regions come from the same dark hole E-fields, propagated onto the union
+    of all regions, and are saved with the region name appended to the file names.
+    :param design: string, what coronagraph design to use - 'small', 'medium' or 'large'
+    :param modes: tuple of str, local modes out of 'piston', 'tip' and 'tilt'
+    :param batch_size: int, number of segment states propagated together
+    :param annuli: list of (float, float), radial annuli in lambda/D to build additional matrices for
+    :param halves: bool, whether to build additional matrices for the halves of the dark hole
+    :param masks: dict, region name: boolean mask on the focal plane, user regions to build additional matrices for
+    :return: overall_dir: string, experiment directory
+    """
+
+    # Keep track of time
+    start_time = time.time()
+
+    ### Parameters
+
+    # System parameters
+    overall_dir = util.create_data_path(CONFIG_INI.get('local', 'local_data_path'), telescope='luvoir-'+design)
+    os.makedirs(overall_dir, exist_ok=True)
+    resDir = os.path.join(overall_dir, 'matrix_numerical')
+    os.makedirs(resDir, exist_ok=True)
+
+    # Set up logger
+    util.setup_pastis_logging(resDir, f'pastis_matrix_{design}')
+    log.info(f'Building multi-mode numerical matrix for LUVOIR, local modes: {modes}\n')
+
+    # General telescope parameters
+    nb_seg = CONFIG_INI.getint('LUVOIR', 'nb_subapertures')
+    wfe_aber = CONFIG_INI.getfloat('calibration', 'calibration_aberration') * 1e-9   # m
+    sampling = CONFIG_INI.getfloat('numerical', 'sampling')
+    nb_modes = len(modes)
+
+    #  Copy configfile to resulting matrix directory
+    util.copy_config(resDir)
+
+    ### Instantiate Luvoir telescope with chosen apodizer design
+    optics_input = CONFIG_INI.get('LUVOIR', 'optics_path')
+    luvoir = LuvoirAPLC(optics_input, design, sampling)
+
+    ### Segment states: unaberrated, then each local mode on each segment
+    coefs = np.zeros([nb_modes * nb_seg + 1, nb_seg, 3])
+    for k in range(nb_modes * nb_seg):
+        aber = np.zeros(nb_modes * nb_seg)
+        aber[k] = wfe_aber
+        coefs[k + 1] = luvoir.modal_aber_to_coef(aber, modes)
+
+    ### Focal plane regions, the dark hole and the additional ones, all propagated at once onto their union
+    regions = luvoir.dark_hole_regions(annuli, halves, masks)
+    _save_dark_hole_regions(regions, resDir)
+    union_mask, positions = dark_hole_union(regions)
+
+    log.info(f'Propagating {coefs.shape[0]} segment states at {len(luvoir.wavelengths)} wavelength(s)')
+    efields_union = luvoir.calc_efield_batch(coefs, dh_mask=hc.Field(union_mask, luvoir.focal_det),
+                                             batch_size=batch_size, workers=len(luvoir.wavelengths))
+
+    header = _matrix_config_header(luvoir, wfe_aber, None, propagation='calc_efield_batch', modes=list(modes),
+                                   wavelengths=list(luvoir.wavelengths), single_precision=luvoir.single_precision,
+                                   crop_pupil=luvoir.crop_pupil)
+    header['MODES'] = (','.join(modes), 'local modes, outer index of the matrix')
+    header['NSEG'] = (nb_seg, 'number of segments, inner index of the matrix')
+    filename_matrix = 'PASTISmatrix_num_multimode_' + '-'.join(modes)
+
+    for name, region_pos in positions.items():
+        suffix = _region_suffix(name)
+        efields = efields_union[:, :, region_pos]
+        all_contrasts = np.mean(np.sum(np.abs(efields)**2, axis=0), axis=1)
+        contrast_floor = all_contrasts[0]
+        log.info(f'contrast floor{suffix}: {contrast_floor}')
+        np.savetxt(os.path.join(resDir, 'single-mode_contrasts' + suffix + '.txt'), all_contrasts[1:], fmt='%e')
+
+        ### Generating the PASTIS matrix from the E-field changes of all pokes
+        matrix_pastis = np.zeros([nb_modes * nb_seg, nb_modes * nb_seg])
+        for efields_wvln in efields:
+            delta_efields = efields_wvln[1:] - efields_wvln[0]
+            matrix_pastis += np.real(delta_efields.conj().dot(delta_efields.T)) / efields.shape[2]
+        np.fill_diagonal(matrix_pastis, all_contrasts[1:] - contrast_floor)
+
+        # Normalize matrix for the input aberration, to units of nanometers like num_matrix_luvoir()
+        matrix_pastis /= np.square(wfe_aber * 1e9)
+
+        # Save matrix, its blocks and the single-mode matrices on the diagonal to file
+        util.write_fits(matrix_pastis, os.path.join(resDir, filename_matrix + suffix + '.fits'), header=header)
+        blocks = util.matrix_blocks(matrix_pastis, nb_modes)
+        util.write_fits(blocks, os.path.join(resDir, filename_matrix + '_blocks' + suffix + '.fits'), header=header)
+
+        for i, mode in enumerate(modes):
+            header_block = header.copy()
+            header_block['MODES'] = (mode, 'local mode of this diagonal block')
+            util.write_fits(blocks[i, i], os.path.join(resDir, filename_matrix + '_block_' + mode + suffix + '.fits'),
+                            header=header_block)
+
+        log.info(f'Matrix saved to: {os.path.join(resDir, filename_matrix + suffix + ".fits")}')
+
+    # Tell us how long it took to finish.
+    end_time = time.time()
+    log.info(f'Runtime for matrix_building.py: {end_time - start_time}sec = {(end_time - start_time) / 60}min')
+    log.info(f'Data saved to {resDir}')
+
     return overall_dir
 
 
+def update_matrix_luvoir(matrix_dir, design, segments):
+    """
+    Recompute the rows and columns of changed segments in an existing numerical LUVOIR piston PASTIS matrix.
+
+    Only the coronagraph floor, the single pokes of the changed segments and their pairs with all other segments are
+    propagated, which is about len(segments) * nseg propagations instead of nseg^2. They use the same propagation and
+    normalization as num_matrix_luvoir(): one monochromatic LuvoirAPLC.calc_psf() per segment state, normalized by the
+    maximum of the reference PSF. The diagonal elements of the unchanged segments, needed for the off-diagonal
+    elements, are taken from the existing matrix, so the configuration hash in its header has to match the current
+    configfile. The matrices of all focal plane regions of the existing matrix (see num_matrix_luvoir()) are updated
+    from the same propagations. The updated matrices are saved in a new experiment directory, with the original matrix
+    and the updated segments recorded in their headers and in a provenance file.
+    :param matrix_dir: string, experiment directory of the existing matrix (containing 'matrix_numerical')
+    :param design: string, what coronagraph design to use - 'small', 'medium' or 'large'
+    :param segments: list of int, indices of the changed segments, starting at 0
+    :return: overall_dir: string, experiment directory of the updated matrix
+    """
+
+    # Keep track of time
+    start_time = time.time()
+
+    # Read calibration aberration
+    zern_number = CONFIG_INI.getint('calibration', 'local_zernike')
+    zern_mode = util.ZernikeMode(zern_number)                       # Create Zernike mode object for easier handling
+    filename_matrix = 'PASTISmatrix_num_' + zern_mode.name + '_' + zern_mode.convention + str(zern_mode.index)
+    wfe_aber = CONFIG_INI.getfloat('calibration', 'calibration_aberration') * 1e-9   # m
+    sampling = CONFIG_INI.getfloat('numerical', 'sampling')
+
+    # The existing matrix is monochromatic like num_matrix_luvoir(), broadband matrices have to be rebuilt
+    nb_wavelengths = CONFIG_INI.getint('LUVOIR', 'nb_wavelengths', fallback=1)
+    if nb_wavelengths > 1:
+        raise ValueError(f'update_matrix_luvoir() updates monochromatic matrices, but nb_wavelengths = {nb_wavelengths}.'
+                         f' Rebuild broadband matrices with num_matrix_luvoir_broadband().')
+
+    ### Instantiate Luvoir telescope with chosen apodizer design
+    optics_input = CONFIG_INI.get('LUVOIR', 'optics_path')
+    luvoir = LuvoirAPLC(optics_input, design, sampling)
+
+    # Existing matrices of all focal plane regions, in contrast units, built with the same configuration
+    parent_dir = os.path.join(matrix_dir, 'matrix_numerical')
+    regions = _read_dark_hole_regions(parent_dir, luvoir.focal_det)
+    if regions is None:
+        regions = {'dh': luvoir.dark_hole}
+    header = _matrix_config_header(luvoir, wfe_aber, zern_mode, propagation='calc_psf', wavelengths=[luvoir.wvln])
+    matrices = []
+    for name in regions:
+        parent_path = os.path.join(parent_dir, filename_matrix + _region_suffix(name) + '.fits')
+        matrix_pastis, parent_header = fits.getdata(parent_path, header=True)
+        if parent_header.get('CFGHASH') != header['CFGHASH']:
+            raise ValueError(f'{parent_path} was not built with the current configuration (CFGHASH '
+                             f'{parent_header.get("CFGHASH")} instead of {header["CFGHASH"]}), it has to be rebuilt.')
+        matrices.append(matrix_pastis * np.square(wfe_aber * 1e9))
+    matrices = np.array(matrices)
+    parent_path = os.path.join(parent_dir, filename_matrix + '.fits')
+    nb_seg = matrices.shape[1]
+    segments = sorted(set(segments))
+
+    # Output directories
+    overall_dir = util.create_data_path(CONFIG_INI.get('local', 'local_data_path'), telescope='luvoir-'+design)
+    resDir = os.path.join(overall_dir, 'matrix_numerical')
+    os.makedirs(resDir, exist_ok=True)
+
+    util.setup_pastis_logging(resDir, f'pastis_matrix_{design}')
+    log.info(f'Updating numerical matrix {parent_path} for segments {[seg + 1 for seg in segments]}\n')
+    log.info(f'Focal plane regions: {list(regions)}')
+    util.copy_config(resDir)
+    _save_dark_hole_regions(regions, resDir)
+
+    ### Reference image for contrast normalization and coronagraph floor
+    luvoir.flatten()
+    unaberrated_coro_psf, ref = luvoir.calc_psf(ref=True, display_intermediate=False, return_intermediate=False)
+    norm = np.max(ref)
+    contrast_floor = np.array([util.dh_mean(unaberrated_coro_psf, region) / norm for region in regions.values()])
+    log.info(f'contrast floor: {contrast_floor[0]}')
+
+    ### Segment pairs: single pokes of the changed segments, then all their new pairs
+    pairs = [(k, k) for k in segments]
+    pairs += [(k, j) for k in segments for j in range(nb_seg) if j != k and not (j in segments and j < k)]
+
+    log.info(f'Propagating {len(pairs) + 1} segment states')
+    all_contrasts = []
+    for k, j in pairs:
+        luvoir.flatten()
+        luvoir.set_segment(k+1, wfe_aber/2, 0, 0)
+        if k != j:
+            luvoir.set_segment(j+1, wfe_aber/2, 0, 0)
+
+        image, inter = luvoir.calc_psf(ref=False, display_intermediate=False, return_intermediate='intensity')
+        all_contrasts.append([util.dh_mean(image / norm, region) for region in regions.values()])
+    all_contrasts = np.array(all_contrasts) - contrast_floor
+
+    header['PARENT'] = (os.path.basename(os.path.normpath(matrix_dir)), 'experiment of the updated matrix')
+    header['UPDSEGS'] = (','.join(str(seg + 1) for seg in segments), 'recomputed segments, starting at 1')
+    for r, name in enumerate(regions):
+        matrix_pastis = matrices[r]
+
+        # Diagonal: new single pokes for the changed segments, existing values for all others
+        diag = np.diag(matrix_pastis).copy()
+        for n, (k, j) in enumerate(pairs[:len(segments)]):
+            diag[k] = all_contrasts[n, r]
+        matrix_pastis[segments, segments] = diag[segments]
+
+        # Off-diagonal elements of the changed rows and columns
+        for n, (k, j) in enumerate(pairs[len(segments):], start=len(segments)):
+            matrix_off_val = (all_contrasts[n, r] - diag[k] - diag[j]) / 2.
+            matrix_pastis[k, j] = matrix_off_val
+            matrix_pastis[j, k] = matrix_off_val
+
+        # Normalize matrix for the input aberration like num_matrix_luvoir()
+        matrix_pastis /= np.square(wfe_aber * 1e9)
+
+        # Save matrix to file, with its configuration and provenance
+        util.write_fits(matrix_pastis, os.path.join(resDir, filename_matrix + _region_suffix(name) + '.fits'),
+                        header=header)
+    with open(os.path.join(resDir, 'provenance.txt'), 'w') as f:
+        f.write(f'Updated from: {parent_path}\n')
+        f.write(f'Recomputed segments (starting at 1): {[seg + 1 for seg in segments]}\n')
+        f.write(f'Number of propagations: {len(pairs) + 1}\n')
+    log.info(f'Matrix saved to: {os.path.join(resDir, filename_matrix + ".fits")}')
+
+    # Tell us how long it took to finish.
+    end_time = time.time()
+    log.info(f'Runtime for matrix_building.py: {end_time - start_time}sec = {(end_time - start_time) / 60}min')
+    log.info(f'Data saved to {resDir}')
+
+    return overall_dir
+
 if __name__ == '__main__':
 
         # Pick the function of the telescope you want to run
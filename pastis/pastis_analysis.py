@@ -4,6 +4,7 @@ This is a module that lets you do a full PASTIS WFE requirement analysis from a
 Currently supports only LUVOIR.
 """
 import os
+import multiprocessing
 import time
 import numpy as np
 from astropy.io import fits
@@ -12,28 +13,76 @@ import logging
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 import hcipy as hc
-from hcipy.optics.segmented_mirror import SegmentedMirror
 
 from config import CONFIG_INI
 from e2e_simulators.luvoir_imaging import LuvoirAPLC
 import plotting as ppl
+from shared_arrays import SharedArrayStore
 import util_pastis as util
 
 log = logging.getLogger(__name__)
 
+# Simulator and shared arrays of a Monte Carlo worker process, set up by _setup_monte_carlo_worker()
+_mc_luvoir = None
+_mc_store = None
 
-def modes_from_matrix(datadir, saving=True):
+
+def matrix_local_modes(header):
+    """
+    Read the local segment modes of a PASTIS matrix from its fits header.
+    :param header: astropy.io.fits.Header of the matrix file
+    :return: tuple of str, local modes of the matrix, piston only for matrices without a MODES keyword
+    """
+    if 'MODES' in header:
+        return tuple(header['MODES'].split(','))
+    return ('piston',)
+
+
+def set_matrix_band(luvoir, header):
+    """
+    Set the wavelengths of the simulator to the band a numerical LUVOIR PASTIS matrix is built over, so that all E2E
+    contrasts of an analysis are calculated over the same band as the matrix.
+    :param luvoir: LuvoirAPLC
+    :param header: astropy.io.fits.Header of the matrix file, matrices without an NBWAVES keyword are monochromatic
+    """
+    nb_wavelengths = header.get('NBWAVES', 1)
+    if nb_wavelengths == 1:
+        luvoir.wavelengths = [luvoir.wvln]
+        return
+
+    bandwidth = (max(luvoir.wavelengths) - min(luvoir.wavelengths)) / luvoir.wvln
+    if nb_wavelengths != len(luvoir.wavelengths) or not np.isclose(bandwidth, header['BANDWID']):
+        raise ValueError(f'The matrix is integrated over {nb_wavelengths} wavelengths in a fractional bandwidth of '
+                         f'{header["BANDWID"]}, the simulator over {len(luvoir.wavelengths)} in {bandwidth}. Set '
+                         f'nb_wavelengths and bandwidth in the configfile to the ones of the matrix.')
+
+
+def coronagraph_floor(luvoir, dh_mask=None):
+    """
+    Calculate the mean dark hole contrast of the flat segmented mirror, over the wavelengths of the simulator.
+    :param luvoir: LuvoirAPLC
+    :param dh_mask: hcipy.Field, dark hole mask, default is luvoir.dh_mask
+    :return: float, coronagraph floor
+    """
+    return luvoir.calc_psf_batch(np.zeros((1,) + luvoir.sm.coef.shape), dh_mask)[0]
+
+
+def modes_from_matrix(datadir, saving=True, matrix_name='PASTISmatrix_num_piston_Noll1'):
     """
     Calculate mode basis and singular values from PASTIS matrix using an SVD. In the case of the PASTIS matrix,
     this is equivalent to using an eigendecomposition, because the matrix is symmetric. Note how the SVD orders the
     modes and singular values in reverse order conpared to an eigendecomposition.
     :param datadir: string, path to overall data directory containing matrix and results folder
     :param saving: string, whether to save singular values, modes and their plots or not; default=True
-    :return: pastis modes (which are the singular vectors/eigenvectors), singular values/eigenvalues
+    :param matrix_name: string, file name of the matrix without extension, e.g. a multi-mode matrix from
+                        matrix_building_numerical.num_matrix_luvoir_multimode(); default is the piston matrix
+    :return: pastis modes (which are the singular vectors/eigenvectors), singular values/eigenvalues,
+             tuple of the local segment modes the matrix is made of
     """
 
     # Read matrix
-    matrix = fits.getdata(os.path.join(datadir, 'matrix_numerical', 'PASTISmatrix_num_piston_Noll1.fits'))
+    matrix, header = fits.getdata(os.path.join(datadir, 'matrix_numerical', matrix_name + '.fits'), header=True)
+    modes = matrix_local_modes(header)
 
     # Get singular modes and values from SVD
     pmodes, svals, vh = np.linalg.svd(matrix, full_matrices=True)
@@ -52,7 +101,7 @@ def modes_from_matrix(datadir, saving=True):
         ppl.plot_eigenvalues(svals, nseg=svals.shape[0], wvln=CONFIG_INI.getfloat('LUVOIR', 'lambda'),
                              out_dir=os.path.join(datadir, 'results'), save=True)
 
-    return pmodes, svals
+    return pmodes, svals, modes
 
 
 def modes_from_file(datadir):
@@ -68,27 +117,29 @@ def modes_from_file(datadir):
     return pmodes, svals
 
 
-def full_modes_from_themselves(pmodes, datadir, sm, wf_aper, saving=False):
+def full_modes_from_themselves(pmodes, datadir, luvoir, modes=('piston',), saving=False):
     """
     Put all modes onto the segmented mirror in the pupil and get full 2D pastis modes.
 
-    Take the pmodes array of all modes (shape [segnum, modenum] = [nseg, nseg]) and apply them onto a segmented mirror
-    in the pupil. This phase gets returned both as an array of hcipy.Fields, as well as a standard array of 2D arrays.
-    Optionally, save a PDF displaying all modes, a fits cube and individual PDF images.
+    Take the pmodes array of all modes (shape [segnum, modenum] = [nmodes*nseg, nmodes*nseg]) and apply them onto the
+    segmented mirror of the simulator. This phase gets returned both as an array of hcipy.Fields, as well as a standard
+    array of 2D arrays. Optionally, save a PDF displaying all modes, a fits cube and individual PDF images.
     :param pmodes: array of PASTIS modes [segnum, modenum]
     :param datadir: string, path to overall data directory containing matrix and results folder
+    :param luvoir: LuvoirAPLC
+    :param modes: tuple of str, local segment modes the PASTIS modes are made of, default is piston only
     :param saving: bool, whether to save figure to disk or not, default=False
     :return: all_modes as array of Fields, mode_cube as array of 2D arrays (hcipy vs matplotlib)
     """
 
-    nseg = pmodes.shape[0]
+    nmodes = pmodes.shape[1]
 
     ### Put all modes sequentially on the segmented mirror and get them as a phase map, then convert to WFE map
     all_modes = []
-    for thismode in range(nseg):
-        log.info(f'Working on mode {thismode + 1}/{nseg}.')
+    for thismode in range(nmodes):
+        log.info(f'Working on mode {thismode + 1}/{nmodes}.')
 
-        wf_sm = apply_mode_to_sm(pmodes[:, thismode], sm, wf_aper)
+        wf_sm = apply_mode_to_luvoir(pmodes[:, thismode], luvoir, modes)
         all_modes.append(wf_sm.phase / wf_sm.wavenumber)    # wf.phase is in rad, so this converts it to meters
 
     ### Check for results directory structure and create if it doesn't exist
@@ -104,17 +155,18 @@ def full_modes_from_themselves(pmodes, datadir, sm, wf_aper, saving=False):
     ### Plot all modes together and save
     if saving:
         log.info('Saving all PASTIS modes...')
-        plt.figure(figsize=(36, 30))
-        for thismode in range(nseg):
-            plt.subplot(12, 10, thismode + 1)
+        nrows = int(np.ceil(nmodes / 10))
+        plt.figure(figsize=(36, 2.5 * nrows))
+        for thismode in range(nmodes):
+            plt.subplot(nrows, 10, thismode + 1)
             hc.imshow_field(all_modes[thismode], cmap='RdBu')
             plt.axis('off')
             plt.title(f'Mode {thismode + 1}')
-        plt.savefig(os.path.join(datadir, 'results', 'modes', 'modes_piston.pdf'))
+        plt.savefig(os.path.join(datadir, 'results', 'modes', 'modes_' + '-'.join(modes) + '.pdf'))
 
     ### Plot them individually and save as fits and pdf
     mode_cube = []  # to save as a fits cube
-    for thismode in range(nseg):
+    for thismode in range(nmodes):
 
         # pdf
         plt.clf()
@@ -161,6 +213,22 @@ def apply_mode_to_sm(pmode, sm, wf_aper):
     return wf_sm
 
 
+def apply_mode_to_luvoir(pmode, luvoir, modes=('piston',)):
+    """
+    Apply a PASTIS mode of any local segment modes to the segmented mirror of a simulator and return the propagated
+    wavefront "through" the SM.
+    :param pmode: array, a single PASTIS mode [nmodes*nseg] or any other local segment aberrations in NANOMETERS,
+                  ordered by local mode first, then by segment
+    :param luvoir: LuvoirAPLC
+    :param modes: tuple of str, local segment modes of pmode, default is piston only
+    :return: wf_sm: hcipy.Wavefront of the segmented mirror propagation
+    """
+    luvoir.set_coef(luvoir.modal_aber_to_coef((np.asarray(pmode) * u.nm).to(u.m).value, modes))
+    wf_sm = luvoir.sm(luvoir.wf_aper)
+
+    return wf_sm
+
+
 def full_modes_from_file(datadir):
     """
     Read all modes into an array of hcipy.Fields and an array of 2D arrays.
@@ -199,7 +267,7 @@ def calculate_delta_sigma(cdyn, nmodes, svalue):
     return del_sigma
 
 
-def cumulative_contrast_e2e(pmodes, sigmas, luvoir, dh_mask, individual=False):
+def cumulative_contrast_e2e(pmodes, sigmas, luvoir, dh_mask, individual=False, modes=('piston',)):
     """
     Calculate the cumulative contrast or contrast per mode of a set of PASTIS modes with mode weights sigmas,
     using an E2E simulator.
@@ -208,29 +276,27 @@ def cumulative_contrast_e2e(pmodes, sigmas, luvoir, dh_mask, individual=False):
     :param luvoir: LuvoirAPLC
     :param dh_mask: hcipy.Field, dh_mask that goes together with the instance of the LUVOIR simulator
     :param individual: bool, if False (default), calculates cumulative contrast, if True, calculates contrast per mode
+    :param modes: tuple of str, local segment modes the PASTIS modes are made of, default is piston only
     :return: cont_cum_e2e, list of cumulative or individual contrasts
     """
 
-    cont_cum_e2e = []
+    # Segment aberrations of all (cumulative) modes
+    opds = np.zeros([pmodes.shape[0], pmodes.shape[0]])
     for maxmode in range(pmodes.shape[0]):
 
         if individual:
-            opd = pmodes[:, maxmode] * sigmas[maxmode]
+            opds[maxmode] = pmodes[:, maxmode] * sigmas[maxmode]
         else:
-            opd = np.nansum(pmodes[:, :maxmode+1] * sigmas[:maxmode+1], axis=1)
+            opds[maxmode] = np.nansum(pmodes[:, :maxmode+1] * sigmas[:maxmode+1], axis=1)
 
-        luvoir.flatten()
-        for seg, val in enumerate(opd):
-            val *= u.nm    # the LUVOIR modes come out in units of nanometers
-            luvoir.set_segment(seg + 1, val.to(u.m).value/2, 0, 0)
+    opds = (opds * u.nm).to(u.m).value    # the LUVOIR modes come out in units of nanometers
 
-        # Get PSF from putting this WFE on the simulator
-        psf, ref = luvoir.calc_psf(ref=True)
-        norm = ref.max()
-
-        # Calculate the contrast from that PSF
-        contrast = util.dh_mean(psf/norm, dh_mask)
-        cont_cum_e2e.append(contrast)
+    # Get the dark hole contrasts from putting these WFEs on the simulator
+    if tuple(modes) == ('piston',):
+        cont_cum_e2e = list(luvoir.calc_piston_contrast(opds, dh_mask))
+    else:
+        coefs = np.array([luvoir.modal_aber_to_coef(opd, modes) for opd in opds])
+        cont_cum_e2e = list(luvoir.calc_psf_batch(coefs, dh_mask))
 
     return cont_cum_e2e
 
@@ -287,12 +353,13 @@ def calculate_segment_constraints(pmodes, pastismatrix, c_target, coronagraph_fl
     return mu_map
 
 
-def calc_random_segment_configuration(luvoir, mus, dh_mask):
+def calc_random_segment_configuration(luvoir, mus, dh_mask, modes=('piston',)):
     """
     Calculate the PSF after applying a randomly weighted set of segment-based PASTIS constraints on the pupil.
     :param luvoir: LuvoirAPLC
     :param mus: array, segment-based PASTIS constraints in nm
     :param dh_mask: hcipy.Field, dark hole mask for PSF produced by LuvoirAPLC instance
+    :param modes: tuple of str, local segment modes of mus, default is piston only
     :return: random_map: list, random segment map used in this PSF calculation in m;
              rand_contrast: float, mean contrast of the calculated PSF
     """
@@ -304,35 +371,26 @@ def calc_random_segment_configuration(luvoir, mus, dh_mask):
 
     # Multiply each segment mu by one of these random numbers,
     # put that on the LUVOIR SM and calculate the PSF.
-    luvoir.flatten()
     random_map = []
-    for seg, (mu, randval) in enumerate(zip(mus, rand)):
+    for mu, randval in zip(mus, rand):
         random_seg = mu * randval
         random_map.append(random_seg.to(u.m).value)
-        luvoir.set_segment(seg+1, (random_seg).to(u.m).value/2, 0, 0)
-    psf, ref = luvoir.calc_psf(ref=True, display_intermediate=False)
-
-    # plt.figure()
-    # plt.subplot(1, 3, 1)
-    # hc.imshow_field(dh_mask)
-    # plt.subplot(1, 3, 2)
-    # hc.imshow_field(psf, norm=LogNorm(), mask=dh_mask)
-    # plt.subplot(1, 3, 3)
-    # hc.imshow_field(psf, norm=LogNorm())
-    # plt.show()
-
-    rand_contrast = util.dh_mean(psf / ref.max(), dh_mask)
+    if tuple(modes) == ('piston',):
+        rand_contrast = luvoir.calc_piston_contrast(random_map, dh_mask)
+    else:
+        rand_contrast = luvoir.calc_psf_batch(luvoir.modal_aber_to_coef(random_map, modes)[np.newaxis], dh_mask)[0]
 
     return random_map, rand_contrast
 
 
-def calc_random_mode_configurations(pmodes, luvoir, sigmas, dh_mask):
+def calc_random_mode_configurations(pmodes, luvoir, sigmas, dh_mask, modes=('piston',)):
     """
     Calculate the PSF after weighting the PASTIS modes with weights from a normal distribution with stddev = sigmas.
     :param pmodes: array, pastis mode matrix [nseg, nmodes]
     :param luvoir: LuvoirAPLC
     :param sigmas: array, mode-based PASTIS constraints
     :param dh_mask: hcipy.Field, dark hole mask for PSF produced by luvoir
+    :param modes: tuple of str, local segment modes the PASTIS modes are made of, default is piston only
     :return: random_weights: array, random weights used in this PSF calculation
              rand_contrast: float, mean contrast of the calculated PSF
     """
@@ -345,17 +403,90 @@ def calc_random_mode_configurations(pmodes, luvoir, sigmas, dh_mask):
     opd = np.nansum(pmodes[:, :] * random_weights, axis=1)
     opd *= u.nm
 
-    luvoir.flatten()
-    for seg, aber in enumerate(opd):
-        luvoir.set_segment(seg + 1, aber.to(u.m).value / 2, 0, 0)
-    psf, ref = luvoir.calc_psf(ref=True, display_intermediate=False)
-
-    rand_contrast = util.dh_mean(psf / ref.max(), dh_mask)
+    if tuple(modes) == ('piston',):
+        rand_contrast = luvoir.calc_piston_contrast(opd.to(u.m).value, dh_mask)
+    else:
+        coef = luvoir.modal_aber_to_coef(opd.to(u.m).value, modes)
+        rand_contrast = luvoir.calc_psf_batch(coef[np.newaxis], dh_mask)[0]
 
     return random_weights, rand_contrast
 
 
-def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat=100):
+def _setup_monte_carlo_worker(handle, cache_config):
+    """ Attach a Monte Carlo worker process to the shared optics, propagation and result buffers, and create its
+    simulator. """
+    global _mc_luvoir, _mc_store
+    _mc_store = SharedArrayStore.attach(handle)
+    _mc_luvoir = LuvoirAPLC(cache_config['input_dir'], cache_config['apod_design'], cache_config['sampling'],
+                            cache_config['pupil_px'], shared_store=_mc_store)
+    _mc_luvoir.attach_propagation(_mc_store)
+
+
+def _monte_carlo_realization(rep, seed, kind, constraints, modes):
+    """ Calculate one Monte Carlo realization on the simulator of a worker, into the shared result buffers. """
+    np.random.seed(seed)
+    if kind == 'modes':
+        draw, contrast = calc_random_mode_configurations(_mc_store.get('pmodes'), _mc_luvoir, constraints,
+                                                         _mc_luvoir.dh_mask, modes)
+    else:
+        draw, contrast = calc_random_segment_configuration(_mc_luvoir, constraints, _mc_luvoir.dh_mask, modes)
+    _mc_store.get('mc_draws')[rep] = draw
+    _mc_store.get('mc_contrasts')[rep] = contrast
+
+
+def monte_carlo_luvoir(luvoir, constraints, n_repeat, kind='segments', pmodes=None, modes=('piston',), processes=1):
+    """
+    Run an E2E Monte Carlo simulation with random mode weights or random segment aberrations.
+
+    With several processes, the optics of luvoir, the PASTIS modes and the result buffers are put into shared memory,
+    and each worker creates its simulator on zero-copy views of them instead of reading the optics files. The MFT
+    matrices and, for piston only, the segment basis are calculated once here and shared the same way.
+    :param luvoir: LuvoirAPLC
+    :param constraints: array, mode-based (sigmas) or segment-based (mus) PASTIS constraints
+    :param n_repeat: int, number of realizations
+    :param kind: str, 'modes' to draw mode weights from the sigmas, or 'segments' to draw segment aberrations from the mus
+    :param pmodes: array, PASTIS modes [nseg, nmodes], only for kind='modes'
+    :param modes: tuple of str, local segment modes, default is piston only
+    :param processes: int, number of worker processes
+    :return: draws: array [n_repeat, len(constraints)], random mode weights or segment aberrations in m;
+             contrasts: array [n_repeat], mean dark hole contrast of each realization
+    """
+    if processes <= 1:
+        draws = []
+        contrasts = []
+        for rep in range(n_repeat):
+            log.info(f'{kind.capitalize()[:-1]} realization {rep + 1}/{n_repeat}')
+            if kind == 'modes':
+                draw, contrast = calc_random_mode_configurations(pmodes, luvoir, constraints, luvoir.dh_mask, modes)
+            else:
+                draw, contrast = calc_random_segment_configuration(luvoir, constraints, luvoir.dh_mask, modes)
+            draws.append(draw)
+            contrasts.append(contrast)
+        return np.array(draws), np.array(contrasts)
+
+    log.info(f'Running {n_repeat} realizations on {processes} processes')
+    seeds = np.random.randint(0, 2**31 - 1, n_repeat)
+    with SharedArrayStore() as store:
+        luvoir.share_optics(store)
+        luvoir.share_propagation(store, segment_basis=tuple(modes) == ('piston',))
+        if kind == 'modes':
+            store.put('pmodes', pmodes)
+        store.empty('mc_draws', (n_repeat, len(constraints)))
+        store.empty('mc_contrasts', (n_repeat,))
+
+        with multiprocessing.Pool(processes, initializer=_setup_monte_carlo_worker,
+                                  initargs=(store.handle, luvoir.cache_config)) as pool:
+            pool.starmap(_monte_carlo_realization,
+                         [(rep, seed, kind, constraints, modes) for rep, seed in enumerate(seeds)])
+
+        draws = np.array(store.get('mc_draws'))
+        contrasts = np.array(store.get('mc_contrasts'))
+
+    return draws, contrasts
+
+
+def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat=100, processes=1,
+                                    matrix_name='PASTISmatrix_num_piston_Noll1'):
     """
     Run a full PASTIS analysis on a given PASTIS matrix.
 
@@ -374,6 +505,9 @@ def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat
     :param run_choice: str, path to data and where outputs will be saved
     :param c_target: float, target contrast
     :param n_repeat: number of realizations in both Monte Carlo simulations (modes and segments), default=100
+    :param processes: int, number of worker processes of the Monte Carlo simulations, default=1
+    :param matrix_name: string, file name of the matrix without extension, e.g. a multi-mode matrix from
+                        matrix_building_numerical.num_matrix_luvoir_multimode(); default is the piston matrix
     """
 
     # Which parts are we running?
@@ -393,51 +527,26 @@ def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat
     # LUVOIR coronagraph parameters
     sampling = CONFIG_INI.getfloat('numerical', 'sampling')
 
-    nseg = CONFIG_INI.getint('LUVOIR', 'nb_subapertures')
     wvln = CONFIG_INI.getfloat('LUVOIR', 'lambda') * 1e-9   # [m]
 
     log.info('Setting up optics...')
     log.info(f'Data folder: {workdir}')
     log.info(f'Coronagraph: {design}')
 
-    # Create SM
-    # Read pupil and indexed pupil
-    inputdir = CONFIG_INI.get('LUVOIR', 'optics_path')
-    aper_path = 'inputs/TelAp_LUVOIR_gap_pad01_bw_ovsamp04_N1000.fits'
-    aper_ind_path = 'inputs/TelAp_LUVOIR_gap_pad01_bw_ovsamp04_N1000_indexed.fits'
-    aper_read = hc.read_fits(os.path.join(inputdir, aper_path))
-    aper_ind_read = hc.read_fits(os.path.join(inputdir, aper_ind_path))
-
-    # Sample them on a pupil grid and make them hc.Fields
-    pupil_grid = hc.make_pupil_grid(dims=aper_ind_read.shape[0], diameter=15)
-    aper = hc.Field(aper_read.ravel(), pupil_grid)
-    aper_ind = hc.Field(aper_ind_read.ravel(), pupil_grid)
-
-    # Create the wavefront on the aperture
-    wf_aper = hc.Wavefront(aper, wvln)
-
-    # Load segment positions from fits header
-    hdr = fits.getheader(os.path.join(inputdir, aper_ind_path))
-    poslist = []
-    for i in range(nseg):
-        segname = 'SEG' + str(i + 1)
-        xin = hdr[segname + '_X']
-        yin = hdr[segname + '_Y']
-        poslist.append((xin, yin))
-    poslist = np.transpose(np.array(poslist))
-    seg_pos = hc.CartesianGrid(poslist)
-
-    # Instantiate segmented mirror
-    sm = SegmentedMirror(aper_ind, seg_pos)
-
     # Instantiate LUVOIR
     optics_input = CONFIG_INI.get('LUVOIR', 'optics_path')
     luvoir = LuvoirAPLC(optics_input, design, sampling)
 
-    # Generate reference PSF and coronagraph contrast floor
+    # Read the PASTIS matrix, the local segment modes it is made of and the band all E2E contrasts are calculated over
+    matrix, matrix_header = fits.getdata(os.path.join(workdir, 'matrix_numerical', matrix_name + '.fits'), header=True)
+    modes = matrix_local_modes(matrix_header)
+    log.info(f"Local segment modes: {', '.join(modes)}")
+    set_matrix_band(luvoir, matrix_header)
+    log.info(f'Wavelengths: {luvoir.wavelengths} m')
+
+    # Generate the unaberrated PSF at the central wavelength, for display
     luvoir.flatten()
-    psf_unaber, ref = luvoir.calc_psf(ref=True, display_intermediate=False)
-    norm = ref.max()
+    psf_unaber = luvoir.calc_psf(display_intermediate=False)
 
     plt.figure()
     plt.subplot(1, 3, 1)
@@ -451,22 +560,19 @@ def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat
     hc.imshow_field(psf_unaber, norm=LogNorm())
     plt.savefig(os.path.join(workdir, 'unaberrated_dh.pdf'))
 
-    # Calculate coronagraph floor
-    coro_floor = util.dh_mean(psf_unaber/norm, luvoir.dh_mask)
+    # Calculate coronagraph floor, over the band of the matrix
+    coro_floor = coronagraph_floor(luvoir)
     log.info(f'Coronagraph floor: {coro_floor}')
     with open(os.path.join(workdir, 'coronagraph_floor.txt'), 'w') as file:
         file.write(f'{coro_floor}')
 
-    # Read the PASTIS matrix
-    matrix = fits.getdata(os.path.join(workdir, 'matrix_numerical', 'PASTISmatrix_num_piston_Noll1.fits'))
-
     ### Calculate PASTIS modes and singular values/eigenvalues
     if calculate_modes:
         log.info('Calculating all PASTIS modes')
-        pmodes, svals = modes_from_matrix(workdir)
+        pmodes, svals, modes = modes_from_matrix(workdir, matrix_name=matrix_name)
 
         ### Get full 2D modes and save them
-        all_modes, mode_cube = full_modes_from_themselves(pmodes, workdir, sm, wf_aper, saving=True)
+        all_modes, mode_cube = full_modes_from_themselves(pmodes, workdir, luvoir, modes, saving=True)
 
     else:
         log.info(f'Reading PASTIS modes from {workdir}')
@@ -475,7 +581,7 @@ def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat
     ### Calculate mode-based static constraints
     if calculate_sigmas:
         log.info('Calculating static sigmas')
-        sigmas = calculate_sigma(c_target, nseg, svals, coro_floor)
+        sigmas = calculate_sigma(c_target, pmodes.shape[0], svals, coro_floor)
         np.savetxt(os.path.join(workdir, 'results', f'mode_requirements_{c_target}_uniform.txt'), sigmas)
 
         # Plot static mode constraints
@@ -495,13 +601,9 @@ def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat
         # Keep track of time
         start_monte_carlo_modes = time.time()
 
-        all_contr_rand_modes = []
-        all_random_weight_sets = []
-        for rep in range(n_repeat):
-            log.info(f'Mode realization {rep + 1}/{n_repeat}')
-            random_weights, one_contrast_mode = calc_random_mode_configurations(pmodes, luvoir, sigmas, luvoir.dh_mask)
-            all_random_weight_sets.append(random_weights)
-            all_contr_rand_modes.append(one_contrast_mode)
+        all_random_weight_sets, all_contr_rand_modes = monte_carlo_luvoir(luvoir, sigmas, n_repeat, kind='modes',
+                                                                          pmodes=pmodes, modes=modes,
+                                                                          processes=processes)
 
         # Empirical mean and standard deviation of the distribution
         mean_modes = np.mean(all_contr_rand_modes)
@@ -521,7 +623,7 @@ def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat
     ###  Calculate cumulative contrast plot with E2E simulator and matrix product
     if calc_cumulative_contrast:
         log.info('Calculating cumulative contrast plot, uniform contrast across all modes')
-        cumulative_e2e = cumulative_contrast_e2e(pmodes, sigmas, luvoir, luvoir.dh_mask)
+        cumulative_e2e = cumulative_contrast_e2e(pmodes, sigmas, luvoir, luvoir.dh_mask, modes=modes)
         cumulative_pastis = cumulative_contrast_matrix(pmodes, sigmas, matrix, coro_floor)
 
         np.savetxt(os.path.join(workdir, 'results', f'cumul_contrast_accuracy_e2e_{c_target}.txt'), cumulative_e2e)
@@ -543,12 +645,11 @@ def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat
         mus = calculate_segment_constraints(pmodes, matrix, c_target, coro_floor)
         np.savetxt(os.path.join(workdir, 'results', f'segment_requirements_{c_target}.txt'), mus)
 
-        # Put mus on SM and plot
-        wf_constraints = apply_mode_to_sm(mus, sm, wf_aper)
-
-        ppl.plot_segment_weights(mus, out_dir=os.path.join(workdir, 'results'), c_target=c_target, save=True)
+        # Plot mus per segment and as a map on the SM
+        ppl.plot_segment_weights(mus, out_dir=os.path.join(workdir, 'results'), c_target=c_target, modes=modes,
+                                 save=True)
         ppl.plot_mu_map(mus, wvln=CONFIG_INI.getfloat('LUVOIR', 'lambda'), out_dir=os.path.join(workdir, 'results'),
-                        design=design, c_target=c_target, save=True)
+                        design=design, c_target=c_target, modes=modes, save=True)
     else:
         log.info(f'Reading mus from {workdir}')
         mus = np.loadtxt(os.path.join(workdir, 'results', f'segment_requirements_{c_target}.txt'))
@@ -559,13 +660,8 @@ def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat
         # Keep track of time
         start_monte_carlo_seg = time.time()
 
-        all_contr_rand_seg = []
-        all_random_maps = []
-        for rep in range(n_repeat):
-            log.info(f'Segment realization {rep + 1}/{n_repeat}')
-            random_map, one_contrast_seg = calc_random_segment_configuration(luvoir, mus, luvoir.dh_mask)
-            all_random_maps.append(random_map)
-            all_contr_rand_seg.append(one_contrast_seg)
+        all_random_maps, all_contr_rand_seg = monte_carlo_luvoir(luvoir, mus, n_repeat, kind='segments',
+                                                                 modes=modes, processes=processes)
 
         # Empirical mean and standard deviation of the distribution
         mean_segments = np.mean(all_contr_rand_seg)
@@ -634,14 +730,15 @@ def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat
                                           alphas=(0.5, 1.), linestyles=('--', '-'), colors=('k', 'r'), save=True)
 
         # Calculate contrast per mode
-        per_mode_opt_e2e = cumulative_contrast_e2e(pmodes, sigmas_opt, luvoir, luvoir.dh_mask, individual=True)
+        per_mode_opt_e2e = cumulative_contrast_e2e(pmodes, sigmas_opt, luvoir, luvoir.dh_mask, individual=True,
+                                                   modes=modes)
         np.savetxt(os.path.join(workdir, 'results', f'contrast_per_mode_{c_target}_e2e_segment-based.txt'),
                    per_mode_opt_e2e)
         ppl.plot_contrast_per_mode(per_mode_opt_e2e, coro_floor, c_target, pmodes.shape[0],
                                    os.path.join(workdir, 'results'), save=True)
 
         # Calculate segment-based cumulative contrast
-        cumulative_opt_e2e = cumulative_contrast_e2e(pmodes, sigmas_opt, luvoir, luvoir.dh_mask)
+        cumulative_opt_e2e = cumulative_contrast_e2e(pmodes, sigmas_opt, luvoir, luvoir.dh_mask, modes=modes)
         np.savetxt(os.path.join(workdir, 'results', f'cumul_contrast_allocation_e2e_{c_target}_segment-based.txt'),
                    cumulative_opt_e2e)
 
@@ -650,12 +747,9 @@ def run_full_pastis_analysis_luvoir(design, run_choice, c_target=1e-10, n_repeat
                                                         c_target, fname_suffix='segment-based-vs-uniform', save=True)
 
     ### Apply mu map and run through E2E simulator
-    mus *= u.nm
-    luvoir.flatten()
-    for seg, mu in enumerate(mus):
-        luvoir.set_segment(seg+1, mu.to(u.m).value/2, 0, 0)
-    psf, ref = luvoir.calc_psf(ref=True, display_intermediate=True)
-    contrast_mu = util.dh_mean(psf/ref.max(), luvoir.dh_mask)
+    apply_mode_to_luvoir(mus, luvoir, modes)
+    luvoir.calc_psf(display_intermediate=True)
+    contrast_mu = luvoir.calc_psf_batch(np.array(luvoir.sm.coef)[np.newaxis])[0]   # over the band of the matrix
     log.info(f'Contrast with mu-map: {contrast_mu}')
 
     ###
@@ -4,16 +4,16 @@ Plotting functions for the PASTIS code.
 import os
 import hcipy as hc
 import matplotlib
-from matplotlib import cm
 import matplotlib.pyplot as plt
 from matplotlib.ticker import ScalarFormatter
 import numpy as np
 
 from config import CONFIG_INI
+import disk_cache
 from e2e_simulators.luvoir_imaging import LuvoirAPLC
-from pastis_analysis import apply_mode_to_sm
+import pastis_analysis
 
-cmap_brev = cm.get_cmap('Blues_r')
+cmap_brev = plt.get_cmap('Blues_r')
 
 
 def plot_pastis_matrix(pastis_matrix, wvln, out_dir, fname_suffix='', save=False):
@@ -137,6 +137,7 @@ def plot_mode_weights_simple(sigmas, wvln, out_dir, c_target, fname_suffix='', l
         sets = 1
     else:
         raise AttributeError('sigmas must be an array of values, or a tuple of such arrays.')
+    nmodes = len(sigmas[0]) if sets > 1 else len(sigmas)
 
     plt.figure(figsize=(12, 8))
     if sets == 1:
@@ -153,10 +154,11 @@ def plot_mode_weights_simple(sigmas, wvln, out_dir, c_target, fname_suffix='', l
         plt.legend(prop={'size': 20})
     plt.tight_layout()
 
-    plt.annotate(s='Low impact modes\n (high tolerance)', xy=(60, 2e-5), xytext=(67, 0.0024), color='black',
-                 fontweight='bold', size=25)
-    plt.annotate(s='High impact modes\n (low tolerance)', xy=(60, 2e-5), xytext=(3, 3.4e-5), color='black',
-                 fontweight='bold', size=25)
+    # Annotation positions scale with the number of modes, they were placed for the 120 LUVOIR-A piston modes
+    plt.annotate(s='Low impact modes\n (high tolerance)', xy=(nmodes / 2, 2e-5), xytext=(0.56 * nmodes, 0.0024),
+                 color='black', fontweight='bold', size=25)
+    plt.annotate(s='High impact modes\n (low tolerance)', xy=(nmodes / 2, 2e-5), xytext=(0.025 * nmodes, 3.4e-5),
+                 color='black', fontweight='bold', size=25)
 
     if save:
         plt.savefig(os.path.join(out_dir, '.'.join([fname, 'pdf'])))
@@ -351,13 +353,17 @@ def plot_covariance_matrix(covariance_matrix, out_dir, c_target, segment_space=T
         plt.savefig(os.path.join(out_dir, '.'.join([fname, 'pdf'])))
 
 
-def plot_segment_weights(mus, out_dir, c_target, labels=None, fname_suffix='', save=False):
+def plot_segment_weights(mus, out_dir, c_target, labels=None, modes=('piston',), fname_suffix='', save=False):
     """
     Plot segment weights against segment index, in units of picometers (converted from input).
-    :param mus: array or list, segment requirements in nm
+
+    For several local segment modes, the requirements of each local mode are plotted against the segment index in a
+    subplot of their own.
+    :param mus: array or list, segment requirements in nm, ordered by local mode first, then by segment
     :param out_dir: str, output path to save the figure to if save=True
     :param c_target: float, target contrast for which the mode weights have been calculated
     :param labels: tuple, optional, labels for the different lists of sigmas provided
+    :param modes: tuple of str, local segment modes of the mus, default is piston only
     :param fname_suffix: str, optional, suffix to add to the saved file name
     :param save: bool, whether to save to disk or not, default is False
     :return:
@@ -376,17 +382,24 @@ def plot_segment_weights(mus, out_dir, c_target, labels=None, fname_suffix='', s
     else:
         raise AttributeError('sigmas must be an array of values, or a tuple of such arrays.')
 
-    plt.figure(figsize=(12, 8))
-    if sets == 1:
-        plt.plot(mus * 1e3, lw=3, label=labels)   # 1e3 to convert from nm to pm
-    else:
-        for i in range(sets):
-            plt.plot(mus[i] * 1e3, lw=3, label=labels[i])
-    plt.xlabel('Segment number', size=30)
-    plt.ylabel('WFE requirements (pm)', size=30)
-    plt.tick_params(axis='both', which='both', length=6, width=2, labelsize=30)
-    if labels is not None:
-        plt.legend(prop={'size': 25}, loc=(0.15, 0.73))
+    mu_sets = [mus] if sets == 1 else list(mus)
+    mu_sets = [np.reshape(mu_set, (len(modes), -1)) for mu_set in mu_sets]
+
+    plt.figure(figsize=(12, 8 * len(modes)))
+    for m, mode in enumerate(modes):
+        plt.subplot(len(modes), 1, m + 1)
+        if sets == 1:
+            plt.plot(mu_sets[0][m] * 1e3, lw=3, label=labels)   # 1e3 to convert from nm to pm
+        else:
+            for i in range(sets):
+                plt.plot(mu_sets[i][m] * 1e3, lw=3, label=labels[i])
+        if len(modes) > 1:
+            plt.title(mode.capitalize(), size=30)
+        plt.xlabel('Segment number', size=30)
+        plt.ylabel('WFE requirements (pm)', size=30)
+        plt.tick_params(axis='both', which='both', length=6, width=2, labelsize=30)
+        if labels is not None:
+            plt.legend(prop={'size': 25}, loc=(0.15, 0.73))
     plt.tight_layout()
 
     if save:
@@ -405,8 +418,8 @@ def create_luvoir_and_wf_at_mirror(design, wvln):
 
     aper_path = 'inputs/TelAp_LUVOIR_gap_pad01_bw_ovsamp04_N1000.fits'
     aper_ind_path = 'inputs/TelAp_LUVOIR_gap_pad01_bw_ovsamp04_N1000_indexed.fits'
-    aper_read = hc.read_fits(os.path.join(optics_path, aper_path))
-    aper_ind_read = hc.read_fits(os.path.join(optics_path, aper_ind_path))
+    aper_read = disk_cache.read_fits_asset(os.path.join(optics_path, aper_path))
+    aper_ind_read = disk_cache.read_fits_asset(os.path.join(optics_path, aper_ind_path))
 
     pupil_grid = hc.make_pupil_grid(dims=aper_ind_read.shape[0], diameter=15)
     aper = hc.Field(aper_read.ravel(), pupil_grid)
@@ -418,15 +431,20 @@ def create_luvoir_and_wf_at_mirror(design, wvln):
     return luvoir, wf_aper
 
 
-def plot_mu_map(mus, wvln, out_dir, design, c_target, limits=None, fname_suffix='', save=False):
+def plot_mu_map(mus, wvln, out_dir, design, c_target, limits=None, modes=('piston',), fname_suffix='', save=False):
     """
     Plot the segment requirement map for a specific target contrast.
-    :param mus: array or list, segment requirements (standard deviations) in nm
+
+    Each segment is shown flat, at the value of its requirement. For several local segment modes, the requirements of
+    each local mode are shown in a map of their own.
+    :param mus: array or list, segment requirements (standard deviations) in nm, ordered by local mode first, then by
+                segment
     :param wvln: float, operating wavelength in nm
     :param out_dir: str, output path to save the figure to if save=True
     :param design: str, "small", "medium", or "large" LUVOIR-A APLC design for which the mus have been calculated
     :param c_target: float, target contrast for which the segment requirements have been calculated
     :param limits: tuple, colorbar limirs, deault is None
+    :param modes: tuple of str, local segment modes of the mus, default is piston only
     :param fname_suffix: str, optional, suffix to add to the saved file name
     :param save: bool, whether to save to disk or not, default is False
     :return:
@@ -437,36 +455,43 @@ def plot_mu_map(mus, wvln, out_dir, design, c_target, limits=None, fname_suffix=
 
     # Create wavefront in aperture plane and luvoir instance
     luvoir, wf_aper = create_luvoir_and_wf_at_mirror(design, wvln)
-    wf_constraints = apply_mode_to_sm(mus, luvoir.sm, wf_aper)
-
-    plt.figure(figsize=(10, 10))
-
-    map_small = (wf_constraints.phase / wf_constraints.wavenumber * 1e12).shaped  # in picometers
-    map_small = np.ma.masked_where(map_small == 0, map_small)
-    cmap_brev.set_bad(color='black')
-
-    plt.imshow(map_small, cmap=cmap_brev)
-    cbar = plt.colorbar(fraction=0.046,
-                        pad=0.04)  # no clue what these numbers mean but it did the job of adjusting the colorbar size to the actual plot size
-    cbar.ax.tick_params(labelsize=30)  # this changes the numbers on the colorbar
-    cbar.ax.yaxis.offsetText.set(size=25)  # this changes the base of ten on the colorbar
-    cbar.set_label('picometers', size=30)
-    if limits is not None:
-        plt.clim(limits[0] * 1e3, limits[1] * 1e3)  # in pm
-    plt.tick_params(axis='both', which='both', length=6, width=2, labelsize=20)
-    plt.axis('off')
+    mode_mus = np.reshape(mus, (len(modes), -1))
+
+    plt.figure(figsize=(10 * len(modes), 10))
+    for m, mode in enumerate(modes):
+        # Piston of each segment at its requirement, to show the requirement value across the segment
+        wf_constraints = pastis_analysis.apply_mode_to_sm(mode_mus[m], luvoir.sm, wf_aper)
+
+        map_small = (wf_constraints.phase / wf_constraints.wavenumber * 1e12).shaped  # in picometers
+        map_small = np.ma.masked_where(map_small == 0, map_small)
+        cmap_brev.set_bad(color='black')
+
+        plt.subplot(1, len(modes), m + 1)
+        plt.imshow(map_small, cmap=cmap_brev)
+        cbar = plt.colorbar(fraction=0.046,
+                            pad=0.04)  # no clue what these numbers mean but it did the job of adjusting the colorbar size to the actual plot size
+        cbar.ax.tick_params(labelsize=30)  # this changes the numbers on the colorbar
+        cbar.ax.yaxis.offsetText.set(size=25)  # this changes the base of ten on the colorbar
+        cbar.set_label('picometers', size=30)
+        if limits is not None:
+            plt.clim(limits[0] * 1e3, limits[1] * 1e3)  # in pm
+        if len(modes) > 1:
+            plt.title(mode.capitalize(), size=30)
+        plt.tick_params(axis='both', which='both', length=6, width=2, labelsize=20)
+        plt.axis('off')
     plt.tight_layout()
 
     if save:
         plt.savefig(os.path.join(out_dir, '.'.join([fname, 'pdf'])))
 
 
-def calculate_mode_phases(pastis_modes, wvln, design):
+def calculate_mode_phases(pastis_modes, wvln, design, modes=('piston',)):
     """
     Calculate the phase maps in radians of a set of PASTIS modes.
     :param pastis_modes: array, PASTIS modes [seg, mode] in nm
     :param wvln: float, wavelength at which the PASTIS matrix was generated, in nm
     :param design: str, "small", "medium", or "large" LUVOIR-A APLC design
+    :param modes: tuple of str, local segment modes the PASTIS modes are made of, default is piston only
     :return: all_modes, array of phase pupil images
     """
     # Create wavefront in aperture plane and luvoir instance
@@ -475,18 +500,20 @@ def calculate_mode_phases(pastis_modes, wvln, design):
     # Calculate phases of all modes
     all_modes = []
     for mode in range(len(pastis_modes)):
-        all_modes.append(apply_mode_to_sm(pastis_modes[:, mode], luvoir.sm, wf_aper).phase)
+        pastis_analysis.apply_mode_to_luvoir(pastis_modes[:, mode], luvoir, modes)
+        all_modes.append(luvoir.sm(wf_aper).phase)
 
     return all_modes
 
 
-def plot_all_modes(pastis_modes, wvln, out_dir, design, fname_suffix='', save=False):
+def plot_all_modes(pastis_modes, wvln, out_dir, design, modes=('piston',), fname_suffix='', save=False):
     """
     Plot all PATIS modes onto a grid.
     :param pastis_modes: array, PASTIS modes [seg, mode] in nm
     :param wvln: float, wavelength at which the PASTIS matrix was generated, in nm
     :param out_dir: str, output path to save the figure to if save=True
     :param design: str, "small", "medium", or "large" LUVOIR-A APLC design
+    :param modes: tuple of str, local segment modes the PASTIS modes are made of, default is piston only
     :param fname_suffix: str, optional, suffix to add to the saved file name
     :param save: bool, whether to save to disk or not, default is False
     :return:
@@ -496,11 +523,14 @@ def plot_all_modes(pastis_modes, wvln, out_dir, design, fname_suffix='', save=Fa
         fname += f'_{fname_suffix}'
 
     # Calculate phases of all modes
-    all_modes = calculate_mode_phases(pastis_modes, wvln, design)
+    all_modes = calculate_mode_phases(pastis_modes, wvln, design, modes)
 
-    # Plot them
-    fig, axs = plt.subplots(12, 10, figsize=(20, 24))
-    for i, ax in enumerate(axs.flat):
+    # Plot them, on rows of 10 modes
+    nrows = int(np.ceil(len(all_modes) / 10))
+    fig, axs = plt.subplots(nrows, 10, figsize=(20, 2 * nrows), squeeze=False)
+    for ax in axs.flat[len(all_modes):]:
+        ax.axis('off')
+    for i, ax in enumerate(axs.flat[:len(all_modes)]):
         im = hc.imshow_field(all_modes[i], cmap='RdBu', ax=ax, vmin=-0.0045, vmax=0.0045)
         ax.axis('off')
         ax.annotate(f'{i + 1}', xy=(-6.8, -6.8), fontweight='roman', fontsize=13)
@@ -510,7 +540,7 @@ def plot_all_modes(pastis_modes, wvln, out_dir, design, fname_suffix='', save=Fa
         plt.savefig(os.path.join(out_dir, '.'.join([fname, 'pdf'])))
 
 
-def plot_single_mode(mode_nr, pastis_modes, wvln, out_dir, design, figsize=(8.5,8.5), vmin=None, vmax=None, fname_suffix='', save=False):
+def plot_single_mode(mode_nr, pastis_modes, wvln, out_dir, design, figsize=(8.5,8.5), vmin=None, vmax=None, modes=('piston',), fname_suffix='', save=False):
     """
     Plot a single PASTIS mode.
     :param mode_nr: int, mode index
@@ -521,6 +551,7 @@ def plot_single_mode(mode_nr, pastis_modes, wvln, out_dir, design, figsize=(8.5,
     :param figsize: tuple, size of figure, default=(8.5,8.5)
     :param vmin: matplotlib min extent of image, default is None
     :param vmax: matplotlib max extent of image, default is None
+    :param modes: tuple of str, local segment modes the PASTIS modes are made of, default is piston only
     :param fname_suffix: str, optional, suffix to add to the saved file name
     :param save: bool, whether to save to disk or not, default is False
     :return:
@@ -533,7 +564,8 @@ def plot_single_mode(mode_nr, pastis_modes, wvln, out_dir, design, figsize=(8.5,
     luvoir, wf_aper = create_luvoir_and_wf_at_mirror(design, wvln)
 
     plt.figure(figsize=figsize, constrained_layout=False)
-    one_mode = apply_mode_to_sm(pastis_modes[:, mode_nr - 1], luvoir.sm, wf_aper)
+    pastis_analysis.apply_mode_to_luvoir(pastis_modes[:, mode_nr - 1], luvoir, modes)
+    one_mode = luvoir.sm(wf_aper)
     hc.imshow_field(one_mode.phase, cmap='RdBu', vmin=vmin, vmax=vmax)
     plt.axis('off')
     plt.annotate(f'{mode_nr}', xy=(-7.1, -6.9), fontweight='roman', fontsize=43)
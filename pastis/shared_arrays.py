@@ -0,0 +1,99 @@
+"""
+Named numpy arrays in shared memory, for handing large read-only optics and preallocated result buffers to worker
+processes.
+
+The parent process creates a SharedArrayStore and puts the arrays into it, the workers attach to it with the handle
+(a small picklable dict) and get zero-copy views on the same memory instead of unpickling or re-reading the arrays.
+"""
+
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedArrayStore:
+    """
+    Named numpy arrays, each in its own multiprocessing.shared_memory block.
+
+    The store that created the blocks owns them and frees them in close(), stores attached with attach() only unmap
+    them. Views returned by get() are only valid until the store is closed, so copy results out before that.
+    """
+    def __init__(self):
+        self._blocks = {}   # name: (SharedMemory, shape, dtype)
+        self._owner = True
+
+    def _create(self, name, shape, dtype):
+        if name in self._blocks:
+            raise KeyError(f'Array {name} is already in the shared store.')
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)   # shared memory blocks can not be empty
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        self._blocks[name] = (shm, tuple(shape), dtype.str)
+        return self.get(name)
+
+    def put(self, name, array):
+        """
+        Copy an array into shared memory.
+        :param name: str, name of the array in the store
+        :param array: array to share
+        :return: array, view on the shared copy
+        """
+        array = np.asarray(array)
+        shared = self._create(name, array.shape, array.dtype)
+        shared[...] = array
+        return shared
+
+    def empty(self, name, shape, dtype=np.float64):
+        """
+        Create a zero-initialized result buffer in shared memory, for the workers to write into.
+        :param name: str, name of the array in the store
+        :param shape: tuple, shape of the buffer
+        :param dtype: dtype of the buffer
+        :return: array, view on the shared buffer
+        """
+        shared = self._create(name, shape, dtype)
+        shared[...] = 0
+        return shared
+
+    def get(self, name):
+        """
+        Get a zero-copy view on a shared array.
+        :param name: str, name of the array in the store
+        :return: array
+        """
+        shm, shape, dtype = self._blocks[name]
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def __contains__(self, name):
+        return name in self._blocks
+
+    @property
+    def handle(self):
+        """ Picklable description of all shared arrays, to attach to the store from other processes. """
+        return {name: (shm.name, shape, dtype) for name, (shm, shape, dtype) in self._blocks.items()}
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Attach to the shared arrays of a store created in another process.
+        :param handle: dict, SharedArrayStore.handle of the owning store
+        :return: SharedArrayStore that does not own the shared memory
+        """
+        store = cls()
+        store._owner = False
+        for name, (shm_name, shape, dtype) in handle.items():
+            store._blocks[name] = (shared_memory.SharedMemory(name=shm_name), tuple(shape), dtype)
+        return store
+
+    def close(self):
+        """ Unmap all shared arrays, and free them if this store owns them. """
+        for shm, _shape, _dtype in self._blocks.values():
+            shm.close()
+            if self._owner:
+                shm.unlink()
+        self._blocks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -7,14 +7,15 @@ The flat error budget gets calculated as a standard part of the main PASTIS anal
 """
 
 import os
-import astropy.units as u
+from astropy.io import fits
 import logging
 import matplotlib.pyplot as plt
 import numpy as np
 
 from config import CONFIG_INI
 from e2e_simulators.luvoir_imaging import LuvoirAPLC
-from pastis_analysis import modes_from_file
+from pastis_analysis import modes_from_file, matrix_local_modes, set_matrix_band, coronagraph_floor, \
+    apply_mode_to_luvoir
 
 log = logging.getLogger(__name__)
 
@@ -31,13 +32,14 @@ def single_mode_sigma(c_target, c_floor, evalue):
     return sigma
 
 
-def single_mode_contrasts(sigma, pmodes, single_mode, luvoir):
+def single_mode_contrasts(sigma, pmodes, single_mode, luvoir, modes=('piston',)):
     """
     Calculate the contrast stemming from one weighted PASTIS mode.
     :param sigma: mode weight for the mode with index single_mode
     :param pmodes: all PASTIS modes
     :param single_mode: mode index of mode to weight and calculate contrast for
     :param luvoir: LuvoirAPLC instance
+    :param modes: tuple of str, local segment modes the PASTIS modes are made of, default is piston only
     :return: float, DH mean contrast for weighted PASTIS mode
     """
 
@@ -45,23 +47,16 @@ def single_mode_contrasts(sigma, pmodes, single_mode, luvoir):
     opd = pmodes[:, single_mode - 1] * sigma
 
     # Put OPD on LUVOIR simulator
-    luvoir.flatten()
-    for seg, val in enumerate(opd):
-        val *= u.nm
-        luvoir.set_segment(seg + 1, val.to(u.m).value / 2, 0, 0)
-
-    # Get PSF from putting this OPD on the simulator
-    psf, ref = luvoir.calc_psf(ref=True)
-    norm = ref.max()
+    apply_mode_to_luvoir(opd, luvoir, modes)
 
-    # Calculate the contrast from that PSF
-    dh_intensity = psf / norm * luvoir.dh_mask
-    contrast = np.mean(dh_intensity[np.where(luvoir.dh_mask != 0)])
+    # Get the mean dark hole contrast of this OPD from the simulator, over its wavelengths
+    contrast = luvoir.calc_psf_batch(np.array(luvoir.sm.coef)[np.newaxis])[0]
 
     return contrast
 
 
-def single_mode_error_budget(design, run_choice, c_target=1e-10, single_mode=None):
+def single_mode_error_budget(design, run_choice, c_target=1e-10, single_mode=None,
+                             matrix_name='PASTISmatrix_num_piston_Noll1'):
     """
     Calculate and plot single-mode error budget, for onde PASTIS mode.
 
@@ -72,6 +67,8 @@ def single_mode_error_budget(design, run_choice, c_target=1e-10, single_mode=Non
     :param run_choice: str, path to data
     :param c_target: float, target contrast
     :param single_mode: int, mode index for single mode error budget
+    :param matrix_name: string, file name of the matrix the PASTIS modes were calculated from, without extension;
+                        default is the piston matrix
     :return:
     """
 
@@ -87,12 +84,14 @@ def single_mode_error_budget(design, run_choice, c_target=1e-10, single_mode=Non
     luvoir = LuvoirAPLC(optics_input, design, sampling)
     luvoir.flatten()
 
+    # Local segment modes of the matrix, and the band all contrasts are calculated over
+    matrix_header = fits.getheader(os.path.join(workdir, 'matrix_numerical', matrix_name + '.fits'))
+    modes = matrix_local_modes(matrix_header)
+    set_matrix_band(luvoir, matrix_header)
+
     # Generate baseline contrast
-    psf_unaber, ref = luvoir.calc_psf(ref=True)
-    norm = ref.max()
-    dh_intensity = psf_unaber / norm * luvoir.dh_mask
-    coronagraph_floor = np.mean(dh_intensity[np.where(dh_intensity != 0)])
-    log.info(f'coronagraph_floor: {coronagraph_floor}')
+    c_floor = coronagraph_floor(luvoir)
+    log.info(f'coronagraph_floor: {c_floor}')
 
     # Load PASTIS modes and eigenvalues
     pmodes, svals = modes_from_file(workdir)
@@ -100,11 +99,11 @@ def single_mode_error_budget(design, run_choice, c_target=1e-10, single_mode=Non
     log.info('Single mode error budget')
 
     # Calculate the mode weight
-    single_sigma = single_mode_sigma(c_target, coronagraph_floor, svals[single_mode-1])
+    single_sigma = single_mode_sigma(c_target, c_floor, svals[single_mode-1])
     log.info(f'Eigenvalue: {svals[single_mode-1]}')
     log.info(f'single_sigma: {single_sigma}')
 
-    single_contrast = single_mode_contrasts(single_sigma, pmodes, single_mode, luvoir)
+    single_contrast = single_mode_contrasts(single_sigma, pmodes, single_mode, luvoir, modes)
     log.info(f'contrast: {single_contrast}')
 
     # Make array of target contrasts
@@ -113,12 +112,12 @@ def single_mode_error_budget(design, run_choice, c_target=1e-10, single_mode=Non
 
     # Calculate according sigmas
     for i, con in enumerate(c_list):
-        sigma_list.append(single_mode_sigma(con, coronagraph_floor, svals[single_mode-1]))
+        sigma_list.append(single_mode_sigma(con, c_floor, svals[single_mode-1]))
 
     # Calculate recovered contrasts
     c_recov = []
     for i, sig in enumerate(sigma_list):
-        c_recov.append(single_mode_contrasts(sig, pmodes, single_mode, luvoir))
+        c_recov.append(single_mode_contrasts(sig, pmodes, single_mode, luvoir, modes))
 
     log.info(f'c_recov: {c_recov}')
     np.savetxt(os.path.join(workdir, 'results', 'single_mode_target_contrasts.txt'), c_list)
@@ -0,0 +1,116 @@
+"""
+Shared setup of the tests: the PASTIS modules import each other as top-level modules, so the package directory has to
+be on the path. The small segmented telescope of these fixtures stands in for the LUVOIR delivery files.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import CONFIG_INI
+import disk_cache
+
+
+def clear_disk_caches():
+    """ Forget the disk caches of the memoized getters, so that they are created from the configfile again. """
+    for get_cache in (disk_cache.get_psf_cache, disk_cache.get_mft_cache, disk_cache.get_optics_cache):
+        get_cache.cache_clear()
+
+
+@pytest.fixture
+def set_config():
+    """ Set options of the configfile for one test, they are restored afterwards. Setting options of the cache section
+    resets the disk caches. """
+    saved = []
+
+    def _set(section, option, value):
+        saved.append((section, option, CONFIG_INI.get(section, option, raw=True, fallback=None)))
+        CONFIG_INI.set(section, option, str(value))
+        if section == 'cache':
+            clear_disk_caches()
+
+    yield _set
+
+    for section, option, value in reversed(saved):
+        if value is None:
+            CONFIG_INI.remove_option(section, option)
+        else:
+            CONFIG_INI.set(section, option, value)
+    clear_disk_caches()
+
+
+@pytest.fixture(autouse=True)
+def no_disk_caches(set_config):
+    """ Switch off all on-disk caches, so that the tests neither read nor write them. """
+    for cache in ('psf_cache', 'mft_cache', 'optics_cache'):
+        set_config('cache', cache, False)
+
+
+def hexagonal_segment_positions(rings, pitch):
+    """ Centers of the segments of a hexagonal aperture with the given number of rings, without the central segment. """
+    positions = []
+    for r in range(-rings, rings + 1):
+        for q in range(-rings, rings + 1):
+            if abs(q + r) <= rings and (q, r) != (0, 0):
+                positions.append((pitch * (q + r / 2), pitch * np.sqrt(3) / 2 * r))
+    return np.array(positions)
+
+
+def make_indexed_aperture(pupil_grid, seg_position, flat_to_flat):
+    """ Indexed aperture of hexagonal segments with flat sides along x, segment k + 1 centered on seg_position[k]. """
+    import hcipy as hc
+
+    indexed = np.zeros(pupil_grid.size)
+    normals = [(np.cos(angle), np.sin(angle)) for angle in np.arange(3) * np.pi / 3]
+    for k, (xs, ys) in enumerate(seg_position):
+        inside = np.ones(pupil_grid.size, dtype=bool)
+        for nx, ny in normals:
+            inside &= np.abs((pupil_grid.x - xs) * nx + (pupil_grid.y - ys) * ny) <= flat_to_flat / 2
+        indexed[inside] = k + 1
+    return hc.Field(indexed, pupil_grid)
+
+
+@pytest.fixture
+def small_aplc():
+    """
+    Small SegmentedTelescopeAPLC: 18 hexagonal segments in two rings around an obscured center, on 96 px.
+
+    Needs the SegmentedMirror of HCIPy, the test is skipped if the installed HCIPy does not have it.
+    """
+    pytest.importorskip('e2e_simulators.luvoir_imaging', exc_type=ImportError)
+    return make_small_aplc()
+
+
+def make_small_aplc():
+    """ New instance of the small telescope of the small_aplc fixture, for tests that need more than one. """
+    from e2e_simulators import luvoir_imaging
+    import hcipy as hc
+
+    wavelength = 500e-9
+    pitch = 1.3
+    diameter = 7.
+    pupil_grid = hc.make_pupil_grid(dims=96, diameter=diameter)
+
+    seg_position = hexagonal_segment_positions(rings=2, pitch=pitch)
+    indexed_aperture = make_indexed_aperture(pupil_grid, seg_position, pitch - 0.02)
+    aperture = hc.Field((np.asarray(indexed_aperture) > 0).astype(float), pupil_grid)
+    apodizer = hc.Field(np.exp(-(pupil_grid.x**2 + pupil_grid.y**2) / 8), pupil_grid)
+    lyot_stop = hc.circular_aperture(0.9 * diameter)(pupil_grid)
+
+    lam_over_d = wavelength / diameter
+    fpm_grid = hc.make_focal_grid(pupil_grid=pupil_grid, q=6, num_airy=3.5, wavelength=wavelength)
+    fpm = 1 - hc.circular_aperture(2 * 3.5 * lam_over_d)(fpm_grid)
+    focal_grid = hc.make_focal_grid(pupil_grid=pupil_grid, q=4, num_airy=14, wavelength=wavelength)
+
+    params = {'wavelength': wavelength, 'diameter': diameter, 'imlamD': 14, 'fpm_rad': 3.5,
+              'wavelengths': list(wavelength * (1 + 0.1 * np.linspace(-0.5, 0.5, 3)))}
+    aplc = luvoir_imaging.SegmentedTelescopeAPLC(aper=aperture, indexed_aperture=indexed_aperture,
+                                                 seg_pos=hc.CartesianGrid(hc.UnstructuredCoords(seg_position.T)),
+                                                 apod=apodizer, lyotst=lyot_stop, fpm=fpm, focal_grid=focal_grid,
+                                                 params=params)
+    aplc.dark_hole = luvoir_imaging.get_dark_hole(focal_grid, 3.4, 12., lam_over_d)
+    aplc.dh_mask = aplc.dark_hole.mask
+    return aplc
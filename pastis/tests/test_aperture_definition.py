@@ -0,0 +1,73 @@
+"""
+Tests of the non-redundant pair search of aperture_definition.py against the pair-wise comparisons it replaced.
+"""
+import numpy as np
+
+import aperture_definition
+
+
+def hexagonal_segment_positions(rings, pitch):
+    """ Centers of the segments of a hexagonal aperture with the given number of rings, without the central segment. """
+    positions = []
+    for q in range(-rings, rings + 1):
+        for r in range(-rings, rings + 1):
+            if abs(q + r) <= rings and (q, r) != (0, 0):
+                positions.append((pitch * (q + r / 2), pitch * np.sqrt(3) / 2 * r))
+    return np.array(positions)
+
+
+def cross(a, b):
+    """ z component of the cross product of two 2D vectors. """
+    return a[0] * b[1] - a[1] * b[0]
+
+
+def null_redundant_baselines_loop(vec_flat):
+    """ Original nulling loop of make_aperture_nrp(). """
+    vec_null = np.copy(vec_flat)
+    for i in range(len(vec_flat)):
+        for j in range(i):
+            if np.abs(np.linalg.norm(vec_flat[i]) - np.linalg.norm(vec_flat[j])) <= 1.e-10:
+                if np.abs(cross(vec_flat[i], vec_flat[j])) <= 1.e-10:
+                    vec_null[i] = [0, 0]
+    return vec_null
+
+
+def projection_matrix_loop(vec_list, nr_pairs_list):
+    """ Original projection matrix loop of make_aperture_nrp(), first plane only. """
+    nb_seg = vec_list.shape[0]
+    vec_flat = np.reshape(vec_list, (nb_seg**2, 2))
+    matrix_flat = np.zeros(nb_seg**2)
+    for i in range(nb_seg**2):
+        for k in range(len(nr_pairs_list)):
+            nrp_vector = vec_list[nr_pairs_list[k, 0] - 1, nr_pairs_list[k, 1] - 1]
+            if np.abs(np.linalg.norm(vec_flat[i]) - np.linalg.norm(nrp_vector)) <= 1.e-10:
+                if np.abs(cross(vec_flat[i], nrp_vector)) <= 1.e-10:
+                    matrix_flat[i] = k + 1
+    return np.reshape(matrix_flat, (nb_seg, nb_seg))
+
+
+def test_baseline_keys_of_redundant_baselines():
+    vectors = np.array([[1.5, -0.3], [-1.5, 0.3], [1.5 + 1e-9, -0.3], [0., 2.], [0., -2.], [1.5, 0.3]])
+    keys = aperture_definition.get_baseline_keys(vectors)
+
+    assert keys[0] == keys[1] == keys[2]
+    assert keys[3] == keys[4]
+    assert len(set(keys)) == 3
+
+
+def test_nulling_and_projection_matrix_match_loops():
+    seg_position = hexagonal_segment_positions(rings=2, pitch=1.32)
+    nb_seg = len(seg_position)
+    vec_list = seg_position[:, np.newaxis, :] - seg_position[np.newaxis, :, :]
+    vec_flat = np.reshape(vec_list, (nb_seg**2, 2))
+
+    vec_null = aperture_definition.null_redundant_baselines(vec_flat)
+    np.testing.assert_array_equal(vec_null, null_redundant_baselines_loop(vec_flat))
+
+    distance_list = np.sum(np.square(vec_null), axis=1).reshape(nb_seg, nb_seg)
+    nonzero = np.nonzero(distance_list)
+    nr_pairs_list = np.transpose(nonzero) + 1
+
+    projection_matrix = aperture_definition.make_projection_matrix(vec_list, vec_list[nonzero])
+    assert projection_matrix.dtype == np.int16
+    np.testing.assert_array_equal(projection_matrix, projection_matrix_loop(vec_list, nr_pairs_list))
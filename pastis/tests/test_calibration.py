@@ -0,0 +1,63 @@
+"""
+Tests of the calibration of image-PASTIS on the JWST E2E simulator, with a stand-in for the NIRCam sessions of WebbPSF.
+"""
+import multiprocessing
+
+import numpy as np
+import pytest
+
+calibration = pytest.importorskip('calibration', exc_type=ImportError)
+
+import image_pastis as impastis
+
+
+class FakeNircamSession:
+    """ Deterministic stand-in for a NircamSession: the PSF brightens with the aberration, differently per segment. """
+
+    def __init__(self, coronagraph):
+        self.coronagraph = coronagraph
+
+    def reset(self):
+        pass
+
+    def calc_psf(self, Aber_WSS=None):
+        psf = np.full((128, 128), 1e-6 if self.coronagraph else 1.)
+        if Aber_WSS is not None:
+            weights = np.arange(1, Aber_WSS.shape[0] + 1)
+            psf = psf + np.sum(weights * np.sum((Aber_WSS * 1e9)**2, axis=1)) * 1e-8
+        return psf
+
+
+def fake_nircam_session(filter, fpm=None, ppm=None):
+    return FakeNircamSession(fpm is not None)
+
+
+def fake_analytical_model(zernike_pol, coef, cali=False, design=None):
+    image = np.full((16, 16), np.sum(np.asarray(coef)**2) * 1e-9)
+    return image, image
+
+
+@pytest.fixture
+def jwst_calibration(set_config, tmp_path, monkeypatch):
+    """ JWST calibration on the fake NIRCam sessions and analytical model, writing to tmp_path. """
+    set_config('telescope', 'name', 'JWST')
+    set_config('local', 'local_data_path', tmp_path)
+    (tmp_path / 'active').mkdir()
+
+    # The WebbPSF module reads the telescope from the configfile on import
+    webbim = pytest.importorskip('e2e_simulators.webbpsf_imaging', exc_type=ImportError)
+    monkeypatch.setattr(webbim, 'get_nircam_session', fake_nircam_session)
+    monkeypatch.setattr(impastis, 'analytical_model', fake_analytical_model)
+    monkeypatch.setattr(impastis, 'analytical_dark_hole', lambda design=None: np.ones((16, 16)))
+    # The pool workers have to be forked to inherit the fakes
+    monkeypatch.setattr(calibration.multiprocessing, 'Pool', multiprocessing.get_context('fork').Pool)
+
+
+def test_calibration_jwst_on_processes(jwst_calibration):
+    """ The pool of worker processes gives the calibration vector of the serial run, in segment order. """
+    serial = calibration.calibration_jwst(processes=1)
+    pool = calibration.calibration_jwst(processes=2)
+
+    assert np.all(np.isfinite(serial))
+    assert len(np.unique(serial)) == serial.size
+    np.testing.assert_array_equal(pool, serial)
@@ -0,0 +1,53 @@
+"""
+Tests of the disk caches in disk_cache.py.
+"""
+import os
+import shutil
+
+import numpy as np
+from astropy.io import fits
+
+import disk_cache
+
+
+def test_read_fits_asset_keys_on_file_content(set_config, tmp_path, monkeypatch):
+    """ Optics files are cached on the checksum of their content, whatever their path and modification time. """
+    set_config('cache', 'optics_cache', True)
+    set_config('cache', 'optics_cache_dir', tmp_path / 'optics')
+    set_config('cache', 'optics_cache_size_mb', 10)
+
+    path = str(tmp_path / 'aperture.fits')
+    data = np.arange(64, dtype='>f8').reshape(8, 8)
+    fits.writeto(path, data)
+    np.testing.assert_array_equal(disk_cache.read_fits_asset(path), data)
+
+    # Cache hits do not open the FITS file
+    with monkeypatch.context() as patch:
+        patch.setattr(fits, 'getdata', lambda *args, **kwargs: None)
+        cached = disk_cache.read_fits_asset(path)
+    assert isinstance(cached, np.memmap)
+    np.testing.assert_array_equal(cached, data)
+
+    # An identical copy shares the entry
+    copy_path = str(tmp_path / 'copy.fits')
+    shutil.copy2(path, copy_path)
+    np.testing.assert_array_equal(disk_cache.read_fits_asset(copy_path), data)
+    assert len(os.listdir(tmp_path / 'optics')) == 1
+
+    # A new delivery of the same size copied with its modification time (cp -p), read by a new process
+    stat = os.stat(path)
+    fits.writeto(path, 2 * data, overwrite=True)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.stat(path).st_size == stat.st_size
+    disk_cache._file_checksum.cache_clear()
+    np.testing.assert_array_equal(disk_cache.read_fits_asset(path), 2 * data)
+
+
+def test_cache_getters_follow_the_config(set_config, tmp_path):
+    """ The tests switch the memoized disk caches on and off through the configfile. """
+    assert disk_cache.get_psf_cache() is None
+    set_config('cache', 'psf_cache', True)
+    set_config('cache', 'psf_cache_dir', tmp_path)
+    assert disk_cache.get_psf_cache().cache_dir == str(tmp_path)
+    set_config('cache', 'psf_cache', False)
+    assert disk_cache.get_psf_cache() is None
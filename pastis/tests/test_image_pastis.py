@@ -0,0 +1,68 @@
+"""
+Tests of the analytical model of image-PASTIS and its calibration on HCIPy simulators, for LUVOIR.
+"""
+import numpy as np
+import astropy.units as u
+import pytest
+
+from conftest import hexagonal_segment_positions
+
+pytest.importorskip('poppy')
+luvoir_imaging = pytest.importorskip('e2e_simulators.luvoir_imaging', exc_type=ImportError)
+
+import aperture_definition
+import image_pastis as impastis
+
+
+@pytest.fixture
+def luvoir_config(set_config, tmp_path):
+    """ LUVOIR with the segments of the small test telescope in the configfile, and its segmentation bundle. """
+    seg_position = hexagonal_segment_positions(rings=2, pitch=1.3)
+    nb_seg = len(seg_position)
+
+    set_config('telescope', 'name', 'LUVOIR')
+    set_config('local', 'local_data_path', tmp_path)
+    set_config('LUVOIR', 'nb_subapertures', nb_seg)
+    set_config('LUVOIR', 'pupil_px', 128)
+    set_config('numerical', 'size_seg', 48)
+    set_config('calibration', 'local_zernike', 1)
+
+    vec_list = seg_position[:, np.newaxis, :] - seg_position[np.newaxis, :, :]
+    vec_null = aperture_definition.null_redundant_baselines(vec_list.reshape(-1, 2)).reshape(vec_list.shape)
+    nonzero = np.nonzero(np.sum(np.square(vec_null), axis=2))
+    os_dir = tmp_path / 'active' / 'segmentation'
+    os_dir.mkdir(parents=True)
+    aperture_definition.write_segmentation_bundle(str(os_dir / aperture_definition.SEGMENTATION_BUNDLE_NAME),
+                                                  telescope='LUVOIR', seg_position=seg_position,
+                                                  vec_list=vec_list, vec_list_nulled=vec_null,
+                                                  NR_distance_list=np.sum(np.square(vec_null), axis=2)[nonzero],
+                                                  NR_pairs_list=np.transpose(nonzero) + 1,
+                                                  Projection_Matrix=aperture_definition.make_projection_matrix(
+                                                      vec_list, vec_list[nonzero]))
+    return seg_position
+
+
+def test_luvoir_analytical_model_is_segment_interference(luvoir_config):
+    """ The image is the mini-segment envelope times the interference of the segments, |sum_k a_k exp(ik r_k.u)|^2. """
+    seg_position = luvoir_config
+    focal_grid, dark_hole = impastis._luvoir_image_plane('small')
+    k = 2 * np.pi / (500e-9)
+
+    images = []
+    interferences = []
+    for _ in range(2):
+        coef = np.random.randn(len(seg_position)) * u.nm
+        dh_psf, intensity = impastis.analytical_model(1, coef.copy(), cali=False, design='small')
+        assert intensity.shape == tuple(focal_grid.shape)
+        np.testing.assert_array_equal(dh_psf.ravel()[dark_hole.indices], intensity.ravel()[dark_hole.indices])
+        assert np.all(np.delete(dh_psf.ravel(), dark_hole.indices) == 0)
+
+        aber = (coef - np.mean(coef)).value
+        phases = k * (np.outer(focal_grid.x, seg_position[:, 0]) + np.outer(focal_grid.y, seg_position[:, 1]))
+        images.append(intensity.ravel())
+        interferences.append(np.abs(np.exp(1j * phases).dot(aber))**2)
+
+    # The envelope of the mini-segment does not depend on the aberrations
+    np.testing.assert_allclose(images[0] * interferences[1], images[1] * interferences[0],
+                               rtol=1e-8, atol=1e-10 * np.max(images[0] * interferences[1]))
+    assert impastis.analytical_dark_hole('small') is dark_hole
@@ -0,0 +1,329 @@
+"""
+Tests of the HCIPy segmented telescope simulator, on the small telescope of the small_aplc fixture.
+"""
+import gc
+import os
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def psf_cache_dir(set_config, tmp_path):
+    """ Switch on the PSF cache in a temporary directory. """
+    set_config('cache', 'psf_cache', True)
+    set_config('cache', 'psf_cache_dir', tmp_path)
+    set_config('cache', 'psf_cache_size_mb', 100)
+    return tmp_path
+
+
+def test_psf_cache_keys_on_numerical_settings(small_aplc, psf_cache_dir):
+    """ PSFs of different precisions and pupil crops are separate cache entries, and each matches the propagation. """
+    aplc = small_aplc
+    aplc.cache_config = {'telescope': 'test'}
+    coef = np.zeros((aplc.seg_pos.size, 3))
+    coef[3, 0] = 5e-9
+    aplc.set_coef(coef)
+
+    expected = {}
+    for single_precision in (False, True):
+        for crop_pupil in (False, True):
+            aplc.single_precision = single_precision
+            aplc.crop_pupil = crop_pupil
+            expected[single_precision, crop_pupil] = np.asarray(aplc._calc_psf_compiled())
+            aplc.calc_psf()
+    assert len(os.listdir(psf_cache_dir)) == 4
+
+    for (single_precision, crop_pupil), psf in expected.items():
+        aplc.single_precision = single_precision
+        aplc.crop_pupil = crop_pupil
+        np.testing.assert_array_equal(aplc.calc_psf(), psf)
+
+
+def test_batch_mft_is_mft_per_field():
+    """ The stacked matrix products of _batch_mft() are the MFT mft_y.dot(field).dot(mft_x) of each field. """
+    luvoir_imaging = pytest.importorskip('e2e_simulators.luvoir_imaging', exc_type=ImportError)
+
+    rng = np.random.default_rng(1)
+    fields = rng.normal(size=(5, 7, 6)) + 1j * rng.normal(size=(5, 7, 6))
+    mft_y = rng.normal(size=(4, 7)) + 1j * rng.normal(size=(4, 7))
+    mft_x = rng.normal(size=(6, 3)) + 1j * rng.normal(size=(6, 3))
+
+    expected = np.array([mft_y.dot(field).dot(mft_x) for field in fields])
+    np.testing.assert_allclose(luvoir_imaging._batch_mft(fields, mft_y, mft_x), expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize('crop_pupil', [False, True])
+def test_batch_propagation_matches_hcipy_coronagraph(small_aplc, crop_pupil):
+    """ The batched MFT propagation onto the dark hole gives the E-field of the HCIPy Lyot coronagraph and propagator. """
+    import hcipy as hc
+
+    aplc = small_aplc
+    aplc.crop_pupil = crop_pupil
+    coro = hc.LyotCoronagraph(aplc.aper.grid, aplc.fpm, aplc.lyotstop)
+    prop = hc.FraunhoferPropagator(aplc.aper.grid, aplc.focal_det)
+    rng = np.random.default_rng(2)
+    coefs = rng.normal(scale=[20e-9, 1e-8, 1e-8], size=(3, aplc.seg_pos.size, 3))
+
+    surfaces = []
+    expected = []
+    for coef in coefs:
+        aplc.set_coef(coef)
+        surfaces.append(aplc._pupil_crop(aplc.sm.surface))
+        wf_im = prop(coro(aplc.apod_prop(aplc.sm(aplc.wf_aper))))
+        expected.append(np.asarray(wf_im.electric_field)[aplc.dark_hole.indices])
+    expected = np.array(expected)
+
+    # HCIPy's Fraunhofer propagator has the extra constant phase factor 1/i, which does not change any intensity
+    efields_dh = aplc._calc_dh_efield_batch(np.array(surfaces), aplc.wvln, aplc.dh_mask)
+    np.testing.assert_allclose(efields_dh, 1j * expected, rtol=0, atol=1e-9 * np.abs(expected).max())
+
+
+def test_propagators_match_hcipy(small_aplc):
+    """ The coronagraphs and the propagator of the simulator, on its cached MFT matrices, are the HCIPy ones. """
+    import hcipy as hc
+
+    aplc = small_aplc
+    coef = np.random.default_rng(3).normal(scale=[20e-9, 1e-8, 1e-8], size=(aplc.seg_pos.size, 3))
+    aplc.set_coef(coef)
+    wf_apod = aplc.apod_prop(aplc.sm(aplc.wf_aper))
+
+    propagators = {'coro': hc.LyotCoronagraph(aplc.aper.grid, aplc.fpm, aplc.lyotstop),
+                   'coro_no_ls': hc.LyotCoronagraph(aplc.aper.grid, aplc.fpm),
+                   'prop': hc.FraunhoferPropagator(aplc.aper.grid, aplc.focal_det)}
+    for name, hcipy_propagator in propagators.items():
+        expected = np.asarray(hcipy_propagator(wf_apod).electric_field)
+        efield = np.asarray(getattr(aplc, name)(wf_apod).electric_field)
+        np.testing.assert_allclose(efield, expected, rtol=0, atol=1e-10 * np.abs(expected).max(), err_msg=name)
+
+    # Built once on the memoized MFT matrices, which do not depend on the pupil crop
+    assert aplc.coro is aplc.coro
+    nb_mfts = len(aplc._fpm_mfts)
+    assert nb_mfts > 0
+    aplc.crop_pupil = not aplc.crop_pupil
+    aplc.coro(wf_apod)
+    assert len(aplc._fpm_mfts) == nb_mfts
+
+
+def test_single_precision_contrast_error(small_aplc):
+    """ In single precision, the contrast change from sub-nm segment aberrations matches double precision. """
+    aplc = small_aplc
+    nseg = aplc.seg_pos.size
+    rng = np.random.default_rng(4)
+    coefs = np.zeros((4, nseg, 3))
+    coefs[1:, :, 0] = rng.normal(scale=0.5e-9, size=(3, nseg))
+    coefs[3, :, 1:] = rng.normal(scale=1e-9, size=(nseg, 2))
+
+    contrasts = {}
+    for single_precision in (False, True):
+        aplc.single_precision = single_precision
+        psf_contrasts = []
+        dh_contrasts = []
+        for coef in coefs:
+            aplc.set_coef(coef)
+            psf_contrasts.append(np.mean(np.asarray(aplc.calc_psf())[aplc.dark_hole.indices]))
+            dh_contrasts.append(aplc.calc_psf_dh()[1])
+        contrasts[single_precision] = {'calc_psf': np.array(psf_contrasts),
+                                       'calc_psf_dh': np.array(dh_contrasts),
+                                       'calc_psf_batch': aplc.calc_psf_batch(coefs),
+                                       'calc_piston_contrast': aplc.calc_piston_contrast(2 * coefs[:3, :, 0]),
+                                       'calc_tiptilt_contrast': aplc.calc_tiptilt_contrast(coefs)}
+
+    for method, contrast_double in contrasts[False].items():
+        contrast_single = contrasts[True][method]
+        np.testing.assert_allclose(contrast_single, contrast_double, rtol=1e-8, err_msg=method)
+        np.testing.assert_allclose(contrast_single[1:] - contrast_single[0], contrast_double[1:] - contrast_double[0],
+                                   rtol=1e-5, err_msg=method)
+
+
+def test_one_reference_peak(small_aplc):
+    """ calc_psf() normalized by its reference PSF, calc_psf_dh() and calc_psf_batch() give the same contrast. """
+    aplc = small_aplc
+    aplc.wavelengths = [aplc.wvln]
+    coef = np.zeros((aplc.seg_pos.size, 3))
+    coef[:, 0] = np.random.default_rng(5).normal(scale=2e-9, size=aplc.seg_pos.size)
+    aplc.set_coef(coef)
+
+    psf, psf_ref = aplc.calc_psf(ref=True)
+    contrast_psf = np.mean(np.asarray(psf)[aplc.dark_hole.indices]) / np.max(psf_ref)
+
+    np.testing.assert_allclose(aplc.calc_psf_dh()[1], contrast_psf, rtol=1e-10)
+    np.testing.assert_allclose(aplc.calc_psf_batch(coef[np.newaxis]), contrast_psf, rtol=1e-10)
+    np.testing.assert_allclose(aplc.calc_piston_contrast(2 * coef[:, 0]), contrast_psf, rtol=1e-10)
+
+
+def test_tiptilt_taylor_expansion_matches_direct_propagation(small_aplc):
+    """ The Taylor-expanded tip/tilt contrasts converge to the direct propagation, states out of range are direct. """
+    aplc = small_aplc
+    nseg = aplc.seg_pos.size
+    rng = np.random.default_rng(7)
+    coefs = np.zeros((5, nseg, 3))
+    coefs[:, :, 0] = rng.normal(scale=1e-9, size=(5, nseg))
+    coefs[:, :, 1:] = rng.normal(scale=3e-9, size=(5, nseg, 2))
+    coefs[4, 2, 1] = 1e-7   # far beyond the accurate range of the expansion
+    contrast_direct = aplc.calc_psf_batch(coefs)
+
+    rel_errors = []
+    for order in (2, 3, 4):
+        contrast = aplc.calc_tiptilt_contrast(coefs, order=order, validate=2)
+        rel_error = np.abs(contrast / contrast_direct - 1)
+        errors = aplc.taylor_errors
+
+        np.testing.assert_array_equal(errors['expanded'], [True, True, True, True, False])
+        assert np.all(rel_error[:4] < errors['error_bound'][:4])
+        assert np.any(np.isclose(errors['rel_error'], rel_error[:4], rtol=1e-6, atol=0))
+        np.testing.assert_allclose(contrast[4], contrast_direct[4], rtol=1e-12)
+        rel_errors.append(np.max(rel_error[:4]))
+    assert rel_errors[0] > rel_errors[1] > rel_errors[2]
+
+    # One state gives a float, and the bound is also kept without validation
+    assert isinstance(aplc.calc_tiptilt_contrast(coefs[0]), float)
+    assert aplc.taylor_errors['rel_error'] is None
+    assert aplc.taylor_errors['error_bound'].shape == (1,)
+
+
+def test_pupil_crop_does_not_change_psf(small_aplc):
+    """ Propagating only the bounding box of the illuminated pupil gives the PSFs and contrasts of the full pupil. """
+    aplc = small_aplc
+    rows, cols = aplc._illuminated_box
+    assert rows.stop - rows.start < aplc.aper.grid.shape[0] and cols.stop - cols.start < aplc.aper.grid.shape[1]
+
+    coefs = np.random.default_rng(8).normal(scale=[5e-9, 5e-9, 5e-9], size=(3, aplc.seg_pos.size, 3))
+    results = {}
+    for crop_pupil in (False, True):
+        aplc.crop_pupil = crop_pupil
+        psfs = []
+        dh_intensities = []
+        for coef in coefs:
+            aplc.set_coef(coef)
+            psfs.append(np.asarray(aplc.calc_psf()))
+            dh_intensities.append(aplc.calc_psf_dh()[0])
+        results[crop_pupil] = {'calc_psf': np.array(psfs), 'calc_psf_dh': np.array(dh_intensities),
+                               'calc_psf_batch': aplc.calc_psf_batch(coefs)}
+
+    for method, full in results[False].items():
+        np.testing.assert_allclose(results[True][method], full, rtol=0, atol=1e-12 * np.abs(full).max(), err_msg=method)
+
+
+def test_mft_threads_are_shut_down(small_aplc):
+    """ The thread pool of the split matrix products gives the same PSF, and is shut down on leaving the context. """
+    aplc = small_aplc
+    aplc.set_coef(np.random.default_rng(9).normal(scale=5e-9, size=(aplc.seg_pos.size, 3)))
+    psf = np.asarray(aplc.calc_psf())
+
+    with aplc:
+        aplc.mft_threads = 2
+        np.testing.assert_allclose(aplc.calc_psf(), psf, rtol=1e-12, atol=0)
+        executor = aplc._mft_executor
+        assert executor is not None
+    assert aplc._mft_executor is None
+    assert executor._shutdown
+    np.testing.assert_allclose(aplc.calc_psf(), psf, rtol=1e-12, atol=0)   # starts a new pool
+
+    # Without close(), the threads are shut down by the finalizer when the simulator is garbage collected or at exit
+    executor = aplc._mft_executor
+    assert aplc._mft_executor_finalizer.alive
+    aplc._mft_executor_finalizer()
+    assert executor._shutdown
+
+
+def test_shared_propagation(small_aplc):
+    """ A worker attached to the propagation of share_propagation() uses the shared MFTs and basis, with the same
+    contrasts as the sharing simulator. """
+    from conftest import make_small_aplc
+    from shared_arrays import SharedArrayStore
+
+    aplc = small_aplc
+    aplc.single_precision = True
+    nseg = aplc.seg_pos.size
+    coef = np.zeros((nseg, 3))
+    coef[:, 0] = np.random.default_rng(10).normal(scale=2e-9, size=nseg)
+    aplc.set_coef(coef)
+    expected = aplc.calc_psf_dh()[1], aplc.calc_piston_contrast(2 * coef[:, 0])
+
+    with SharedArrayStore() as store:
+        aplc.share_propagation(store)
+        worker_store = SharedArrayStore.attach(store.handle)
+        worker = make_small_aplc()
+        worker.attach_propagation(worker_store)
+        assert worker.single_precision and worker.crop_pupil == aplc.crop_pupil
+        memos = {name: len(getattr(worker, name)) for name in ('_dh_mfts', '_fpm_mfts', '_flat_efields',
+                                                                '_segment_bases', '_ref_peaks')}
+
+        worker.set_coef(coef)
+        np.testing.assert_allclose(worker.calc_psf_dh()[1], expected[0], rtol=1e-8)
+        np.testing.assert_allclose(worker.calc_piston_contrast(2 * coef[:, 0]), expected[1], rtol=1e-8)
+
+        # Nothing was calculated again, the memos are views on the shared memory
+        assert {name: len(getattr(worker, name)) for name in memos} == memos
+        basis = worker._get_segment_basis(worker.dh_mask)
+        assert np.shares_memory(basis, worker_store.get('segment_basis'))
+        dh_mft = worker._get_dh_mft(worker.dh_mask, worker.wavelengths[0])
+        assert np.shares_memory(dh_mft['mft_y'], worker_store.get('dh_mft_0_mft_y'))
+
+        del worker, basis, dh_mft
+        gc.collect()
+        worker_store.close()
+
+
+def test_region_contrasts(small_aplc):
+    """ The contrast of each focal plane region, overlapping or not, is the mean of calc_psf() over its pixels. """
+    from e2e_simulators import luvoir_imaging
+    import util_pastis as util
+
+    aplc = small_aplc
+    aplc.wavelengths = [aplc.wvln]
+    aplc.lam_over_d = aplc.lamDrad
+    x = np.asarray(aplc.focal_det.x) / aplc.lam_over_d
+    y = np.asarray(aplc.focal_det.y) / aplc.lam_over_d
+    box = (np.abs(x) < 5) & (np.abs(y) < 5)
+    regions = luvoir_imaging.LuvoirAPLC.dark_hole_regions(aplc, annuli=[(2, 6)], halves=True, masks={'box': box})
+    assert list(regions) == ['dh', 'annulus_2-6', 'dh_right', 'dh_left', 'dh_top', 'dh_bottom', 'box']
+
+    # The halves leave out the dark hole pixels on the axis between them
+    dh_mask = np.asarray(aplc.dh_mask, dtype=bool)
+    assert np.any(dh_mask & (x == 0)) and np.any(dh_mask & (y == 0))
+    np.testing.assert_array_equal(regions['dh_right'].mask | regions['dh_left'].mask, dh_mask & (x != 0))
+    np.testing.assert_array_equal(regions['dh_top'].mask | regions['dh_bottom'].mask, dh_mask & (y != 0))
+    assert not np.any(regions['dh_right'].mask & regions['dh_left'].mask)
+    assert not np.any(regions['dh_top'].mask & regions['dh_bottom'].mask)
+
+    # The union holds every pixel of every region once
+    union_mask, positions = luvoir_imaging.dark_hole_union(regions)
+    np.testing.assert_array_equal(union_mask, np.any([region.mask for region in regions.values()], axis=0))
+    for name, region in regions.items():
+        np.testing.assert_array_equal(np.flatnonzero(union_mask)[positions[name]], region.indices, err_msg=name)
+
+    coefs = np.random.default_rng(12).normal(scale=[5e-9, 5e-9, 5e-9], size=(2, aplc.seg_pos.size, 3))
+    contrasts = aplc.calc_region_contrasts(coefs, regions)
+    for s, coef in enumerate(coefs):
+        aplc.set_coef(coef)
+        psf, psf_ref = aplc.calc_psf(ref=True)
+        peak = np.max(psf_ref)
+        for name, region in regions.items():
+            np.testing.assert_allclose(contrasts[name][s], util.dh_mean(psf, region) / peak, rtol=1e-10, err_msg=name)
+            np.testing.assert_allclose(contrasts[name][s], util.dh_mean(psf, region.mask) / peak, rtol=1e-10)
+
+
+@pytest.mark.parametrize('binning', [2, 3, 4])
+def test_bin_indexed_pupil_matches_binned_aperture(small_aplc, binning):
+    """ The binned indexed aperture puts every bin that transmits in the binned aperture into a segment. """
+    from e2e_simulators import luvoir_imaging
+
+    aplc = small_aplc
+    shape = tuple(aplc.aper.grid.shape)
+    indexed = np.asarray(aplc.indexed_aperture).reshape(shape)
+    aperture = luvoir_imaging._bin_pupil(np.asarray(aplc.aper).reshape(shape), binning)
+    indexed_binned = luvoir_imaging._bin_indexed_pupil(indexed, binning)
+    assert np.any((aperture > 0) & (aperture <= 0.5))   # bins split with the gaps
+
+    np.testing.assert_array_equal(indexed_binned > 0, aperture > 0)
+    for seg in range(1, aplc.seg_pos.size + 1):
+        # Each binned pixel of a segment has light of that segment, and the segment keeps its full bins
+        in_bins = luvoir_imaging._bin_pupil(indexed == seg, binning)
+        assert np.all(in_bins[indexed_binned == seg] > 0), seg
+        assert np.all(indexed_binned[in_bins == 1] == seg), seg
+
+    # Ties between a segment and the gap go to the segment, whichever comes first in the bin
+    np.testing.assert_array_equal(luvoir_imaging._bin_indexed_pupil(np.array([[0, 0], [3, 3]]), 2), [[3]])
+    np.testing.assert_array_equal(luvoir_imaging._bin_indexed_pupil(np.array([[0, 2], [0, 0]]), 2), [[2]])
@@ -0,0 +1,97 @@
+"""
+Tests of the numerical PASTIS matrices, built on the small telescope of the small_aplc fixture instead of LuvoirAPLC.
+"""
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+
+@pytest.fixture
+def matrix_building(small_aplc, set_config, tmp_path, monkeypatch):
+    """ matrix_building_numerical on the small telescope, writing its experiment directories into tmp_path. """
+    import matrix_building_numerical
+    import util_pastis as util
+
+    small_aplc.cache_config = {'telescope': 'test'}
+    small_aplc.dark_hole_regions = lambda annuli=(), halves=False, masks=None: {'dh': small_aplc.dark_hole}
+    monkeypatch.setattr(matrix_building_numerical, 'LuvoirAPLC', lambda *args, **kwargs: small_aplc)
+
+    experiments = iter(range(100))
+    monkeypatch.setattr(util, 'create_data_path',
+                        lambda initial_path, telescope='', suffix='': str(tmp_path / f'experiment{next(experiments)}'))
+    monkeypatch.setattr(util, 'setup_pastis_logging', lambda experiment_path, name: None)
+    monkeypatch.setattr(util, 'copy_config', lambda outdir: None)
+
+    set_config('LUVOIR', 'nb_subapertures', small_aplc.seg_pos.size)
+    set_config('LUVOIR', 'nb_wavelengths', 1)
+    set_config('calibration', 'local_zernike', 1)
+    set_config('calibration', 'calibration_aberration', 1.)
+    return matrix_building_numerical
+
+
+def test_update_matrix_luvoir(matrix_building, set_config):
+    """ Recomputing segments of an unchanged telescope gives the matrix of num_matrix_luvoir() back. """
+    parent_dir = matrix_building.num_matrix_luvoir('small', saveopds=False)
+    matrix_path = 'matrix_numerical/PASTISmatrix_num_piston_Noll1.fits'
+    parent = fits.getdata(f'{parent_dir}/{matrix_path}')
+
+    updated_dir = matrix_building.update_matrix_luvoir(parent_dir, 'small', segments=[7, 2])
+    updated, header = fits.getdata(f'{updated_dir}/{matrix_path}', header=True)
+
+    np.testing.assert_allclose(updated, parent, rtol=1e-10, atol=1e-10 * np.abs(parent).max())
+    assert header['UPDSEGS'] == '3,8'
+    assert header['CFGHASH'] == fits.getheader(f'{parent_dir}/{matrix_path}')['CFGHASH']
+
+    # A parent of another configuration is refused
+    set_config('calibration', 'calibration_aberration', 2.)
+    with pytest.raises(ValueError, match='CFGHASH'):
+        matrix_building.update_matrix_luvoir(parent_dir, 'small', segments=[2])
+    set_config('calibration', 'calibration_aberration', 1.)
+    set_config('LUVOIR', 'nb_wavelengths', 3)
+    with pytest.raises(ValueError, match='nb_wavelengths'):
+        matrix_building.update_matrix_luvoir(parent_dir, 'small', segments=[2])
+
+
+def test_update_matrix_luvoir_regions(matrix_building, small_aplc):
+    """ The matrices of the additional focal plane regions of the parent are updated with the one of the dark hole. """
+    from e2e_simulators.luvoir_imaging import LuvoirAPLC
+
+    small_aplc.lam_over_d = small_aplc.lamDrad
+    small_aplc.dark_hole_regions = lambda annuli=(), halves=False, masks=None: \
+        LuvoirAPLC.dark_hole_regions(small_aplc, annuli, halves, masks)
+    parent_dir = matrix_building.num_matrix_luvoir('small', saveopds=False, annuli=[(2, 6)], halves=True)
+    updated_dir = matrix_building.update_matrix_luvoir(parent_dir, 'small', segments=[4])
+
+    names = ['', '_annulus_2-6', '_dh_right', '_dh_left', '_dh_top', '_dh_bottom']
+    for suffix in names:
+        matrix_path = f'matrix_numerical/PASTISmatrix_num_piston_Noll1{suffix}.fits'
+        parent = fits.getdata(f'{parent_dir}/{matrix_path}')
+        updated, header = fits.getdata(f'{updated_dir}/{matrix_path}', header=True)
+        np.testing.assert_allclose(updated, parent, rtol=1e-10, atol=1e-10 * np.abs(parent).max(), err_msg=suffix)
+        assert header['UPDSEGS'] == '5'
+    assert os.path.exists(f'{updated_dir}/matrix_numerical/dark_hole_regions.fits')
+
+
+def test_num_matrix_luvoir_multimode_files(matrix_building, small_aplc):
+    """ The diagonal blocks of a multi-mode matrix get their own file names and, like the matrix, the config hash. """
+    small_aplc.wavelengths = [small_aplc.wvln]
+    piston_dir = matrix_building.num_matrix_luvoir('small', saveopds=False)
+    piston_matrix = fits.getdata(f'{piston_dir}/matrix_numerical/PASTISmatrix_num_piston_Noll1.fits')
+
+    overall_dir = matrix_building.num_matrix_luvoir_multimode('small', modes=('piston', 'tip'))
+    files = set(os.listdir(f'{overall_dir}/matrix_numerical'))
+    assert 'PASTISmatrix_num_piston_Noll1.fits' not in files
+
+    name = 'PASTISmatrix_num_multimode_piston-tip'
+    matrix, header = fits.getdata(f'{overall_dir}/matrix_numerical/{name}.fits', header=True)
+    assert header['MODES'] == 'piston,tip' and header['NBWAVES'] == 1 and 'CFGHASH' in header
+    for i, mode in enumerate(('piston', 'tip')):
+        block, header_block = fits.getdata(f'{overall_dir}/matrix_numerical/{name}_block_{mode}.fits', header=True)
+        assert header_block['MODES'] == mode
+        assert header_block['CFGHASH'] == header['CFGHASH']
+        np.testing.assert_array_equal(block, matrix[i * 18:(i + 1) * 18, i * 18:(i + 1) * 18])
+
+    # Single pokes of the piston block are the ones of the pair-wise piston matrix
+    np.testing.assert_allclose(np.diag(matrix)[:18], np.diag(piston_matrix), rtol=1e-8)
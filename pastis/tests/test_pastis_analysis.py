@@ -0,0 +1,65 @@
+"""
+Tests of the PASTIS analysis helpers for several local segment modes, on the small telescope of the small_aplc fixture.
+"""
+import numpy as np
+import pytest
+from astropy.io import fits
+
+
+@pytest.fixture
+def pastis_analysis():
+    return pytest.importorskip('pastis_analysis', exc_type=ImportError)
+
+
+def test_matrix_local_modes(pastis_analysis):
+    header = fits.Header()
+    assert pastis_analysis.matrix_local_modes(header) == ('piston',)
+    header['MODES'] = 'piston,tip,tilt'
+    assert pastis_analysis.matrix_local_modes(header) == ('piston', 'tip', 'tilt')
+
+
+def test_apply_mode_to_luvoir(pastis_analysis, small_aplc):
+    """ Each local mode of a multi-mode PASTIS mode puts its rms OPD in nm onto its segment. """
+    aplc = small_aplc
+    modes = ('piston', 'tip', 'tilt')
+    nseg = aplc.seg_pos.size
+    indices = np.rint(np.asarray(aplc.sm.ind_aper)).astype(int)
+
+    # Piston only is the same as on the bare segmented mirror
+    pmode = np.random.default_rng(6).normal(size=nseg)
+    wf_luvoir = pastis_analysis.apply_mode_to_luvoir(pmode, aplc)
+    wf_sm = pastis_analysis.apply_mode_to_sm(pmode.copy(), aplc.sm, aplc.wf_aper)
+    np.testing.assert_allclose(wf_luvoir.phase, wf_sm.phase, rtol=0, atol=1e-12)
+
+    for m, mode in enumerate(modes):
+        pmode = np.zeros(len(modes) * nseg)
+        pmode[m * nseg + 4] = 2.
+        wf = pastis_analysis.apply_mode_to_luvoir(pmode, aplc, modes)
+        opd = np.asarray(wf.phase / wf.wavenumber) * 1e9
+
+        assert np.all(opd[indices != 5] == 0), mode
+        rms = np.sqrt(np.mean(np.square(opd[indices == 5])))
+        np.testing.assert_allclose(rms, 2., rtol=0.05, err_msg=mode)
+
+
+def test_set_matrix_band(pastis_analysis, small_aplc):
+    """ Monochromatic matrices pin the simulator to the central wavelength, broadband ones have to match its band. """
+    aplc = small_aplc
+    wavelengths = list(aplc.wavelengths)
+    header = fits.Header()
+    header['NBWAVES'] = 3
+    header['BANDWID'] = 0.1
+    pastis_analysis.set_matrix_band(aplc, header)
+    assert aplc.wavelengths == wavelengths
+    floor_broadband = pastis_analysis.coronagraph_floor(aplc)
+
+    header['NBWAVES'] = 5
+    with pytest.raises(ValueError, match='nb_wavelengths'):
+        pastis_analysis.set_matrix_band(aplc, header)
+
+    pastis_analysis.set_matrix_band(aplc, fits.Header())
+    assert aplc.wavelengths == [aplc.wvln]
+    psf, psf_ref = aplc.calc_psf(ref=True)
+    np.testing.assert_allclose(pastis_analysis.coronagraph_floor(aplc),
+                               np.mean(np.asarray(psf)[aplc.dark_hole.indices]) / np.max(psf_ref), rtol=1e-10)
+    assert not np.isclose(pastis_analysis.coronagraph_floor(aplc), floor_broadband, rtol=1e-3, atol=0)
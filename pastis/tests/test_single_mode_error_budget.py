@@ -0,0 +1,24 @@
+"""
+Tests of the single-mode error budget, on the small telescope of the small_aplc fixture.
+"""
+import numpy as np
+import pytest
+
+
+def test_single_mode_contrasts_multimode(small_aplc):
+    """ A PASTIS mode of several local modes puts each of them on its segments, like a piston-only mode does. """
+    single_mode_error_budget = pytest.importorskip('single_mode_error_budget', exc_type=ImportError)
+    aplc = small_aplc
+    nseg = aplc.seg_pos.size
+    pmodes = np.random.default_rng(11).normal(size=(3 * nseg, 2))
+
+    for modes, pmodes_modes in ((('piston',), pmodes[:nseg]), (('piston', 'tip', 'tilt'), pmodes)):
+        contrast = single_mode_error_budget.single_mode_contrasts(2., pmodes_modes, 2, aplc, modes)
+        coef = aplc.modal_aber_to_coef(2e-9 * pmodes_modes[:, 1], modes)
+        np.testing.assert_allclose(contrast, aplc.calc_psf_batch(coef[np.newaxis])[0], rtol=1e-12)
+
+    # Piston only is the same as half the OPD on the segment surfaces
+    coef = np.zeros((nseg, 3))
+    coef[:, 0] = 1e-9 * pmodes[:nseg, 1]
+    np.testing.assert_allclose(single_mode_error_budget.single_mode_contrasts(2., pmodes[:nseg], 2, aplc),
+                               aplc.calc_psf_batch(coef[np.newaxis])[0], rtol=1e-12)
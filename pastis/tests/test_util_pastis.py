@@ -0,0 +1,55 @@
+"""
+Tests of the array helpers in util_pastis.py.
+"""
+import numpy as np
+import pytest
+
+import util_pastis as util
+
+
+def test_load_npz_mmap(tmp_path):
+    arrays = {'version': 1,
+              'telescope': 'LUVOIR',
+              'seg_position': np.random.rand(120, 2),
+              'Projection_Matrix': np.arange(14400, dtype=np.int16).reshape(120, 120),
+              'fortran': np.asfortranarray(np.random.rand(3, 4)),
+              'empty': np.zeros((0, 2))}
+    filepath = str(tmp_path / 'bundle.npz')
+    np.savez(filepath, **arrays)
+
+    loaded = util.load_npz_mmap(filepath)
+
+    assert set(loaded) == set(arrays)
+    for name, array in arrays.items():
+        np.testing.assert_array_equal(loaded[name], array)
+        assert not loaded[name].flags.writeable
+    assert isinstance(loaded['seg_position'], np.memmap)
+    assert not isinstance(loaded['version'], np.memmap)
+    assert loaded['version'].shape == ()
+    assert int(loaded['version']) == 1
+    assert str(loaded['telescope']) == 'LUVOIR'
+
+
+@pytest.mark.parametrize('shape', [(8, 8), (6, 10), (4, 6), (7, 9), (6, 7)])
+def test_fft_shift_ramps(shape):
+    """ FFT() and IFFT() with the sign ramps (even shapes) or the shifts (odd shapes) are the centered FFTs. """
+    rng = np.random.default_rng(0)
+    ef = rng.normal(size=shape) + 1j * rng.normal(size=shape)
+
+    np.testing.assert_allclose(util.FFT(ef), np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(ef))), rtol=0, atol=1e-12)
+    np.testing.assert_allclose(util.IFFT(ef), np.fft.ifftshift(np.fft.ifft2(np.fft.fftshift(ef))), rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('half_box', [None, 20])
+def test_dh_mean_dark_hole_and_mask(half_box):
+    """ dh_mean() on the precomputed indices of a DarkHole is the mean over its mask, including pixels that are zero. """
+    dark_hole = util.get_dark_hole((64, 64), 3, 10, 2, half_box=half_box)
+    im = np.random.default_rng(1).random(dark_hole.mask.shape)
+    rows, cols = np.nonzero(dark_hole.mask)
+    im[rows[:5], cols[:5]] = 0
+
+    expected = np.mean(im[dark_hole.mask != 0])
+    np.testing.assert_allclose(util.dh_mean(im, dark_hole), expected, rtol=1e-14)
+    np.testing.assert_allclose(util.dh_mean(im, dark_hole.mask), expected, rtol=1e-14)
+    np.testing.assert_allclose(util.dh_mean(im.ravel(), dark_hole), expected, rtol=1e-14)   # e.g. HCIPy Fields
+    assert not dark_hole.mask.flags.writeable and not dark_hole.indices.flags.writeable
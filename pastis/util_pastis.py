@@ -3,8 +3,13 @@ Helper functions for PASTIS.
 """
 
 import os
+import atexit
+import collections
 import datetime
+import functools
+import pickle
 import time
+import zipfile
 from shutil import copy
 import sys
 from astropy.io import fits
@@ -13,6 +18,8 @@ import logging
 import logging.handlers
 import numpy as np
 
+from config import CONFIG_INI
+
 log = logging.getLogger()
 
 
@@ -35,7 +42,7 @@ def write_fits(data, filepath, header=None, metadata=None):
     # Create a PrimaryHDU object to encapsulate the data.
     hdu = fits.PrimaryHDU(data)
     if header is not None:
-        hdu.header = header
+        hdu.header.update(header)   # keep the mandatory keywords of the data
 
     # Add metadata to header.
     if metadata is not None:
@@ -56,6 +63,45 @@ def write_fits(data, filepath, header=None, metadata=None):
     return filepath
 
 
+def load_npz_mmap(filepath):
+    """
+    Memory-map all arrays of an uncompressed npz file (as written by np.savez) read-only.
+
+    np.load() ignores mmap_mode for npz files, so this finds where each array's data starts inside the zip archive and
+    maps it directly with np.memmap. Scalar (0-d) and empty members are read into memory with np.load() instead.
+    :param filepath: str, path to the npz file
+    :return: dict of read-only arrays, keyed by the names they were saved with
+    """
+    arrays = {}
+    with zipfile.ZipFile(filepath) as archive, open(filepath, 'rb') as raw, np.load(filepath) as npz:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'{filepath} is compressed and can not be memory-mapped, save it with np.savez().')
+
+            # The data of a member starts after its local file header, which has a fixed size of 30 bytes followed by
+            # the file name and an extra field of variable lengths.
+            raw.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(raw.read(4), dtype='<u2')
+            raw.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+
+            # Read the npy header of the member to get shape, order and type of the array
+            version = np.lib.format.read_magic(raw)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw)
+
+            order = 'F' if fortran_order else 'C'
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if len(shape) == 0 or 0 in shape:
+                arrays[name] = npz[name]
+                arrays[name].flags.writeable = False
+            else:
+                arrays[name] = np.memmap(filepath, dtype=dtype, mode='r', offset=raw.tell(), shape=shape, order=order)
+
+    return arrays
+
+
 def circle_mask(im, xc, yc, rcirc):
     """ Create a circle on array im centered on xc, yc with radius rcirc; inside circle equals 1."""
     x, y = np.shape(im)
@@ -88,15 +134,98 @@ def zoom_cen(im, bb):
     return im[int(y-bb):int(y+bb), int(x-bb):int(x+bb)]
 
 
+@functools.lru_cache(maxsize=None)
+def get_fft_backend():
+    """
+    Get the 2D FFT functions of the backend selected in the configfile: 'numpy', 'scipy' or 'pyfftw'.
+
+    The scipy and pyfftw backends run multi-threaded with the number of threads from the configfile (0 for all cores).
+    The pyfftw backend caches its plans and loads and saves its wisdom from and to the wisdom file in the configfile.
+    :return: fft2, ifft2: functions
+    """
+    backend = CONFIG_INI.get('numerical', 'fft_backend', fallback='numpy')
+    threads = CONFIG_INI.getint('numerical', 'fft_threads', fallback=1) or os.cpu_count()
+
+    if backend == 'numpy':
+        return np.fft.fft2, np.fft.ifft2
+
+    if backend == 'scipy':
+        import scipy.fft
+        return functools.partial(scipy.fft.fft2, workers=threads), functools.partial(scipy.fft.ifft2, workers=threads)
+
+    if backend == 'pyfftw':
+        import pyfftw
+        import pyfftw.interfaces.numpy_fft
+
+        wisdom_file = CONFIG_INI.get('numerical', 'fftw_wisdom_file')
+        if os.path.isfile(wisdom_file):
+            with open(wisdom_file, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+        atexit.register(save_fftw_wisdom, wisdom_file)
+
+        pyfftw.interfaces.cache.enable()
+        return (functools.partial(pyfftw.interfaces.numpy_fft.fft2, threads=threads, planner_effort='FFTW_MEASURE'),
+                functools.partial(pyfftw.interfaces.numpy_fft.ifft2, threads=threads, planner_effort='FFTW_MEASURE'))
+
+    raise ValueError(f"Unknown FFT backend '{backend}', use 'numpy', 'scipy' or 'pyfftw'.")
+
+
+def save_fftw_wisdom(wisdom_file):
+    """
+    Save the pyFFTW wisdom so that later runs can reuse the FFT plans.
+    :param wisdom_file: str, path to the wisdom file
+    """
+    import pyfftw
+    os.makedirs(os.path.dirname(wisdom_file), exist_ok=True)
+    with open(wisdom_file, 'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+
+
+def configure_poppy_fft():
+    """
+    Make poppy (and with it WebbPSF) use FFTW if pyfftw is the FFT backend selected in the configfile.
+    """
+    import poppy
+    poppy.conf.use_fftw = CONFIG_INI.get('numerical', 'fft_backend', fallback='numpy') == 'pyfftw'
+
+
+@functools.lru_cache(maxsize=8)
+def _fft_shift_ramps(shape):
+    """
+    Sign patterns that replace the centering shifts around an FFT of an array with even dimensions.
+
+    For even N, fftshift(fft(ifftshift(x)))[k] = (-1)^(N/2) * (-1)^k * fft((-1)^n * x[n])[k], and the same holds for
+    the inverse FFT, so the shifts become two element-wise multiplications.
+    :param shape: tuple, shape of the 2D array
+    :return: ramp_in, ramp_out: arrays to multiply the input and output of the FFT with
+    """
+    ny, nx = shape
+    ramp_in = (-1.) ** np.add.outer(np.arange(ny), np.arange(nx))
+    ramp_out = ramp_in * (-1.) ** ((ny + nx) // 2)
+    return ramp_in, ramp_out
+
+
 def FFT(ef):
-    """Do the numpy Fourier transform on complex array 'ef', together with all the shifting needed."""
-    FFT_E = np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(ef)))
+    """Do the Fourier transform on complex array 'ef', together with all the shifting needed."""
+    fft2, _ifft2 = get_fft_backend()
+    if ef.ndim == 2 and ef.shape[0] % 2 == 0 and ef.shape[1] % 2 == 0:
+        ramp_in, ramp_out = _fft_shift_ramps(ef.shape)
+        FFT_E = fft2(ef * ramp_in)
+        FFT_E *= ramp_out
+    else:
+        FFT_E = np.fft.fftshift(fft2(np.fft.ifftshift(ef)))
     return FFT_E
 
 
 def IFFT(ef):
-    """Do the numpy inverse Fourier transform on complex array 'ef', together with all the shifting needed."""
-    IFFT_E = np.fft.ifftshift(np.fft.ifft2(np.fft.fftshift(ef)))
+    """Do the inverse Fourier transform on complex array 'ef', together with all the shifting needed."""
+    _fft2, ifft2 = get_fft_backend()
+    if ef.ndim == 2 and ef.shape[0] % 2 == 0 and ef.shape[1] % 2 == 0:
+        ramp_in, ramp_out = _fft_shift_ramps(ef.shape)
+        IFFT_E = ifft2(ef * ramp_in)
+        IFFT_E *= ramp_out
+    else:
+        IFFT_E = np.fft.ifftshift(ifft2(np.fft.fftshift(ef)))
     return IFFT_E
 
 
@@ -109,24 +238,52 @@ def create_dark_hole(pup_im, iwa, owa, samp):
     :param samp: sampling factor
     :return: dh_area: np.array
     """
-    circ_inner = circle_mask(pup_im, pup_im.shape[0]/2., pup_im.shape[1]/2., iwa * samp) * 1   # *1 converts from booleans to integers
-    circ_outer = circle_mask(pup_im, pup_im.shape[0]/2., pup_im.shape[1]/2., owa * samp) * 1
-    dh_area = circ_outer - circ_inner
+    return get_dark_hole(np.shape(pup_im), iwa, owa, samp).mask.copy()
 
-    return dh_area
+
+# Dark hole mask and the flat indices of its pixels, see get_dark_hole()
+DarkHole = collections.namedtuple('DarkHole', ['mask', 'indices'])
+
+
+@functools.lru_cache(maxsize=None)
+def get_dark_hole(shape, iwa, owa, samp, half_box=None):
+    """
+    Get the dark hole on an image of the given shape, which is only built once per set of parameters.
+
+    Contrasts are then a mean over the pixels picked with the flat indices, see dh_mean(). The returned arrays are
+    shared between all callers and read-only.
+    :param shape: tuple, shape of the image
+    :param iwa: inner working angle in lambda/D
+    :param owa: outer working angle in lambda/D
+    :param samp: sampling factor
+    :param half_box: float or None, cut the dark hole down to a box of this half-size around the image center, see zoom_cen()
+    :return: DarkHole, with the integer dark hole mask and the flat indices of the pixels inside of it
+    """
+    shape = tuple(shape)
+    image = np.broadcast_to(0, shape)   # circle_mask() only needs the shape
+    circ_inner = circle_mask(image, shape[0]/2., shape[1]/2., iwa * samp) * 1   # *1 converts from booleans to integers
+    circ_outer = circle_mask(image, shape[0]/2., shape[1]/2., owa * samp) * 1
+    mask = circ_outer - circ_inner
+    if half_box is not None:
+        mask = np.ascontiguousarray(zoom_cen(mask, half_box))
+
+    indices = np.flatnonzero(mask)
+    mask.flags.writeable = False
+    indices.flags.writeable = False
+    return DarkHole(mask, indices)
 
 
 def dh_mean(im, dh):
     """
     Return the dark hole contrast.
 
-    Calculate the mean intensity in the dark hole area dh of the image im.
-    im and dh have to have the same array size and shape.
+    Calculate the mean intensity in the dark hole area dh of the image im, including pixels that are exactly zero.
+    im and dh have to have the same number of pixels.
     :param im: array, image
-    :param dh: array, dark hole mask
+    :param dh: array, dark hole mask; or DarkHole, to pick the pixels with its precomputed indices
     """
-    darkh = im * dh
-    con = np.mean(darkh[np.where(darkh != 0)])
+    indices = dh.indices if isinstance(dh, DarkHole) else np.flatnonzero(dh)
+    con = np.mean(np.asarray(im).ravel()[indices])
     return con
 
 
@@ -134,7 +291,8 @@ def dh_mean(im, dh):
 def pastis_contrast(aber, matrix_pastis):
     """
     Calculate the contrast with PASTIS matrix model.
-    :param aber: aberration vector, its length is number of segments, WFE aberration coefficients in NANOMETERS
+    :param aber: aberration vector, its length is number of segments (times number of local modes for a multi-mode
+                 matrix), WFE aberration coefficients in NANOMETERS
     :param matrix_pastis: PASTIS matrix, in contrast/nm^2
     :return:
     """
@@ -142,6 +300,27 @@ def pastis_contrast(aber, matrix_pastis):
     return result.value
 
 
+def matrix_blocks(matrix, nmodes):
+    """
+    View a multi-mode PASTIS matrix as blocks per pair of local modes.
+    :param matrix: array, PASTIS matrix [nmodes*nseg, nmodes*nseg], ordered by mode first, then by segment
+    :param nmodes: int, number of local modes
+    :return: array [nmodes, nmodes, nseg, nseg], blocks[m, n] couples local mode m with local mode n
+    """
+    nseg = matrix.shape[0] // nmodes
+    return matrix.reshape(nmodes, nseg, nmodes, nseg).transpose(0, 2, 1, 3)
+
+
+def matrix_from_blocks(blocks):
+    """
+    Assemble a multi-mode PASTIS matrix from its blocks per pair of local modes.
+    :param blocks: array [nmodes, nmodes, nseg, nseg]
+    :return: array, PASTIS matrix [nmodes*nseg, nmodes*nseg], ordered by mode first, then by segment
+    """
+    nmodes, _, nseg, _ = blocks.shape
+    return blocks.transpose(0, 2, 1, 3).reshape(nmodes * nseg, nmodes * nseg)
+
+
 def calc_statistical_mean_contrast(pastismatrix, cov_segments, coro_floor):
     """
     Analytically calculate the *statistical* mean contrast for a set of segment requirements.